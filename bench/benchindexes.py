@@ -0,0 +1,215 @@
+#!/usr/bin/python3
+
+# Benchmark the queries the web service and the logger run against the log tables, before and
+# after the migrations that add the indexes. It generates years of toll and travel time history
+# for a set of trips in a scratch database, times the queries on the schema as it was before the
+# indexes, applies the rest of the migrations, and times them again. Point it at a scratch database, not
+# the real one; it drops and recreates it.
+#
+#   bench/benchindexes.py --database tolls_bench --trips 10 --years 3
+#
+# Reports the median and 99th percentile time for each query, with the index MariaDB chose.
+
+import os, sys
+
+# The logger's modules live one directory up.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import argparse, logging, random, time
+import migrate, mysql.connector, tollspool
+from datetime import datetime
+from datetime import timedelta
+from decimal import Decimal
+
+# How many rows to insert in one statement.
+INSERT_CHUNK = 5000
+
+# The web service's query for a window of a trip's toll prices.
+TOLL_PRICES_SQL = '''
+        SELECT DATE_FORMAT(toll_start_date, '%Y%m%d%H%i') toll_start_date,
+            DATE_FORMAT(toll_end_date, '%Y%m%d%H%i') toll_end_date,
+            CONVERT(COALESCE(price_495, 0) + COALESCE(price_95, 0), CHAR) toll_price
+          FROM toll_log
+          WHERE ramp_on = %(ramp_on)s
+            AND ramp_off = %(ramp_off)s
+            AND toll_end_date >= %(min_date)s
+          ORDER BY toll_end_date DESC, toll_start_date DESC
+'''
+
+# The queries, as the web service and the logger run them, with how many minutes back they look.
+QUERIES = {
+    'toll prices, 12 hours':(TOLL_PRICES_SQL, 720),
+    'toll prices, 7 days':(TOLL_PRICES_SQL, 10080),
+    'travel times, 12 hours':('''
+        SELECT DATE_FORMAT(time_start_date, '%Y%m%d%H%i') time_start_date,
+            DATE_FORMAT(time_end_date, '%Y%m%d%H%i') time_end_date,
+            COALESCE(time_495, time_95) travel_time
+          FROM time_log
+          WHERE ramp_on = %(ramp_on)s
+            AND ramp_off = %(ramp_off)s
+            AND time_end_date >= %(min_date)s
+          ORDER BY time_end_date DESC, time_start_date DESC
+    ''', 720),
+    'toll changes, 5 minutes':('''
+        SELECT toll_log_id, toll_end_date end_date
+          FROM toll_log
+          WHERE ramp_on = %(ramp_on)s
+            AND ramp_off = %(ramp_off)s
+            AND toll_end_date > %(min_date)s
+        UNION
+        SELECT toll_log_id, toll_end_date end_date
+          FROM toll_log
+          WHERE ramp_on = %(ramp_on)s
+            AND ramp_off = %(ramp_off)s
+            AND toll_log_id > %(after_id)s
+        ORDER BY end_date DESC
+    ''', 5),
+    'logger series lookup':(tollspool.LOG_TABLES['toll_log']['find'], 0),
+}
+
+def connect(args, database=None):
+    connect_args = {'user':args.user, 'host':args.host}
+    if args.password is not None: connect_args['password'] = args.password
+    if database is not None: connect_args['database'] = database
+
+    return mysql.connector.connect(**connect_args)
+
+# Fill the log tables with a run of series for each trip, from years ago up to end. A series lasts
+# anywhere from a minute to a couple of hours, mostly a few minutes, like the real ones.
+def generate(conn, trips, years, end):
+    curs = conn.cursor()
+    start = end - timedelta(days=365 * years)
+
+    for trip in trips:
+        toll_rows = []
+        time_rows = []
+
+        for rows, make_row in (
+          (toll_rows, lambda: (Decimal(random.randint(50, 4000)) / 100, None)),
+          (time_rows, lambda: (random.randint(5, 60), None))):
+            series_start = start
+
+            while series_start < end:
+                series_end = min(series_start + timedelta(minutes=int(random.expovariate(1 / 8))), end)
+                rows.append((series_start, series_end, trip['ramp_on'], trip['ramp_off'], 'N') + make_row())
+                series_start = series_end + timedelta(minutes=1)
+
+        for sql, rows in (
+          ('''
+            INSERT
+              INTO toll_log (toll_start_date, toll_end_date, ramp_on, ramp_off, direction, price_495, price_95)
+              VALUES (%s, %s, %s, %s, %s, %s, %s)
+          ''', toll_rows),
+          ('''
+            INSERT
+              INTO time_log (time_start_date, time_end_date, ramp_on, ramp_off, direction, time_495, time_95)
+              VALUES (%s, %s, %s, %s, %s, %s, %s)
+          ''', time_rows)):
+            for chunk in range(0, len(rows), INSERT_CHUNK):
+                curs.executemany(sql, rows[chunk:chunk + INSERT_CHUNK])
+
+        conn.commit()
+
+        logging.info('generated {} toll and {} time rows for {}/{}'.format(len(toll_rows), len(time_rows),
+            trip['ramp_on'], trip['ramp_off']))
+
+    for table in ('toll_log', 'time_log'):
+        curs.execute('ANALYZE TABLE {}'.format(table))
+        curs.fetchall()
+
+    curs.close()
+
+# The pth percentile of a list of numbers.
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+# Time each query against random trips. Returns query -> (p50, p99, index used).
+def run_queries(conn, trips, end, repeat):
+    curs = conn.cursor()
+    results = {}
+
+    curs.execute('SELECT MAX(toll_log_id) FROM toll_log')
+    max_id = curs.fetchone()[0]
+
+    for name, (sql, minutes) in QUERIES.items():
+        timings = []
+
+        for i in range(repeat):
+            trip = random.choice(trips)
+            args = dict(trip, min_date=end - timedelta(minutes=minutes), after_id=max_id - len(trips))
+            # The logger looks for a series that started recently.
+            args['toll_start_date'] = end - timedelta(minutes=random.randint(0, 30))
+
+            began = time.perf_counter()
+            curs.execute(sql, args)
+            curs.fetchall()
+            timings.append(time.perf_counter() - began)
+
+        curs.execute('EXPLAIN ' + sql, args)
+        columns = curs.column_names
+        indexes = [row[columns.index('key')] for row in curs.fetchall()]
+
+        results[name] = (percentile(timings, 50), percentile(timings, 99),
+            ', '.join(str(index) for index in indexes))
+
+    curs.close()
+
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the log table queries before and after the index migrations.')
+    parser.add_argument('--trips', type=int, default=10, help='how many trips to generate history for')
+    parser.add_argument('--years', type=int, default=3, help='how many years of history to generate')
+    parser.add_argument('--repeat', type=int, default=200, help='how many times to run each query')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--user', default=os.environ.get('USER'))
+    parser.add_argument('--password')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--database', default='tolls_bench')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s:%(levelname)s:%(message)s', level=logging.INFO)
+
+    random.seed(args.seed)
+
+    conn = connect(args)
+    curs = conn.cursor()
+    curs.execute('DROP DATABASE IF EXISTS {}'.format(args.database))
+    curs.execute('CREATE DATABASE {}'.format(args.database))
+    curs.close()
+    conn.close()
+
+    conn = connect(args, args.database)
+
+    # Start from the schema as it was before the indexes.
+    indexes = [version for version, name, path in migrate.migrations() if name == 'trip_range_indexes'][0]
+    migrate.migrate(conn, indexes - 1)
+
+    trips = [{'ramp_on':1000 + trip, 'ramp_off':2000 + trip} for trip in range(args.trips)]
+    end = datetime.now().replace(second=0, microsecond=0)
+
+    began = time.perf_counter()
+    generate(conn, trips, args.years, end)
+    logging.info('generated the history in {:.1f} s'.format(time.perf_counter() - began))
+
+    before = run_queries(conn, trips, end, args.repeat)
+
+    began = time.perf_counter()
+    applied = migrate.migrate(conn)
+    logging.info('applied migrations {} in {:.1f} s'.format(applied, time.perf_counter() - began))
+
+    after = run_queries(conn, trips, end, args.repeat)
+
+    conn.close()
+
+    print('{:26} {:>10} {:>10} {:>10} {:>10} {:>8}  {}'.format('query', 'p50 before', 'p99 before',
+        'p50 after', 'p99 after', 'speedup', 'index before -> after'))
+
+    for name in QUERIES:
+        print('{:26} {:>8.2f}ms {:>8.2f}ms {:>8.2f}ms {:>8.2f}ms {:>7.1f}x  {} -> {}'.format(name,
+            before[name][0] * 1000, before[name][1] * 1000, after[name][0] * 1000, after[name][1] * 1000,
+            before[name][0] / after[name][0], before[name][2], after[name][2]))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+#!/usr/bin/python3
+
+# Benchmark the logger's tick loop, offline. The web API is replaced by the scripted stand-in in
+# fakeexpresslanes.py, and the ticks are written to a local database; point it at a scratch
+# database, not the real one. Minutes are simulated, so M minutes take only as long as the work
+# in them does.
+#
+#   bench/benchlogger.py --database tolls_bench --create-schema --trips 50 --minutes 240
+#
+# Reports ticks per second, database statements per tick, and tick latency percentiles.
+
+import os, sys
+
+# The logger's modules live one directory up.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import argparse, concurrent.futures, logging, tempfile, time
+import expresslanes, fakeexpresslanes, logtolls, migrate, mysql.connector, tollspool
+from datetime import datetime
+from datetime import timedelta
+
+# Create the logger's tables in the benchmark database.
+def create_schema(connect_args):
+    conn = mysql.connector.connect(**connect_args)
+    migrate.migrate(conn)
+    conn.close()
+
+# The pth percentile of a list of numbers.
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the toll logger against a stand-in web API.')
+    parser.add_argument('--trips', type=int, default=20, help='how many trips to log')
+    parser.add_argument('--minutes', type=int, default=60, help='how many minutes to simulate')
+    parser.add_argument('--every-minute', action='store_true', help='poll every trip every minute')
+    parser.add_argument('--user', default=os.environ.get('USER'))
+    parser.add_argument('--password')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--database', default='tolls_bench')
+    parser.add_argument('--create-schema', action='store_true', help='create the tables first')
+    fakeexpresslanes.script_args(parser)
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s:%(levelname)s:%(message)s', level=logging.WARNING)
+
+    connect_args = {'user':args.user, 'host':args.host, 'database':args.database}
+    if args.password is not None: connect_args['password'] = args.password
+
+    if args.create_schema:
+        create_schema(connect_args)
+
+    # Start the stand-in web API.
+    script = fakeexpresslanes.script_from(args)
+    server = fakeexpresslanes.serve(script)
+
+    # There's no point spreading requests over a simulated minute, or limiting their rate.
+    logtolls.SPREAD_SECONDS = 0
+    if args.every_minute: logtolls.POLL_CEILING = 1
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=logtolls.FETCH_WORKERS)
+    limiter = expresslanes.RateLimiter(1e9, 1e9)
+
+    client = expresslanes.Client('127.0.0.1', server.server_address[1], secure=False,
+        pool_size=logtolls.FETCH_WORKERS, connect_timeout=logtolls.CONNECT_TIMEOUT,
+        read_timeout=logtolls.FETCH_TIMEOUT, retries=logtolls.FETCH_RETRIES)
+
+    spool_dir = tempfile.mkdtemp()
+    writer = tollspool.Writer(tollspool.Spool(os.path.join(spool_dir, 'bench.spool'), name='bench'), connect_args)
+    writer.connect()
+
+    trips = [{'ramp_on':1000 + trip, 'ramp_off':2000 + trip} for trip in range(args.trips)]
+    reversible = {}
+
+    start = datetime.now().replace(second=0, microsecond=0)
+    latencies = []
+    statements = []
+
+    began = time.perf_counter()
+
+    for minute in range(args.minutes):
+        log_date = start + timedelta(minutes=minute)
+        script.minute = int(log_date.timestamp() // 60)
+
+        # Each tick is timed from the start of its fetches until it's in the database.
+        tick_began = time.perf_counter()
+        logtolls.run_tick(executor, client, limiter, trips, logtolls.REVERSIBLE_RAMPS, reversible, writer,
+            log_date, start=datetime.now())
+        statements.append(writer.drain())
+        latencies.append(time.perf_counter() - tick_began)
+
+    elapsed = time.perf_counter() - began
+
+    writer.disconnect()
+    executor.shutdown()
+    server.shutdown()
+
+    print('trips:              {}'.format(args.trips))
+    print('minutes:            {}'.format(args.minutes))
+    print('upstream requests:  {}'.format(script.requests))
+    print('elapsed:            {:.2f} s'.format(elapsed))
+    print('ticks per second:   {:.2f}'.format(args.minutes / elapsed))
+    print('statements / tick:  {:.2f}'.format(sum(statements) / len(statements)))
+    print('tick latency p50:   {:.1f} ms'.format(percentile(latencies, 50) * 1000))
+    print('tick latency p99:   {:.1f} ms'.format(percentile(latencies, 99) * 1000))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+#!/usr/bin/python3
+
+# Benchmark drawing the toll display, without a display (it only needs Pillow and NumPy, so it
+# runs anywhere, CI included). It draws a day or so of made-up tolls a minute at a time, the way
+# tolldisp and the web service do, and times the first frame (which draws everything), every frame
+# after it (which only draws what changed), and encoding a frame as a PNG.
+#
+#   bench/benchrender.py --frames 500 --size 800x480 --minutes 720
+#
+# Reports the median and 99th percentile time for each. Without the Ubuntu fonts installed, it
+# draws with Pillow's built-in font instead.
+
+import os, sys
+
+# The series lives one directory up, with the display's modules, and the renderer in the web
+# service's package, which may not be installed where we're benchmarking.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'webtoll'))
+
+import argparse, io, random, time
+import tollseries
+from webtoll import render
+from datetime import datetime
+from datetime import timedelta
+from PIL import ImageFont
+
+# Made-up tolls: a price that holds for a while, then moves, like the real ones do.
+def make_tolls(count):
+    tolls = []
+    price = 5.0
+
+    while len(tolls) < count:
+        price = min(max(price + random.choice((-0.5, -0.25, 0.25, 0.5, 1.0)), 0.5), 40.0)
+        tolls.extend([price] * random.randint(5, 30))
+
+    return tolls[:count]
+
+def get_fonts(regular, bold):
+    try:
+        return render.get_fonts(regular, bold)
+    except OSError:
+        fonts = {name:ImageFont.load_default(size=size) for name, size in
+            (('day', 22), ('label', 42), ('trip', 24), ('time', 24), ('toll', 140))}
+        render.font_heights(fonts)
+
+        return fonts
+
+def percentile(times, fraction):
+    times = sorted(times)
+
+    return times[min(int(len(times) * fraction), len(times) - 1)]
+
+def report(name, times):
+    print('{:<16} {:>10.2f} {:>10.2f}'.format(name, percentile(times, 0.5) * 1000, percentile(times, 0.99) * 1000))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark drawing the toll display.')
+    parser.add_argument('--frames', type=int, default=500, help='how many frames to draw')
+    parser.add_argument('--size', default='800x480', help='the size of the display')
+    parser.add_argument('--minutes', type=int, default=720, help='how many minutes of tolls to graph')
+    parser.add_argument('--regular-font', default='Ubuntu-R')
+    parser.add_argument('--bold-font', default='Ubuntu-B')
+    args = parser.parse_args()
+
+    display_size = tuple(int(pixels) for pixels in args.size.split('x'))
+    fonts = get_fonts(args.regular_font, args.bold_font)
+
+    trip = {'ramp_on':182, 'ramp_off':191,
+            'ramp_on_name':'Route 267',
+            'ramp_off_name':'Springfield Interchange',
+            'travel_time':12}
+
+    tolls = tollseries.TollSeries(args.minutes + 1)
+    incoming = make_tolls(args.minutes + args.frames)
+    tolls.extend(incoming[:args.minutes])
+
+    check_time = datetime.now().replace(second=0, microsecond=0)
+
+    # A new renderer draws the whole display.
+    first = []
+
+    for index in range(min(args.frames, 50)):
+        start = time.perf_counter()
+        render.Renderer(trip, display_size, fonts).render(check_time, trip, tolls.values(), tolls.max(),
+            tolls.min(), tolls.latest(), 'N')
+        first.append(time.perf_counter() - start)
+
+    # After that, a minute at a time.
+    renderer = render.Renderer(trip, display_size, fonts)
+    frames = []
+    encodes = []
+
+    for toll in incoming[args.minutes:]:
+        check_time += timedelta(minutes=1)
+        tolls.push(toll)
+
+        start = time.perf_counter()
+        display = renderer.render(check_time, trip, tolls.values(), tolls.max(), tolls.min(), tolls.latest(), 'N')
+        frames.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        display.save(io.BytesIO(), 'PNG')
+        encodes.append(time.perf_counter() - start)
+
+    print('{:<16} {:>10} {:>10}'.format('', 'p50 ms', 'p99 ms'))
+    report('first frame', first)
+    report('next frames', frames)
+    report('png encode', encodes)
+
+if __name__ == '__main__':
+    main()
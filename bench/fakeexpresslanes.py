@@ -0,0 +1,162 @@
+#!/usr/bin/python3
+
+# A stand-in for the express lanes web API's get-ramps-price call, for benchmarking the logger
+# without hitting expresslanes.com. Responses are scripted: how slow they are, how often they fail,
+# and how the prices change over time are all up to the caller.
+#
+# Run it on its own to point something at it in real time:
+#
+#   bench/fakeexpresslanes.py --port 8081 --latency 0.05 --pattern random
+#
+# or use Script and serve() from another script (like benchlogger.py) to drive it with simulated
+# minutes.
+
+import argparse, gzip, http.server, json, random, threading, time, urllib.parse
+
+# The prices a ramp pair steps through.
+PRICES = (1.25, 2.50, 3.75, 5.60, 8.95, 12.40, 17.05)
+
+class Script:
+    # latency and jitter are in seconds. error_rate is the fraction of responses that report an
+    # error in the JSON; http_error_rate the fraction that fail with a 503. pattern is how prices
+    # change: "flat" (never), "step" (every change_every minutes), or "random" (on average every
+    # change_every minutes).
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, http_error_rate=0.0,
+      pattern='step', change_every=15, seed=1):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.http_error_rate = http_error_rate
+        self.pattern = pattern
+        self.change_every = change_every
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+        # The minute we're serving prices for, in minutes since the epoch. Left as None, it's
+        # taken from the clock.
+        self.minute = None
+        self.requests = 0
+
+        # For the random pattern: ramp pair -> (minute last changed, price index).
+        self.walks = {}
+
+    def current_minute(self):
+        return self.minute if self.minute is not None else int(time.time() // 60)
+
+    def price_index(self, ramp_on, ramp_off, minute):
+        if self.pattern == 'flat':
+            return (ramp_on + ramp_off) % len(PRICES)
+        elif self.pattern == 'step':
+            # Stagger the trips so they don't all change at once.
+            return ((minute + ramp_on) // self.change_every) % len(PRICES)
+
+        with self.lock:
+            last_minute, index = self.walks.get((ramp_on, ramp_off), (minute, 0))
+
+            # Roll for a change for every minute since we were last asked.
+            for _ in range(max(minute - last_minute, 0)):
+                if self.random.random() < 1 / self.change_every:
+                    index = (index + self.random.choice((-1, 1))) % len(PRICES)
+
+            self.walks[(ramp_on, ramp_off)] = (max(minute, last_minute), index)
+
+        return index
+
+    # The HTTP status and JSON body for a request.
+    def respond(self, ramp_on, ramp_off):
+        with self.lock:
+            self.requests += 1
+            roll = self.random.random()
+            delay = self.latency + self.random.uniform(0, self.jitter)
+
+        if delay > 0:
+            time.sleep(delay)
+
+        if roll < self.http_error_rate:
+            return 503, None
+        elif roll < self.http_error_rate + self.error_rate:
+            return 200, {'error':'1', 'error_text':'scripted error'}
+
+        minute = self.current_minute()
+        price = PRICES[self.price_index(ramp_on, ramp_off, minute)]
+
+        # The reversible lanes run northbound in the morning and southbound in the afternoon.
+        northbound = ramp_on > ramp_off
+        open_95 = (minute % 1440 < 720) == northbound
+
+        return 200, {
+            'error':'0',
+            'error_text':'',
+            'price_495':price,
+            'price_95':round(price / 2, 2) if open_95 else '',
+            'time_495':10 + (minute + ramp_on) % 7,
+            'time_95':8 if open_95 else '',
+            'status_95':'open' if open_95 else 'closed',
+        }
+
+def handler_for(script):
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            url = urllib.parse.urlparse(self.path)
+            query = urllib.parse.parse_qs(url.query)
+
+            try:
+                ramp_on = int(query['ramp_entry'][0])
+                ramp_off = int(query['ramp_exit'][0])
+            except (KeyError, ValueError):
+                self.send_error(400)
+                return
+
+            status, toll = script.respond(ramp_on, ramp_off)
+            body = b'' if toll is None else json.dumps(toll).encode('utf-8')
+
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+
+            if 'gzip' in self.headers.get('Accept-Encoding', ''):
+                body = gzip.compress(body)
+                self.send_header('Content-Encoding', 'gzip')
+
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+# Serve a script from a background thread. Returns the server; server.server_address[1] is the port.
+def serve(script, port=0, address='127.0.0.1'):
+    server = http.server.ThreadingHTTPServer((address, port), handler_for(script))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server
+
+def script_args(parser):
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds to take over each response')
+    parser.add_argument('--jitter', type=float, default=0.0, help='up to this many more seconds, at random')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of responses reporting an error')
+    parser.add_argument('--http-error-rate', type=float, default=0.0, help='fraction of responses failing with a 503')
+    parser.add_argument('--pattern', choices=('flat', 'step', 'random'), default='step', help='how prices change')
+    parser.add_argument('--change-every', type=int, default=15, help='minutes between price changes')
+    parser.add_argument('--seed', type=int, default=1)
+
+def script_from(args):
+    return Script(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+        http_error_rate=args.http_error_rate, pattern=args.pattern, change_every=args.change_every,
+        seed=args.seed)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Stand-in for the express lanes get-ramps-price API.')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--address', default='127.0.0.1')
+    script_args(parser)
+    args = parser.parse_args()
+
+    server = http.server.ThreadingHTTPServer((args.address, args.port), handler_for(script_from(args)))
+    print('serving on {}:{}'.format(args.address, args.port))
+    server.serve_forever()
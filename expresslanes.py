@@ -0,0 +1,158 @@
+import gzip, http.client, json, logging, queue, random, socket, threading, time
+from urllib.parse import urlencode
+
+# Where the web API that gives us toll and travel time data lives.
+API_HOST = 'www.expresslanes.com'
+API_PATH = '/maps-api/get-ramps-price'
+
+# Something went wrong talking to the web API that's worth trying again.
+class UpstreamError(Exception):
+    pass
+
+# A client for the express lanes web API that keeps a bounded pool of persistent HTTPS connections,
+# so that we aren't paying for a new TLS handshake on every request. It's safe to share one client
+# between threads.
+class Client:
+    def __init__(self, host=API_HOST, port=None, secure=True, pool_size=4,
+      connect_timeout=5, read_timeout=10, retries=2, backoff=0.5):
+        self.host = host
+        self.port = port
+        self.secure = secure
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.backoff = backoff
+
+        # Idle connections, most recently used first, so the ones that go stale are the ones we don't need.
+        self.idle = queue.LifoQueue()
+        # Limits how many connections (idle or in use) we'll ever have open at once.
+        self.slots = threading.BoundedSemaphore(pool_size)
+
+    # Borrow a connection from the pool, opening a new one if there aren't any idle.
+    def _acquire(self):
+        # Wait no longer for a free slot than we would for a connection.
+        if not self.slots.acquire(timeout=self.connect_timeout):
+            raise UpstreamError('timed out waiting for a connection from the pool')
+
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        if self.secure:
+            conn = http.client.HTTPSConnection(self.host, self.port, timeout=self.connect_timeout)
+        else:
+            conn = http.client.HTTPConnection(self.host, self.port, timeout=self.connect_timeout)
+
+        try:
+            conn.connect()
+        except:
+            self.slots.release()
+            raise
+
+        # Now that we're connected, switch over to the read timeout.
+        conn.sock.settimeout(self.read_timeout)
+
+        return conn
+
+    # Give a connection back to the pool, or close it if it can't be reused.
+    def _release(self, conn, reuse):
+        if reuse:
+            self.idle.put(conn)
+        else:
+            conn.close()
+
+        self.slots.release()
+
+    # Make a single GET request, returning the (decompressed) body of the response.
+    def _get(self, path):
+        conn = self._acquire()
+        reuse = False
+
+        try:
+            conn.request('GET', path, headers={'Accept-Encoding':'gzip', 'Connection':'keep-alive'})
+            response = conn.getresponse()
+            body = response.read()
+
+            # We've read the whole response, so the connection can go back in the pool, unless
+            # the server told us it's going to close it.
+            reuse = not response.will_close
+
+            if response.status >= 500:
+                raise UpstreamError('HTTP error {} {}'.format(response.status, response.reason))
+            elif response.status != 200:
+                # Not something that's going to get better if we try again.
+                raise ValueError('HTTP error {} {}'.format(response.status, response.reason))
+
+            if response.getheader('Content-Encoding', '').lower() == 'gzip':
+                body = gzip.decompress(body)
+        finally:
+            self._release(conn, reuse)
+
+        return body
+
+    # GET a path from the web API, retrying connection problems, timeouts and server errors.
+    def get(self, path):
+        attempt = 0
+
+        while True:
+            try:
+                return self._get(path)
+            except (UpstreamError, http.client.HTTPException, socket.timeout, ConnectionError) as e:
+                if attempt >= self.retries:
+                    raise
+
+                # A connection the server closed while it sat idle in the pool isn't worth waiting
+                # on; just try again on a new one. Anything else, back off with full jitter so that
+                # all of our threads don't hit the API again at the same moment.
+                if not isinstance(e, (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError)):
+                    time.sleep(random.uniform(0, self.backoff * (2 ** attempt)))
+
+                attempt += 1
+                logging.info('retrying request for {} (attempt {}): {}'.format(path, attempt, str(e)))
+
+    # Get the toll and travel time information for an on/off ramp pair, as the parsed JSON response.
+    def get_ramps_price(self, ramp_on, ramp_off):
+        path = API_PATH + '?' + urlencode({'ramp_entry':ramp_on, 'ramp_exit':ramp_off})
+
+        return json.loads(self.get(path).decode('utf-8'))
+
+    # Close all of the idle connections in the pool.
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+# A token bucket, for keeping the rate of our requests to the web API under a limit. Tokens are
+# added at rate per second, up to burst of them saved up; each request takes one. It's safe to
+# share one bucket between threads.
+class RateLimiter:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    # Take a token, waiting for one if need be, but not past the deadline (in time.monotonic()
+    # terms). Returns False if there wasn't a token to be had by then.
+    def acquire(self, deadline=None):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+
+                # How long until there's a whole token.
+                wait = (1 - self.tokens) / self.rate
+
+            if deadline is not None and now + wait > deadline:
+                return False
+
+            time.sleep(wait)
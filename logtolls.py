@@ -1,38 +1,151 @@
 #!/usr/bin/python3
 
-import mysql.connector
-import json, logging, pause, signal, sys, urllib.request
+import expresslanes, mysql.connector, tollfeed, tollmetrics, tollspool
+import concurrent.futures, configparser, logging, pause, signal, sys, time
 from datetime import datetime
 from datetime import timedelta
+from decimal import Decimal, InvalidOperation
 
 # We want these as global variables, so we can reference them in the shutdown routine.
-conn = None
-curs = None
+spool = None
+writer = None
+
+# Set when we get a signal telling us to reload the trip catalog.
+reload_requested = False
+
+# How to connect to the database.
+DB_ARGS = {'user':'tollogger', 'database':'tolls'}
+
+# The optional config file. Any setting in its [logger] section overrides the default of the
+# same name (in upper case) below; e.g. "fetch_timeout = 15".
+CONFIG_FILE = '/var/run/tollogger/tollogger.conf'
+
+# How long, in seconds, to wait to connect to the web API, and then to wait on any one read from it.
+CONNECT_TIMEOUT = 5
+FETCH_TIMEOUT = 10
+
+# How many times to retry a request to the web API that failed in a way that might be temporary.
+FETCH_RETRIES = 2
+
+# Each trip (and the reversible lanes) is polled as often as its recent history says it needs
+# to be: every minute when its toll keeps changing, and as seldom as every POLL_CEILING minutes
+# when it doesn't. The history covers the last VOLATILITY_WINDOW minutes, and we aim for about
+# POLLS_PER_CHANGE polls between changes.
+POLL_FLOOR = 1
+POLL_CEILING = 10
+VOLATILITY_WINDOW = 60
+POLLS_PER_CHANGE = 3
+
+# How long, in seconds after the start of a tick, we'll wait for the web API to answer all of
+# that tick's requests. Whatever hasn't come back by then is logged as an error for the tick.
+FETCH_DEADLINE = 50
+
+# A tick's requests are spread evenly over this many seconds from the start of the minute, rather
+# than all going out at once. This has to leave time for the last of them to finish before the
+# deadline.
+SPREAD_SECONDS = 30
+
+# The most requests per second we'll make to the web API on average, and the most we'll make
+# in a burst.
+REQUEST_RATE = 2.0
+REQUEST_BURST = 4
+
+# The most requests we'll have in flight to the web API at once. This is also the most
+# connections we'll keep open to it.
+FETCH_WORKERS = 16
+
+# The trips we track the tolls and time for, and the on/off ramps to use when checking the status
+# of the reversible lanes northbound and southbound, come from the trip table. These are what we
+# use until we've been able to read it.
+DEFAULT_TRIPS = [{'ramp_on':182, 'ramp_off':191}, {'ramp_on':191, 'ramp_off':182}]
+REVERSIBLE_RAMPS = {'north':{'ramp_on':218, 'ramp_off':183}, 'south':{'ramp_on':183, 'ramp_off':218}}
+
+# The longest gap, in minutes, between the end of a series and a new entry with the same values
+# that we'll still treat as a continuation of the series. This is what lets us pick up where we
+# left off after a restart or a failed lookup, rather than starting a new series.
+RESUME_TOLERANCE = 5
+
+# Where we keep the batches for each tick until they've been written to the database.
+SPOOL_FILE = '/var/run/tollogger/tollogger.spool'
+
+# How long, in seconds, to wait before first trying the database again after losing it. We back
+# off from there, up to the maximum.
+DB_RETRY_DELAY = 5
+DB_MAX_RETRY_DELAY = 60
+
+# The local port to serve metrics on at /metrics (0 for none), and the file to write them to
+# every tick (blank for none). Sending us SIGUSR1 starts profiling the tick loop; sending it
+# again stops, and writes the stats to the profile file.
+METRICS_PORT = 0
+METRICS_FILE = '/var/run/tollogger/tollogger.prom'
+PROFILE_FILE = '/var/run/tollogger/tollogger.prof'
+
+# The Unix socket to publish each tick's tolls, travel times and reversible lanes status to, for the
+# web service to pass on to its clients (blank for none).
+FEED_SOCKET = '/var/run/webtoll/tollfeed.sock'
+
+# The settings that can be overridden from the config file.
+SETTINGS = ('CONNECT_TIMEOUT', 'FETCH_TIMEOUT', 'FETCH_RETRIES', 'POLL_FLOOR', 'POLL_CEILING',
+    'VOLATILITY_WINDOW', 'POLLS_PER_CHANGE', 'FETCH_DEADLINE', 'SPREAD_SECONDS',
+    'REQUEST_RATE', 'REQUEST_BURST', 'FETCH_WORKERS', 'RESUME_TOLERANCE', 'SPOOL_FILE', 'DB_RETRY_DELAY',
+    'DB_MAX_RETRY_DELAY', 'METRICS_PORT', 'METRICS_FILE', 'PROFILE_FILE', 'FEED_SOCKET')
+
+FETCH_SECONDS = tollmetrics.histogram('tolls_fetch_seconds', 'Time taken to fetch the toll for a ramp pair from the web API.')
+UPSTREAM_ERRORS = tollmetrics.counter('tolls_upstream_errors_total', 'Failed toll lookups, by ramp pair and reason.')
+TICK_SECONDS = tollmetrics.histogram('tolls_tick_seconds', 'Time from the start of a tick until its batch was spooled.',
+    buckets=(1, 5, 10, 20, 30, 40, 50, 55, 60, 90, 120))
+TICKS = tollmetrics.counter('tolls_ticks_total', 'Ticks run.')
+TICKS_OVERRUN = tollmetrics.counter('tolls_ticks_overrun_total', 'Ticks that ran past the start of the next minute.')
+TICKS_SKIPPED = tollmetrics.counter('tolls_ticks_skipped_total', 'Minutes that went by without a tick.')
+TRIPS_POLLED = tollmetrics.counter('tolls_trips_polled_total', 'Trips polled, over all ticks.')
+FEED_UPDATES = tollmetrics.counter('tolls_feed_updates_total', 'Tick updates published to the feed, by whether they were delivered.')
+
+# Override the default settings with any found in the config file.
+def load_config (path):
+    config = configparser.ConfigParser()
+
+    # The config file is optional.
+    if not config.read(path) or not config.has_section('logger'):
+        return
+
+    for name, value in config.items('logger'):
+        setting = name.upper()
+
+        if setting not in SETTINGS:
+            logging.warning('ignoring unknown setting {} in {}'.format(name, path))
+            continue
+
+        # Convert the value to the same type as the default.
+        globals()[setting] = type(globals()[setting])(value)
+        logging.info('{} set to {}'.format(name, value))
 
 # We got a signal telling us to quit.
 def handler (signum, frame):
     logging.info('received signal {}'.format(str(signum)))
     shutdown()
 
+# We got a signal telling us to reload the trip catalog. We'll do it at the start of the next tick.
+def reload_handler (signum, frame):
+    global reload_requested
+
+    logging.info('received signal {}, will reload trips'.format(str(signum)))
+    reload_requested = True
+
 # We got a signal telling us to quit. Do a little housekeeping first.
 def shutdown ():
     logging.info('shutting down')
 
-    # If we've opened a cursor, try to close it.
-    if curs != None:
-        try:
-            curs.close()
-        except:
-            # The cursor apparently wasn't actually open. No problem.
-            pass
+    # If we've connected to the database, try to close our connection. Anything that hasn't
+    # been written yet is safe in the spool, and will be written when we start again.
+    if writer != None:
+        writer.disconnect()
 
-    # If we've connected to the database, try to close our connection.
-    if conn != None:
+    # If we've opened the spool, close it.
+    if spool != None:
         try:
-            conn.close()
+            spool.close()
         except:
-            # Apparently we don't actually have a connection to the database.
-            # No problem.
+            # The spool apparently wasn't actually open. No problem.
             pass
 
     logging.info('shutdown complete')
@@ -41,32 +154,22 @@ def shutdown ():
     # That's it. Go ahead and exit.
     sys.exit()
 
-def log_error (toll, curs):
-    insertSQL = '''
-        INSERT
-          INTO error_log (error_log_date, ramp_on, ramp_off, error_text)
-          VALUES (%(error_log_date)s, %(ramp_on)s, %(ramp_off)s, %(error_text)s)
-    '''
-
+# Add an entry in the error log for a failed toll lookup to a tick's batch.
+def log_error (toll, batch):
     toll['error_log_date'] = datetime.now()
     toll['error_text'] = 'error %d - %s' % (toll['error'], toll['error_text'])
 
-    try:
-        curs.execute(insertSQL, toll)
-    except Exception as e:
-        logging.critical('insert into error_log failed: {}'.format(str(e)))
-        shutdown()
+    tollspool.add_row(batch, 'error_log', toll)
 
 # Get toll and time information for an on/off ramp pair. This also gets us status information
 # for the reversible lanes when the trip defined by the ramps traverses those lanes.
-def fetch_toll (trip):
-    # The URL for the web API that gives us the data we want.
-    url = 'https://www.expresslanes.com/maps-api/get-ramps-price?ramp_entry={ramp_on}&ramp_exit={ramp_off}'
+def fetch_toll (client, trip):
+    ramps = '{}/{}'.format(trip['ramp_on'], trip['ramp_off'])
 
     try:
         # Call the web API, and parse the JSON it returns.
-        with urllib.request.urlopen(url.format(ramp_on=trip['ramp_on'], ramp_off=trip['ramp_off'])) as response:
-            toll = json.loads(response.read().decode('utf-8'))
+        with FETCH_SECONDS.time(ramps=ramps):
+            toll = client.get_ramps_price(trip['ramp_on'], trip['ramp_off'])
 
         # Make sure we have an error entry, and that it's an int.
         # An error of 0 just means no error.
@@ -98,20 +201,73 @@ def fetch_toll (trip):
         # about the trip and the exception so that the caller can log it.
         toll = {'error':-1, 'error_text':str(e), 'ramp_on':trip['ramp_on'], 'ramp_off':trip['ramp_off']}
         logging.warning('got exception trying to retrieve toll data: {}'.format(str(e)))
+        UPSTREAM_ERRORS.inc(ramps=ramps, reason='exception')
+    else:
+        if toll['error'] != 0:
+            UPSTREAM_ERRORS.inc(ramps=ramps, reason='api')
 
     return toll
 
-# Figure out the status of the reversible lanes.
-def fetch_reversible ():
-    # Unless we hear otherwise, consider the reversible lanes closed.
-    reversible = {'status_code':'C', 'error':0, 'error_text':None}
+# Fetch everything we need from the web API for one tick: the toll for each trip that's due to be
+# polled, plus the northbound and southbound reversible lane probes if they're due. The requests
+# are spread evenly over the first SPREAD_SECONDS of the tick, within the rate limit, and anything
+# that hasn't come back by the deadline is treated as an error for this tick. Returns the toll for
+# each ramp pair, keyed by (ramp_on, ramp_off).
+def fetch_tick (executor, client, limiter, ramp_pairs, start, deadline):
+    # Each ramp pair only needs to be requested once, however many times it shows up.
+    keys = []
+    for ramps in ramp_pairs:
+        key = (ramps['ramp_on'], ramps['ramp_off'])
+        if key not in keys: keys.append(key)
+
+    # The rate limiter works in time.monotonic() terms.
+    monotonic_deadline = time.monotonic() + (deadline - datetime.now()).total_seconds()
+
+    futures = {}
+
+    for index, key in enumerate(keys):
+        # Wait for this request's slot.
+        slot = start + timedelta(seconds=SPREAD_SECONDS * index / len(keys))
+        delay = (slot - datetime.now()).total_seconds()
+        if delay > 0: time.sleep(delay)
+
+        if not limiter.acquire(monotonic_deadline):
+            # We're over the rate limit, and won't be under it again before the deadline.
+            break
+
+        futures[key] = executor.submit(fetch_toll, client, {'ramp_on':key[0], 'ramp_off':key[1]})
 
-    # The on/off ramps to use when checking the status northbound and southbound.
-    ramps = {'north':{'ramp_on':218, 'ramp_off':183}, 'south':{'ramp_on':183, 'ramp_off':218}}
+    # Wait for the responses, but no later than the deadline.
+    timeout = max((deadline - datetime.now()).total_seconds(), 0)
+    concurrent.futures.wait(futures.values(), timeout=timeout)
 
-    # Get the data for the northbound and southbound trips.
-    north = fetch_toll(ramps['north'])
-    south = fetch_toll(ramps['south'])
+    tolls = {}
+
+    for key in keys:
+        future = futures.get(key)
+
+        if future is not None and future.done():
+            # fetch_toll catches its own exceptions, so this won't raise.
+            tolls[key] = future.result()
+        else:
+            # This request missed the deadline, or never went out. Don't bother starting it if
+            # it's still queued.
+            if future is not None: future.cancel()
+            tolls[key] = {'error':-1, 'error_text':'no response before the tick deadline',
+                'ramp_on':key[0], 'ramp_off':key[1]}
+            logging.warning('toll request for ramps {}/{} missed the tick deadline'.format(key[0], key[1]))
+            UPSTREAM_ERRORS.inc(ramps='{}/{}'.format(key[0], key[1]), reason='deadline')
+
+    return tolls
+
+# The toll fetched for a trip in a tick. Each trip gets its own copy, since logging it changes it.
+def trip_toll (tolls, trip):
+    return dict(tolls[(trip['ramp_on'], trip['ramp_off'])])
+
+# Figure out the status of the reversible lanes from the northbound and southbound probes.
+def fetch_reversible (north, south):
+    # Unless we hear otherwise, consider the reversible lanes closed.
+    reversible = {'status_code':'C', 'error':0, 'error_text':None}
 
     if north['error'] != 0:
         # We got an error trying to fetch the northbound status.
@@ -138,198 +294,400 @@ def fetch_reversible ():
 
     return reversible
 
-# Log the toll record for a trip.
-def log_toll(toll, curs):
-    insertSQL = '''
-        INSERT
-          INTO toll_log (toll_start_date, toll_end_date, ramp_on, ramp_off, direction,
-              price_495, price_95)
-          VALUES (%(toll_start_date)s, %(toll_end_date)s, %(ramp_on)s, %(ramp_off)s, %(direction)s,
-            %(price_495)s, %(price_95)s)
-    '''
+# Add the toll record for a trip to a tick's batch. It either extends the trip's current series
+# of toll prices, or starts a new one.
+def log_toll(toll, new, batch):
+    tollspool.add_row(batch, 'toll_log', toll, new)
 
-    updateSQL = '''
-        UPDATE toll_log
-          SET toll_end_date = %(toll_end_date)s
-          WHERE toll_log_id = %(toll_log_id)s
-    '''
+def log_time(toll, new, batch):
+    tollspool.add_row(batch, 'time_log', toll, new)
 
-    if 'toll_log_id' in toll:
-        try:
-            # We're updating an existing toll record, to extend the end data of the series.
-            curs.execute(updateSQL, toll)
-        except Exception as e:
-            logging.critical('update of toll_log failed: {}'.format(str(e)))
-            shutdown()
+def log_reversible(reversible, new, batch):
+    tollspool.add_row(batch, 'reversible_log', reversible, new)
 
-        toll_log_id = toll['toll_log_id']
-    else:
-        try:
-            # We're creating an new toll record to create a new series of entries for a particular toll amount.
-            curs.execute(insertSQL, toll)
-            curs.execute('SELECT LAST_INSERT_ID()')
-            toll_log_id = curs.fetchone()[0]
-        except Exception as e:
-            logging.critical('insert into toll_log failed: {}'.format(str(e)))
-            shutdown()
-
-    # Return the id of the new/updated toll record.
-    return toll_log_id
-
-def log_time(toll, curs):
-    insertSQL = '''
-        INSERT
-          INTO time_log (time_start_date, time_end_date, ramp_on, ramp_off, direction,
-              time_495, time_95)
-          VALUES (%(time_start_date)s, %(time_end_date)s, %(ramp_on)s, %(ramp_off)s, %(direction)s,
-            %(time_495)s, %(time_95)s)
-    '''
+# Compare a value from the web API with one from the database (or the web API). Prices and times
+# come back from the web API as floats or strings, and from the database as Decimals or ints, so
+# compare them as Decimals. Anything that isn't a number (like a status code) is compared as is.
+def same_value(a, b):
+    if a is None or b is None:
+        return a is None and b is None
 
-    updateSQL = '''
-        UPDATE time_log
-          SET time_end_date = %(time_end_date)s
-          WHERE time_log_id = %(time_log_id)s
-    '''
+    try:
+        return Decimal(str(a)) == Decimal(str(b))
+    except InvalidOperation:
+        return a == b
 
-    if 'time_log_id' in toll:
-        try:
-            curs.execute(updateSQL, toll)
-        except Exception as e:
-            logging.critical('update of time_log failed: {}'.format(str(e)))
-            shutdown()
+# Are the values in the columns all the same in the two entries?
+def same_values(last, current, columns):
+    return all(same_value(last.get(column), current[column]) for column in columns)
 
-        time_log_id = toll['time_log_id']
-    else:
-        try:
-            curs.execute(insertSQL, toll)
-            curs.execute('SELECT LAST_INSERT_ID()')
-            time_log_id = curs.fetchone()[0]
-        except Exception as e:
-            logging.critical('insert into time_log failed: {}'.format(str(e)))
-            shutdown()
+# Does the current entry continue the series described by the last entry? It does if there is a
+# series, it ended recently enough, and the values in the columns are all the same.
+def continues_series(last, current, end_column, columns, log_date):
+    if last is None or end_column not in last:
+        return False
 
-    return time_log_id
+    if log_date - last[end_column] > timedelta(minutes=RESUME_TOLERANCE):
+        return False
 
-def log_reversible(reversible, curs):
-    insertSQL = '''
-        INSERT
-          INTO reversible_log (reversible_start_date, reversible_end_date, status_code)
-          VALUES (%(reversible_start_date)s, %(reversible_end_date)s, %(status_code)s)
-    '''
+    return same_values(last, current, columns)
 
-    updateSQL = '''
-        UPDATE reversible_log
-          SET reversible_end_date = %(reversible_end_date)s,
-            status_code = %(status_code)s
-          WHERE reversible_log_id = %(reversible_log_id)s
-    '''
+# Does the current entry have different values from the last one we logged? A series that's only
+# new because of a gap (a restart, or failed lookups) isn't a change.
+def values_changed(last, current, end_column, columns):
+    return last is not None and end_column in last and not same_values(last, current, columns)
 
-    if 'reversible_log_id' in reversible:
-        try:
-            curs.execute(updateSQL, reversible)
-        except Exception as e:
-            logging.critical('update of reversible_log failed: {}'.format(str(e)))
-            shutdown()
+# Work out when to poll something (a trip, or the reversible lanes) next, from how often its value
+# has changed lately. If it just changed, poll again as soon as we can; changes come in bunches.
+def schedule_poll(state, changed, log_date):
+    changes = state.setdefault('changes', [])
+
+    if changed:
+        changes.append(log_date)
 
-        reversible_log_id = reversible['reversible_log_id']
+    # Forget changes that have dropped out of the window.
+    window_start = log_date - timedelta(minutes=VOLATILITY_WINDOW)
+    changes[:] = [change for change in changes if change > window_start]
+
+    if changed:
+        interval = POLL_FLOOR
     else:
-        try:
-            curs.execute(insertSQL, reversible)
-            curs.execute('SELECT LAST_INSERT_ID()')
-            reversible_log_id = curs.fetchone()[0]
-        except Exception as e:
-            logging.critical('insert into reversible_log failed: {}'.format(str(e)))
-            shutdown()
+        interval = VOLATILITY_WINDOW // (POLLS_PER_CHANGE * (len(changes) + 1))
+
+    state['interval'] = min(max(interval, POLL_FLOOR), POLL_CEILING)
+    state['next_poll'] = log_date + timedelta(minutes=state['interval'])
+
+# Is something (a trip, or the reversible lanes) due to be polled this tick?
+def poll_due(state, log_date):
+    return state.get('next_poll', log_date) <= log_date
 
-    return reversible_log_id
+# Where a series ends, as of the poll we've just made: what we've just seen holds until the next poll, so
+# the series runs up to the minute before it, and everyone reading the series sees those minutes
+# as known rather than missing. A series we're continuing never ends any earlier than it did.
+def series_end(state, last, end_column, new):
+    end = state['next_poll'] - timedelta(minutes=1)
 
-def log_trip_toll(trip, log_date, curs):
-    current_toll = fetch_toll(trip)
+    if not new:
+        end = max(end, last[end_column])
 
+    return end
+
+# Log the toll for a trip, and work out when to poll it next.
+def log_trip_toll(trip, current_toll, log_date, batch):
     if current_toll['error'] == 0:
         # No error getting the toll data.
+        last = trip.get('last')
 
         # Check the tolls first.
 
-        # Is this the first entry in a series of toll prices?
-        if 'last' not in trip or trip['last']['price_495'] != current_toll['price_495'] \
-          or trip['last']['price_95'] != current_toll['price_95']:
+        # Is this the continuation of the current series of toll prices? If we haven't polled
+        # for a while, the series runs up to the last time we saw the old toll, and the new
+        # series starts now.
+        new_toll = not continues_series(last, current_toll, 'toll_end_date', ('price_495', 'price_95'), log_date)
+
+        if not new_toll:
+            current_toll['toll_start_date'] = last['toll_start_date']
+            # We'll only have the id if the series was picked up from the database.
+            current_toll['toll_log_id'] = last.get('toll_log_id')
+        else:
             # This is the first entry in a series of toll prices.
             current_toll['toll_start_date'] = log_date
-        else:
-            # This is the continuation of the current series of toll prices.
-            current_toll['toll_start_date'] = trip['last']['toll_start_date']
-            current_toll['toll_log_id'] = trip['last']['toll_log_id']
 
         # Now check the travel times.
 
-        # Is this the first entry in a series of travel times?
-        if 'last' not in trip or trip['last']['time_495'] != current_toll['time_495'] \
-          or trip['last']['time_95'] != current_toll['time_95']:
+        # Is this the continuation of the current series of travel times?
+        new_time = not continues_series(last, current_toll, 'time_end_date', ('time_495', 'time_95'), log_date)
+
+        if not new_time:
+            current_toll['time_start_date'] = last['time_start_date']
+            current_toll['time_log_id'] = last.get('time_log_id')
+        else:
             # This is the first entry in a series of travel times.
             current_toll['time_start_date'] = log_date
-        else:
-            # This is the continuation of the current series of travel times.
-            current_toll['time_start_date'] = trip['last']['time_start_date']
-            current_toll['time_log_id'] = trip['last']['time_log_id']
 
-        # Until the next interval, the log time of this interval will be the end date of both series.
-        current_toll['toll_end_date'] = log_date
-        current_toll['time_end_date'] = log_date
+        # Poll sooner if the toll changed, and later if it's been holding steady.
+        schedule_poll(trip, values_changed(last, current_toll, 'toll_end_date', ('price_495', 'price_95')), log_date)
+
+        # Until the next poll, both series end where this one says they do.
+        current_toll['toll_end_date'] = series_end(trip, last, 'toll_end_date', new_toll)
+        current_toll['time_end_date'] = series_end(trip, last, 'time_end_date', new_time)
 
         # Log this toll entry.
-        current_toll['toll_log_id'] = log_toll(current_toll, curs)
+        log_toll(current_toll, new_toll, batch)
         # And this time entry.
-        current_toll['time_log_id'] = log_time(current_toll, curs)
+        log_time(current_toll, new_time, batch)
 
         # Replace the trip's last toll entry.
         trip['last'] = current_toll
     else:
         logging.warning('could not get toll info for trip')
-        # We couldn't get the toll data for whatever reason. Log the error.
-        log_error(current_toll, curs)
-
-        # Remove the data for the last toll from the trip. This will force a
-        # new series of both price and travel time values.
-        if 'last' in trip: del trip['last']
+        # We couldn't get the toll data for whatever reason. Log the error. We hang on to the
+        # trip's last toll entry, so that if the next lookup works, and the values haven't
+        # changed, we carry on with the same series.
+        log_error(current_toll, batch)
 
-def log_reversible_status(reversible, log_date, curs):
-    current_reversible = fetch_reversible()
+        # Try again next tick.
+        trip['next_poll'] = log_date + timedelta(minutes=POLL_FLOOR)
 
+# Log the status of the reversible lanes, and work out when to poll them next.
+def log_reversible_status(reversible, current_reversible, log_date, batch):
     if current_reversible['error'] == 0:
         # No error getting the toll data.
+        last = reversible.get('last')
 
-        # Is this the first entry in a series of reversible lane statuses?
-        if 'last' not in reversible or reversible['last']['status_code'] != current_reversible['status_code']:
+        # Is this the continuation of the current series of reversible lane statuses?
+        new_reversible = not continues_series(last, current_reversible, 'reversible_end_date', ('status_code',),
+            log_date)
+
+        if not new_reversible:
+            current_reversible['reversible_start_date'] = last['reversible_start_date']
+            current_reversible['reversible_log_id'] = last.get('reversible_log_id')
+        else:
             # This is the first entry in a series.
             current_reversible['reversible_start_date'] = log_date
-        else:
-            # This is the continuation of the current series of toll prices.
-            current_reversible['reversible_start_date'] = reversible['last']['reversible_start_date']
-            current_reversible['reversible_log_id'] = reversible['last']['reversible_log_id']
 
-        # Until the next interval, the log time of this interval will be the end date of the series.
-        current_reversible['reversible_end_date'] = log_date
+        schedule_poll(reversible, values_changed(last, current_reversible, 'reversible_end_date', ('status_code',)),
+            log_date)
+
+        # Until the next poll, the series ends where this one says it does.
+        current_reversible['reversible_end_date'] = series_end(reversible, last, 'reversible_end_date',
+            new_reversible)
 
         # Log this reversible lanes status entry.
-        current_reversible['reversible_log_id'] = log_reversible(current_reversible, curs)
+        log_reversible(current_reversible, new_reversible, batch)
 
         reversible['last'] = current_reversible
     else:
         logging.warning('could not get status of reversible lanes')
         # We couldn't get the data for the reversible lanes, for whatever reason. Log the error.
-        log_error(current_reversible, curs)
-        # Remove the data for the last reversible lane status. This will force a new series.
-        if 'last' in reversible: del reversible['last']
+        # As with the trips, we hang on to the last status.
+        log_error(current_reversible, batch)
+
+        reversible['next_poll'] = log_date + timedelta(minutes=POLL_FLOOR)
+
+# Pick up the most recent series for each trip, and for the reversible lanes, from the database,
+# so that after a restart we carry on with them instead of starting new ones. Whether a series
+# is recent enough to carry on with is decided when the next entry comes in. A series runs up to
+# the next poll we had planned, so that's when we poll next (right away, if it's passed).
+def resume_series(trips, reversible, conn, curs):
+    tollSQL = '''
+        SELECT toll_log_id, toll_start_date, toll_end_date, price_495, price_95
+          FROM toll_log
+          WHERE ramp_on = %(ramp_on)s
+            AND ramp_off = %(ramp_off)s
+          ORDER BY toll_end_date DESC
+          LIMIT 1
+    '''
+
+    timeSQL = '''
+        SELECT time_log_id, time_start_date, time_end_date, time_495, time_95
+          FROM time_log
+          WHERE ramp_on = %(ramp_on)s
+            AND ramp_off = %(ramp_off)s
+          ORDER BY time_end_date DESC
+          LIMIT 1
+    '''
+
+    reversibleSQL = '''
+        SELECT reversible_log_id, reversible_start_date, reversible_end_date, status_code
+          FROM reversible_log
+          ORDER BY reversible_end_date DESC
+          LIMIT 1
+    '''
+
+    # Run a query, and return the row it found as a dictionary (or an empty one if it didn't).
+    def last_row(sql, args=None):
+        curs.execute(sql, args)
+        rows = curs.fetchall()
+
+        return dict(zip(curs.column_names, rows[0])) if rows else {}
+
+    try:
+        for trip in trips:
+            last = {}
+            last.update(last_row(tollSQL, trip))
+            last.update(last_row(timeSQL, trip))
+
+            if last:
+                trip['last'] = last
+                logging.info('resuming series for trip {}/{} from {}'.format(trip['ramp_on'], trip['ramp_off'], str(last)))
+
+                if 'toll_end_date' in last:
+                    trip['next_poll'] = last['toll_end_date'] + timedelta(minutes=1)
+
+        last = last_row(reversibleSQL)
+
+        if last:
+            reversible['last'] = last
+            reversible['next_poll'] = last['reversible_end_date'] + timedelta(minutes=1)
+            logging.info('resuming reversible lanes series from {}'.format(str(last)))
+
+        # We only read; end the transaction so the first tick can start its own.
+        conn.rollback()
+    except Exception as e:
+        # Not fatal. We'll just start new series.
+        logging.warning('could not resume series from the database: {}'.format(str(e)))
+
+        try:
+            conn.rollback()
+        except:
+            pass
+
+# Read the trips we track, and the reversible lane probes, from the trip table.
+def load_catalog ():
+    catalogSQL = '''
+        SELECT ramp_on.ramp_num ramp_on, ramp_off.ramp_num ramp_off,
+            ramp_on.ramp_name ramp_on_name, ramp_off.ramp_name ramp_off_name,
+            trip.log_toll, trip.reversible_probe
+          FROM trip
+            JOIN ramp ramp_on ON ramp_on.ramp_id = trip.ramp_on_id
+            JOIN ramp ramp_off ON ramp_off.ramp_id = trip.ramp_off_id
+          ORDER BY trip.trip_id
+    '''
+
+    conn = mysql.connector.connect(**DB_ARGS)
+
+    try:
+        curs = conn.cursor(dictionary=True)
+        curs.execute(catalogSQL)
+        rows = curs.fetchall()
+        curs.close()
+    finally:
+        conn.close()
+
+    trips = []
+    reversible_ramps = dict(REVERSIBLE_RAMPS)
+
+    for row in rows:
+        trip = {'ramp_on':row['ramp_on'], 'ramp_off':row['ramp_off'],
+            'ramp_on_name':row['ramp_on_name'], 'ramp_off_name':row['ramp_off_name']}
+
+        if row['log_toll'] == 'Y':
+            trips.append(trip)
+
+        if row['reversible_probe'] == 'N':
+            reversible_ramps['north'] = {'ramp_on':row['ramp_on'], 'ramp_off':row['ramp_off']}
+        elif row['reversible_probe'] == 'S':
+            reversible_ramps['south'] = {'ramp_on':row['ramp_on'], 'ramp_off':row['ramp_off']}
+
+    if len(trips) == 0:
+        raise ValueError('no trips to log in the trip table')
+
+    return trips, reversible_ramps
+
+# Load the trip catalog, carrying over what we know about the trips we were already tracking. If
+# we can't load it, we carry on with the trips we have.
+def reload_catalog (trips, reversible_ramps):
+    try:
+        new_trips, new_reversible_ramps = load_catalog()
+    except Exception as e:
+        logging.error('could not load trips, keeping the {} we have: {}'.format(len(trips), str(e)))
+        return trips, reversible_ramps
+
+    old_trips = {(trip['ramp_on'], trip['ramp_off']):trip for trip in trips}
+
+    for trip in new_trips:
+        old_trip = old_trips.get((trip['ramp_on'], trip['ramp_off']))
+
+        if old_trip is not None:
+            for state in ('last', 'changes', 'interval', 'next_poll'):
+                if state in old_trip: trip[state] = old_trip[state]
+
+    logging.info('tracking {} trips'.format(len(new_trips)))
+
+    return new_trips, new_reversible_ramps
+
+# Run one tick: poll whatever's due, log the results, and spool them for the writer. The tick's
+# requests are spread out from start, which is the log date unless we're running simulated minutes
+# (as the benchmark does).
+def run_tick (executor, client, limiter, trips, reversible_ramps, reversible, writer, log_date, start=None):
+    # Which of the trips, and whether the reversible lanes, are due to be polled this tick.
+    due_trips = [trip for trip in trips if poll_due(trip, log_date)]
+    reversible_due = poll_due(reversible, log_date)
+    TRIPS_POLLED.inc(len(due_trips))
+
+    # Fetch the toll/time info for each of the trips that are due, along with the status of
+    # the reversible lanes, spread over the first part of the minute. The reversible lane
+    # probes go first, and together, so they see the lanes at the same moment.
+    ramp_pairs = due_trips
+    if reversible_due: ramp_pairs = [reversible_ramps['north'], reversible_ramps['south']] + ramp_pairs
+
+    if start is None: start = log_date
+    deadline = start + timedelta(seconds=FETCH_DEADLINE)
+    tolls = fetch_tick(executor, client, limiter, ramp_pairs, start, deadline)
+
+    # Gather up the toll/time info for each of the trips, and the status of the
+    # reversible lanes, and then hand it all off to be written to the database at once.
+    batch = tollspool.new_batch()
+
+    for trip in due_trips:
+        log_trip_toll(trip, trip_toll(tolls, trip), log_date, batch)
+
+    if reversible_due:
+        current_reversible = fetch_reversible(trip_toll(tolls, reversible_ramps['north']),
+            trip_toll(tolls, reversible_ramps['south']))
+        log_reversible_status(reversible, current_reversible, log_date, batch)
+
+    try:
+        # Don't bother the writer on a tick where nothing was due.
+        if any(batch.values()): writer.write(batch)
+    except Exception as e:
+        logging.critical('could not spool tick: {}'.format(str(e)))
+        shutdown()
+
+# A price (as a float) or travel time (as an int) for the feed. They come from the web API as
+# floats or strings, and from the database, for a series picked up at startup, as Decimals or ints.
+def feed_value(value, kind):
+    if value is None or value == '':
+        return None
+
+    return kind(Decimal(str(value)))
+
+# What we know about every trip, and the reversible lanes, as of this tick, for the feed. Trips that
+# weren't polled this tick carry their values from the last time they were; "as_of" is the latest
+# minute they hold for, which is this one unless we've missed polls since.
+def tick_update(trips, reversible, log_date):
+    update = {'log_date':log_date.strftime('%Y%m%d%H%M'), 'trips':[], 'reversible':None}
+
+    for trip in trips:
+        last = trip.get('last')
+        entry = {'ramp_on':trip['ramp_on'], 'ramp_off':trip['ramp_off']}
+
+        # A series picked up from the database at startup may be missing its toll half.
+        if last is not None and 'toll_end_date' in last:
+            for column, kind in (('price_495', float), ('price_95', float), ('time_495', int), ('time_95', int)):
+                entry[column] = feed_value(last.get(column), kind)
+
+            entry['as_of'] = min(last['toll_end_date'], log_date).strftime('%Y%m%d%H%M')
+
+        update['trips'].append(entry)
+
+    last = reversible.get('last')
+
+    if last is not None:
+        update['reversible'] = {'status_code':last['status_code'],
+            'as_of':min(last['reversible_end_date'], log_date).strftime('%Y%m%d%H%M')}
+
+    return update
 
 # The main body of the program.
 def main():
+    global spool, writer, reload_requested
+
     logging.basicConfig(format='%(asctime)s:%(levelname)s:%(message)s', \
 	filename='/var/run/tollogger/tollogger.log', level=logging.INFO)
     logging.info('logger started')
 
+    load_config(CONFIG_FILE)
+
+    # Reload the trip catalog on a hangup.
+    signal.signal(signal.SIGHUP, reload_handler)
+
+    # Turn profiling on and off.
+    profiler = tollmetrics.Profiler(PROFILE_FILE)
+    signal.signal(signal.SIGUSR1, profiler.toggle)
+
     # Catch these signals, so we can shut down cleanly.
-    signal.signal(signal.SIGHUP, handler)
     signal.signal(signal.SIGINT, handler)
     signal.signal(signal.SIGQUIT, handler)
     signal.signal(signal.SIGABRT, handler)
@@ -338,34 +696,88 @@ def main():
     signal.signal(signal.SIGTSTP, handler)
 
     try:
-        # Get a connection to the database, and a cursor.
-        conn = mysql.connector.connect(user='tollogger', database='tolls', autocommit=True)
-        curs = conn.cursor()
-        logging.info('connected to database')
+        # Open the spool, picking up anything that didn't get written to the database last time.
+        spool = tollspool.Spool(SPOOL_FILE)
     except Exception as e:
-        logging.critical('database connection failed: {}'.format(str(e)))
+        logging.critical('could not open spool {}: {}'.format(SPOOL_FILE, str(e)))
         shutdown()
 
-    # The trips we're going to track the tolls and time for.
-    trips = [{'ramp_on':182, 'ramp_off':191}, {'ramp_on':191, 'ramp_off':182}]
+    writer = tollspool.Writer(spool, DB_ARGS, retry_delay=DB_RETRY_DELAY, max_retry_delay=DB_MAX_RETRY_DELAY)
+
+    # The trips we're going to track the tolls and time for, and the ramps we use to check the
+    # status of the reversible lanes.
+    trips, reversible_ramps = reload_catalog([dict(trip) for trip in DEFAULT_TRIPS], REVERSIBLE_RAMPS)
 
     # Start with an empty dictionary for the reversible variable. This will
     # be used later to keep track of the last status received.
     reversible = {}
 
+    try:
+        # Write out whatever's left in the spool, so that we can carry on with whatever series
+        # were still open when we last stopped.
+        writer.drain()
+        resume_series(trips, reversible, writer.conn, writer.curs)
+    except Exception as e:
+        # We'll keep spooling until the database is back.
+        logging.error('database not available at startup: {}'.format(str(e)))
+        writer.disconnect()
+
+    # From here on, all of the writing to the database happens in the background.
+    writer.start()
+
+    if METRICS_PORT != 0:
+        try:
+            tollmetrics.serve(METRICS_PORT)
+        except Exception as e:
+            logging.error('could not serve metrics on port {}: {}'.format(METRICS_PORT, str(e)))
+
+    # The pool of threads used to make the requests to the web API concurrently, and the
+    # pool of persistent connections they share. A trip that's also one of the reversible lane
+    # probes is only requested once a tick; fetch_tick sees to that.
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=FETCH_WORKERS)
+    client = expresslanes.Client(pool_size=FETCH_WORKERS,
+        connect_timeout=CONNECT_TIMEOUT, read_timeout=FETCH_TIMEOUT, retries=FETCH_RETRIES)
+    # Keeps us from hammering the web API, however many trips we're tracking.
+    limiter = expresslanes.RateLimiter(REQUEST_RATE, REQUEST_BURST)
+
+    feed = tollfeed.Publisher(FEED_SOCKET) if FEED_SOCKET != '' else None
+
     while True:
         # To keep things simple, trucate the log date/time to the nearest minute.
         log_date = datetime.now().replace(second=0, microsecond=0)
 
-        # Log the toll/time info for each of the trips we're interested in.
-        for trip in trips:
-            log_trip_toll(trip, log_date, curs)
+        if reload_requested:
+            reload_requested = False
+            trips, reversible_ramps = reload_catalog(trips, reversible_ramps)
+
+        tick_start = time.monotonic()
+
+        run_tick(executor, client, limiter, trips, reversible_ramps, reversible, writer, log_date)
 
-        # Log the status of the reversible lanes.
-        log_reversible_status(reversible, log_date, curs)
+        TICK_SECONDS.observe(time.monotonic() - tick_start)
+        TICKS.inc()
+
+        if feed is not None:
+            delivered = feed.publish(tick_update(trips, reversible, log_date))
+            FEED_UPDATES.inc(result='delivered' if delivered else 'dropped')
 
         # Check again when we get to the next minute.
         next_time = log_date + timedelta(minutes=1)
+
+        # If we're already past it, we've overrun, and any whole minutes we're past it by are
+        # minutes we won't log at all.
+        now = datetime.now()
+        if now >= next_time:
+            TICKS_OVERRUN.inc()
+            TICKS_SKIPPED.inc((now.replace(second=0, microsecond=0) - next_time) // timedelta(minutes=1))
+            logging.warning('tick for {} overran into {}'.format(str(log_date), str(now)))
+
+        if METRICS_FILE != '':
+            try:
+                tollmetrics.write_file(METRICS_FILE)
+            except Exception as e:
+                logging.error('could not write metrics to {}: {}'.format(METRICS_FILE, str(e)))
+
         pause.until(next_time)
 
 if __name__ == '__main__':
@@ -0,0 +1,157 @@
+#!/usr/bin/python3
+
+# Brings the tolls database's schema up to date. The schema is built up by the numbered SQL files in
+# migrations/, applied in order; schema_version records which ones have been applied, so each one
+# only ever runs once.
+#
+#   ./migrate.py --user root            apply anything that hasn't been applied yet
+#   ./migrate.py --user root --list     show what has and hasn't been applied
+#   ./migrate.py --user root --target 1 apply migrations only up to and including 0001
+#
+# A database created before there were migrations (from the old tolls_ddl.sql) already has the
+# baseline schema, so 0001 is recorded as applied without running it; everything after it runs.
+# The baseline is tolls_ddl.sql as it was, and nothing is ever added to it; changes to the schema
+# go in new migrations, so that existing databases get them too.
+
+import argparse, logging, os, re, sys
+import mysql.connector
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+
+# Migration files are named NNNN_what_it_does.sql.
+MIGRATION_FILE = re.compile(r'^(\d{4})_(\w+)\.sql$')
+
+VERSION_DDL = '''
+    CREATE TABLE IF NOT EXISTS schema_version (
+      version INT NOT NULL,
+      name VARCHAR(100) NOT NULL,
+      applied_date DATETIME NOT NULL,
+      CONSTRAINT PK_schema_version PRIMARY KEY (version)
+    )
+'''
+
+# All of the migrations, in order, as (version, name, path).
+def migrations():
+    found = []
+
+    for file_name in os.listdir(MIGRATIONS_DIR):
+        match = MIGRATION_FILE.match(file_name)
+
+        if match is not None:
+            found.append((int(match.group(1)), match.group(2), os.path.join(MIGRATIONS_DIR, file_name)))
+
+    return sorted(found)
+
+# The statements in a migration file, without the comments. Migrations run against whatever
+# database we're connected to, so a USE line (the baseline has one) is left out too.
+def statements(path):
+    with open(path) as sql_file:
+        sql = ''.join(line for line in sql_file
+            if not line.lstrip().startswith('--') and not re.match(r'\s*USE\s', line, re.IGNORECASE))
+
+    return [statement.strip() for statement in sql.split(';') if statement.strip() != '']
+
+def table_exists(curs, table):
+    curs.execute('''
+        SELECT COUNT(*)
+          FROM information_schema.tables
+          WHERE table_schema = DATABASE()
+            AND table_name = %(table)s
+    ''', {'table':table})
+
+    return curs.fetchone()[0] > 0
+
+# The versions that have been applied to the database, creating schema_version if it isn't there.
+def applied_versions(curs):
+    if not table_exists(curs, 'schema_version'):
+        # Tables from before there were migrations; the baseline is already in place.
+        baseline = table_exists(curs, 'toll_log')
+
+        curs.execute(VERSION_DDL)
+
+        if baseline:
+            version, name, path = migrations()[0]
+            record(curs, version, name)
+            logging.info('existing schema recorded as {:04d}_{}'.format(version, name))
+
+    curs.execute('SELECT version FROM schema_version')
+
+    return set(row[0] for row in curs.fetchall())
+
+def record(curs, version, name):
+    curs.execute('''
+        INSERT
+          INTO schema_version (version, name, applied_date)
+          VALUES (%(version)s, %(name)s, NOW())
+    ''', {'version':version, 'name':name})
+
+# Apply the migrations that haven't been applied yet, up to and including target (all of them if
+# target is None). Returns the versions applied. MariaDB commits DDL as it goes, so a migration
+# that fails partway has to be finished or undone by hand before trying again.
+def migrate(conn, target=None):
+    curs = conn.cursor()
+    done = []
+
+    try:
+        applied = applied_versions(curs)
+        conn.commit()
+
+        for version, name, path in migrations():
+            if version in applied or (target is not None and version > target):
+                continue
+
+            logging.info('applying {:04d}_{}'.format(version, name))
+
+            for statement in statements(path):
+                curs.execute(statement)
+
+            record(curs, version, name)
+            conn.commit()
+
+            done.append(version)
+    finally:
+        curs.close()
+
+    return done
+
+def main():
+    parser = argparse.ArgumentParser(description='Bring the tolls database schema up to date.')
+    parser.add_argument('--user', default=os.environ.get('USER'))
+    parser.add_argument('--password')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--database', default='tolls')
+    parser.add_argument('--target', type=int, help='the last migration to apply')
+    parser.add_argument('--list', action='store_true', help='list the migrations and whether they have been applied')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s:%(levelname)s:%(message)s', level=logging.INFO)
+
+    connect_args = {'user':args.user, 'host':args.host, 'database':args.database}
+    if args.password is not None: connect_args['password'] = args.password
+
+    try:
+        conn = mysql.connector.connect(**connect_args)
+    except Exception as e:
+        logging.critical('Unable to connect to the database: {}'.format(str(e)))
+        sys.exit(1)
+
+    try:
+        if args.list:
+            curs = conn.cursor()
+            applied = applied_versions(curs)
+            conn.commit()
+            curs.close()
+
+            for version, name, path in migrations():
+                print('{:04d}_{:40} {}'.format(version, name, 'applied' if version in applied else 'pending'))
+        else:
+            done = migrate(conn, args.target)
+            logging.info('applied {} migration(s)'.format(len(done)))
+    except Exception as e:
+        logging.critical('Migration failed: {}'.format(str(e)))
+        sys.exit(1)
+    finally:
+        conn.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,9 @@
+-- The logger's writer records the last spooled batch it committed here, in the same transaction as
+-- the batch, so that replaying the spool after a crash never writes a batch twice. It goes on top
+-- of 0001; IF NOT EXISTS lets it run on a database that was given the table by hand already.
+
+CREATE TABLE IF NOT EXISTS spool_checkpoint (
+  spool_name VARCHAR(100) NOT NULL,
+  spool_seq BIGINT NOT NULL,
+  CONSTRAINT PK_spool_checkpoint PRIMARY KEY (spool_name)
+);
@@ -0,0 +1,8 @@
+-- The logger reads its trips from the trip table: log_toll says whether a trip's tolls are logged,
+-- and reversible_probe marks the trips (one northbound, one southbound) it checks the reversible
+-- lanes with. It goes on top of 0001; IF NOT EXISTS lets it run on a database that was given the
+-- columns by hand already.
+
+ALTER TABLE trip
+  ADD COLUMN IF NOT EXISTS log_toll CHAR(1) NOT NULL DEFAULT 'Y' CHECK (log_toll IN ('Y', 'N')),
+  ADD COLUMN IF NOT EXISTS reversible_probe CHAR(1) CHECK (reversible_probe IN ('N', 'S'));
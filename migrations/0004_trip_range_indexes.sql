@@ -0,0 +1,10 @@
+-- The web service asks for one trip's rows over a window of end dates, and the logger looks up a
+-- trip's series by start date. With only the end date indexed, both read every trip's rows in the
+-- window. These put the trip first, then the end date, and carry the rest of the columns those
+-- queries read, so they never have to touch the table itself.
+
+CREATE INDEX IDX_toll_log_trip_date
+  ON toll_log (ramp_on, ramp_off, toll_end_date, toll_start_date, price_495, price_95);
+
+CREATE INDEX IDX_time_log_trip_date
+  ON time_log (ramp_on, ramp_off, time_end_date, time_start_date, time_495, time_95);
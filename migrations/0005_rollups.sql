@@ -0,0 +1,31 @@
+-- Hourly (period 'H') and daily (period 'D') statistics for each trip's tolls and travel times, so
+-- that questions about long stretches of time don't have to read and expand every series in them.
+-- "minutes" is how many minutes of the period we have a value for, and the total is the sum of
+-- the value over those minutes, so the time-weighted average is total / minutes. The logger keeps
+-- them up to date as it writes the series; tollrollup.py builds them from the existing history.
+
+CREATE TABLE toll_rollup (
+  ramp_on INT NOT NULL,
+  ramp_off INT NOT NULL,
+  period CHAR(1) NOT NULL,
+  period_start DATETIME NOT NULL,
+  minutes INT NOT NULL,
+  price_total NUMERIC(12,2) NOT NULL,
+  price_min NUMERIC(5,2) NOT NULL,
+  price_max NUMERIC(5,2) NOT NULL,
+  CONSTRAINT PK_toll_rollup PRIMARY KEY (ramp_on, ramp_off, period, period_start),
+  CONSTRAINT CK_toll_rollup_period CHECK (period IN ('H', 'D'))
+);
+
+CREATE TABLE time_rollup (
+  ramp_on INT NOT NULL,
+  ramp_off INT NOT NULL,
+  period CHAR(1) NOT NULL,
+  period_start DATETIME NOT NULL,
+  minutes INT NOT NULL,
+  time_total INT NOT NULL,
+  time_min INT NOT NULL,
+  time_max INT NOT NULL,
+  CONSTRAINT PK_time_rollup PRIMARY KEY (ramp_on, ramp_off, period, period_start),
+  CONSTRAINT CK_time_rollup_period CHECK (period IN ('H', 'D'))
+);
@@ -0,0 +1,15 @@
+-- How many minutes of each hour (period 'H') and day (period 'D') each trip's toll spent at each
+-- price, alongside toll_rollup, so that questions like "how long was it over $10 this month" don't
+-- have to read and expand every series either. The logger keeps it up to date with the other
+-- rollups; tollrollup.py builds it from the existing history.
+
+CREATE TABLE toll_price_rollup (
+  ramp_on INT NOT NULL,
+  ramp_off INT NOT NULL,
+  period CHAR(1) NOT NULL,
+  period_start DATETIME NOT NULL,
+  price NUMERIC(5,2) NOT NULL,
+  minutes INT NOT NULL,
+  CONSTRAINT PK_toll_price_rollup PRIMARY KEY (ramp_on, ramp_off, period, period_start, price),
+  CONSTRAINT CK_toll_price_rollup_period CHECK (period IN ('H', 'D'))
+);
@@ -1,62 +1,135 @@
 #!/usr/bin/python3
 
-import json, pause, sys, threading, urllib.request
+import concurrent.futures, expresslanes, json, os, pause, struct, threading, time, tollseries, urllib.request
+import numpy as np
 from datetime import datetime
 from datetime import timedelta
-from PIL import Image, ImageDraw, ImageFont, ImageTk
+from PIL import Image, ImageTk
 import tkinter as tk
 
-def get_history (tolls, trip):
-    toll_url = 'http://urbanjaguar.org:8080/gettollprices/{:n}/{:n}/{:n}'
-    toll_url = toll_url.format(trip['ramp_on'], trip['ramp_off'], trip['hist_minutes'])
-
-    minute_delta = timedelta(minutes=1)
-    last_period = datetime.now().replace(second=0, microsecond=0) - minute_delta
-    min_date = datetime.now().replace(second=0, microsecond=0) - timedelta(minutes=trip['hist_minutes'])
+# The display is drawn by the web service's renderer, so that the board looks the same on a
+# display as it does as a PNG. It comes with the webtoll package, which a display doesn't need the
+# rest of: pip install --no-deps ./webtoll, and then pillow and numpy.
+from webtoll import render
+
+# The compact columnar format webtoll will send us instead of JSON if we ask for it: a header
+# (magic, column count, row count, origin, step), an 8 byte name per column, and then the columns,
+# as little-endian int32 arrays. Prices are in cents.
+COLUMNS_MIMETYPE = 'application/vnd.webtoll.columns'
+COLUMNS_HEADER = struct.Struct('<4sIIii')
+COLUMNS_MISSING = -2 ** 31
+
+# Split a response in the columnar format into its columns, each a NumPy array of ints read
+# straight out of the response, plus the origin and step from the header.
+def decode_columns (body):
+    magic, column_count, row_count, origin, step = COLUMNS_HEADER.unpack_from(body)
+
+    if magic != b'WTC1':
+        raise ValueError('not a webtoll columns response')
+
+    offset = COLUMNS_HEADER.size
+    names = []
+
+    for index in range(column_count):
+        names.append(body[offset:offset + 8].rstrip(b'\0').decode('ascii'))
+        offset += 8
+
+    columns = {}
+
+    for name in names:
+        columns[name] = np.frombuffer(body, dtype='<i4', count=row_count, offset=offset)
+        offset += row_count * 4
+
+    return columns, origin, step
+
+# Where we keep each trip's toll history, so that we don't have to fetch all of it again when we
+# restart.
+HISTORY_FILE = os.path.expanduser('~/.cache/tolldisp/tolls-{ramp_on}-{ramp_off}.series')
+
+# Fill in the toll prices we're missing from the window, from webtoll. Returns whether we got them;
+# if we didn't, the series is left as it was, so that we ask for the same minutes again. The series
+# is only touched while holding the lock, since the display is adding minutes to it as they come.
+def get_history (tolls, trip, lock):
+    # The minute it is now, in minutes since the epoch, and the minutes before it we're missing:
+    # everything from the first minute in the window we don't have a toll for, or else since the
+    # latest toll we have (say, from before we restarted), or the whole window if that's longer ago
+    # or we don't have a full window.
+    now = int(datetime.now().timestamp() // 60)
+    first = now - tolls.capacity
+
+    with lock:
+        if len(tolls) == tolls.capacity:
+            holes = np.flatnonzero(np.isnan(tolls.values()))
+
+            if len(holes):
+                first = max(first, tolls.minute - tolls.capacity + 1 + int(holes[0]))
+            else:
+                first = max(first, tolls.minute + 1)
+
+    if first >= now:
+        return True
+
+    # Minutes webtoll doesn't have a toll price for either are NaN, which the series leaves out of
+    # its lowest and highest, so the graph still lines up.
+    missing = np.full(now - first, np.nan)
+
+    # The server expands the toll data into one price per minute for us, oldest first, up to and
+    # including the current minute.
+    toll_url = 'http://urbanjaguar.org:8080/gettollseries/{:n}/{:n}/{:n}'
+    toll_url = toll_url.format(trip['ramp_on'], trip['ramp_off'], now - first + 1)
 
     try:
-        # Get all of the toll data for the specified trip for the last hist_minutes.
-        with urllib.request.urlopen(toll_url) as response:
-            tollhist = json.loads(response.read())
-
-        for toll in tollhist:
-            # Make sure the start/end dates are truncated to the nearest minute.
-            start_date = datetime.strptime(toll['toll_start_date'], '%Y%m%d%H%M')
-            end_date = datetime.strptime(toll['toll_end_date'], '%Y%m%d%H%M')
-            price = float(toll['toll_price'])
-
-            # Fill in the gaps between one set of toll pricing and another.
-            while last_period - minute_delta > end_date:
-                tolls.append(0)
-                last_period -= minute_delta
-
-            last_period = start_date
-
-            # Backfill the toll price for the whole range from end to start.
-            while end_date >= start_date:
-                tolls.append(price)
-                end_date -= minute_delta
-
-        while last_period >= min_date:
-            tolls.append(0)
-            last_period -= minute_delta
-    except:
-        pass
+        # Get the toll price for every minute we're missing for the specified trip.
+        request = urllib.request.Request(toll_url, headers={'Accept':COLUMNS_MIMETYPE})
 
-def fetch_toll_data (trip):
-    # The URL for the web API that gives us the data we want.
-    url = 'https://www.expresslanes.com/maps-api/get-ramps-price?ramp_entry={ramp_on}&ramp_exit={ramp_off}'
+        with urllib.request.urlopen(request, timeout=HISTORY_TIMEOUT) as response:
+            columns, origin, step = decode_columns(response.read())
+
+        # Line the prices up with the minutes we're missing, by the minute of the first one. We'll
+        # be getting the current minute's toll ourselves.
+        cents = columns['value']
+        minutes = origin + np.arange(len(cents))
+        wanted = (minutes >= first) & (minutes < now) & (cents != COLUMNS_MISSING)
+        missing[minutes[wanted] - first] = cents[wanted] / 100
+    except Exception:
+        # We'll try again.
+        return False
+
+    with lock:
+        tolls.fill(missing, now - 1)
+
+    return True
 
-    with urllib.request.urlopen(url.format(ramp_on=trip['ramp_on'], ramp_off=trip['ramp_off'])) as response:
-        toll = json.loads(response.read())
+# Keep trying to get the history until we do, in the background, so that the display doesn't wait
+# on webtoll. What we get shows up the next time the display is drawn.
+def keep_history (tolls, trip, lock):
+    while not get_history(tolls, trip, lock):
+        time.sleep(HISTORY_RETRY)
 
-    return toll
+# How many lookups we make at once: the trip, and the reversible lanes northbound and southbound.
+FETCH_WORKERS = 3
 
-# Get toll and time information for an on/off ramp pair. This also gets us status information
-# for the reversible lanes when the trip defined by the ramps traverses those lanes.
+# How many seconds into the minute we'll wait for the lookups before giving up on them until the
+# next minute. The display doesn't wait on them: it's drawn at the top of the minute with what we
+# already have, and again when they come in.
+FETCH_DEADLINE = 20
+
+# How long we'll wait on webtoll for the history, and how long before we try again if we don't get it.
+HISTORY_TIMEOUT = 10
+HISTORY_RETRY = 60
+
+# One client, with its pool of persistent connections, for all of our requests to the web API.
+client = expresslanes.Client(pool_size=FETCH_WORKERS)
+
+def fetch_toll_data (trip):
+    return client.get_ramps_price(trip['ramp_on'], trip['ramp_off'])
+
+# Get toll and time information for an on/off ramp pair, as {'price':..., 'travel_time':...}. This
+# also gets us status information for the reversible lanes when the trip defined by the ramps
+# traverses those lanes.
 def fetch_toll (trip):
-    # If we have an issue fetching the toll price, for whatever reason, we'll just return 0.
-    toll_price = 0
+    # If we have an issue fetching the toll price, for whatever reason, we'll just return None.
+    toll_data = None
 
     try:
         # Get the data from the web API.
@@ -66,19 +139,19 @@ def fetch_toll (trip):
         if toll.setdefault('error', '0') in ('0', None, ''):
             # No. Calculate the total toll price and travel time.
 
-            # Treat empty toll prices and travel times as zero.
-            if toll.setdefault('price_495', '') in (None, ''): toll['price_495'] = 0
-            if toll.setdefault('price_95', '') in (None, ''): toll['price_95'] = 0
-            if toll.setdefault('time_495', '') in (None, ''): toll['time_495'] = 0
-            if toll.setdefault('time_95', '') in (None, ''): toll['time_95'] = 0
+            # Treat empty toll prices and travel times as zero, as long as we got one of them.
+            prices = [toll.get(column) for column in ('price_495', 'price_95') if toll.get(column) not in (None, '')]
+            times = [toll.get(column) for column in ('time_495', 'time_95') if toll.get(column) not in (None, '')]
 
-            toll_price = toll['price_495'] + toll['price_95']
-            trip['travel_time'] = toll['time_495'] + toll['time_95']
+            toll_data = {
+                'price':sum(prices) if prices else None,
+                'travel_time':sum(times) if times else None,
+            }
     except Exception as e:
-        # Ignore any exceptions. We'll just return None for the toll price.
+        # Ignore any exceptions. We'll just return None.
         pass
 
-    return toll_price
+    return toll_data
 
 def fetch_reversible_status (trip):
     # If we have an issue fetching the status of the reversible lanes, for whatever reason, we'll just return None.
@@ -97,188 +170,167 @@ def fetch_reversible_status (trip):
 
     return reversible_status
 
-# Figure out the status of the reversible lanes.
-def fetch_reversible ():
-    # Unless we hear otherwise, consider the reversible lanes closed.
-    reversible_status = 'C'
-
-    # The on/off ramps to use when checking the status northbound and southbound.
-    ramps = {'north':{'ramp_on':218, 'ramp_off':183}, 'south':{'ramp_on':183, 'ramp_off':218}}
-
-    # Get the data for the northbound and southbound trips.
-    north = fetch_reversible_status(ramps['north'])
-    south = fetch_reversible_status(ramps['south'])
-
-    if north != None and south != None:
-        # Derive the status of the reversible lanes based on whether they're
-        # reported as "open" for the northbound or southbound trip. If neither
-        # we'll return the default of "C" (closed).
-        if north == 'open':
-            reversible_status = 'N'
-        elif south == 'open':
-            reversible_status = 'S'
-
-    return reversible_status
-
-def calc_toll_color(toll):
-    low_toll = 10.0
-    low_color = (0x2d, 0x82, 0x00)
-
-    high_toll = 20.0
-    high_color = (0xff, 0x00, 0x24)
-    
-    if toll <= low_toll:
-        toll_color = low_color
-    elif toll >= high_toll:
-        toll_color = high_color
-    else:
-        gradient = (toll - low_toll)/(high_toll - low_toll)
-        toll_red = low_color[0] + int((high_color[0] - low_color[0]) * gradient)
-        toll_green = low_color[1] + int((high_color[1] - low_color[1]) * gradient)
-        toll_blue = low_color[2] + int((high_color[2] - low_color[2]) * gradient)
-        toll_color = (toll_red, toll_green, toll_blue)
-
-    return toll_color
-
-def get_toll_display(check_time, trip, tolls, reversible, display_size, fonts):
-    # Colors for our display.
-    background_color = (0x34, 0x34, 0x34)
-    graph_color = (0x8c, 0x13, 0x1a)
-    text_color = (0x8b, 0x8b, 0x8b)
-
-    # Calculate the initial dimensions of our image.
-
-    # One pixel of width per toll entry.
-    width = len(tolls) - 1
-
-    # One pixel per nickel of the maximum price in the list.
-    max_price_pixels = int(max(tolls) * 100 / 5);
-
-    # We want the maximum price to reach one third of the way to the top of the display.
-    height = max_price_pixels * 3
-
-    # Create the image for the display, and get a drawing context for it.
-    display = Image.new('RGB', (width, height), color=background_color)
-    draw = ImageDraw.Draw(display)
-
-    # We're graphing the tolls left to right, oldest to most recent,
-    # so initialize the toll index to the oldest toll.
-    toll_index = len(tolls)
-
-    # Graph the toll prices onto the image from left to right.
-    for index in range(width + 1):
-        toll_index -= 1
-
-        # Skip over entries where we don't have price data.
-        if tolls[toll_index] == 0: continue
-
-        # Calculate the start/stop coordinates of the line.
-        startx = index
-        starty = height - int(tolls[toll_index] * 100 / 5)
-        stopx = index
-        stopy = height
-
-        draw.line((startx, starty, stopx, stopy), fill=graph_color, width=1)
-
-    # Resize the display to its final dimensions.
-    display = display.resize(display_size, Image.BICUBIC)
-    # After the resize we need a new drawing context.
-    draw = ImageDraw.Draw(display)
-
-    day_text = check_time.strftime('%A %m/%d/%Y')
-    time_text = check_time.strftime('%I:%M %p')
-
-    #
-    # Write all of the text onto the display image.
-    #
-
-    # Use this height as the margin.
-    margin = fonts['day_height']
-
-    # Put the day and date centered at the top.
-    (width, height) = draw.textsize(day_text, font=fonts['day'])
-    draw.text(((display_size[0] - width)/2, margin), day_text, fill=text_color, font=fonts['day'])
-
-    # The ramp where the trip starts.
-    (width, height) = draw.textsize('From: ', font=fonts['label'])
-    anchor = (margin + width, display_size[1]/6)
-    draw.text((margin, anchor[1] - fonts['label_height']), 'From: ', fill=text_color, font=fonts['label'])
-    draw.text((anchor[0], anchor[1] - fonts['trip_height']), trip['ramp_on_name'], fill=text_color, font=fonts['trip'])
-
-    # The ramp where the trip ends.
-    (width, height) = draw.textsize('To: ', font=fonts['label'])
-    draw.text((anchor[0] - width, anchor[1]), 'To: ', fill=text_color, font=fonts['label'])
-    anchor = (anchor[0], anchor[1] + fonts['label_height'] - fonts['trip_height'])
-    draw.text((anchor[0], anchor[1]), trip['ramp_off_name'], fill=text_color, font=fonts['trip'])
-
-    # The highest and lowest tolls in the last X minutes.
-    high_toll_text = 'High: ${:.2f}'.format(max(tolls))
-    low_toll_text = 'Low: ${:.2f}'.format(min(filter(lambda x: x > 0, tolls)))
-    anchor = (margin, anchor[1] + fonts['trip_height'] + margin)
-    draw.text((anchor[0], anchor[1]), high_toll_text, fill=text_color, font=fonts['trip'])
-    draw.text((anchor[0], anchor[1] + fonts['trip_height'] + margin/2), \
-        low_toll_text, fill=text_color, font=fonts['trip'])
-
-    # The status of the reversible lanes.
-    reversible_text = 'I95 '
-    if reversible == 'N':
-        reversible_text += 'Open Northbound'
-    elif reversible == 'S':
-        reversible_text += 'Open Southbound'
-    else:
-        reversible_text += 'Closed'
-
-    anchor = (margin, anchor[1] + fonts['trip_height']*2 + margin*2)
-    draw.text((anchor[0], anchor[1]), reversible_text, fill=text_color, font=fonts['trip'])
-
-    # The current toll.
-    toll_text = '${:.2f}'.format(tolls[0])
-    (width, height) = draw.textsize(toll_text, font=fonts['toll'])
-    anchor = (display_size[0] - margin, fonts['toll_height'])
-    draw.text((anchor[0] - width, (display_size[1]/2) - anchor[1] + margin), \
-        toll_text, fill=calc_toll_color(tolls[0]), font=fonts['toll'])
-
-    # The current time.
-    (width, height) = draw.textsize(time_text, font=fonts['label'])
-    draw.text((anchor[0] - width, (display_size[1]/2) - anchor[1] - fonts['label_height'] + margin), \
-        time_text, fill=text_color, font=fonts['label'])
-
-    # The current travel time.
-    travel_text = 'Travel Time {:n} Minutes'.format(trip['travel_time'])
-    (width, height) = draw.textsize(travel_text, font=fonts['trip'])
-    draw.text((anchor[0] - width, (display_size[1]/2) + (margin * 2)), \
-        travel_text, fill=text_color, font=fonts['trip'])
-
-    # Return the display image.
-    return ImageTk.PhotoImage(image=display)
-
-def font_heights(fonts):
-    # We need an image and a drawing context to find the font heights.
-    junkimg = Image.new('RGB', (800, 480), color=(0x00, 0x00, 0x00))
-    junkdraw = ImageDraw.Draw(junkimg)
-
-    # Find the height of each font.
-    for font_name in list(fonts.keys()):
-        (width, fonts[font_name + '_height']) = junkdraw.textsize('X', font=fonts[font_name])
-
-def get_fonts():
-    fonts = {}
-
-    fonts['day'] = ImageFont.truetype(font='Ubuntu-R', size=22)
-    fonts['label'] = ImageFont.truetype(font='Ubuntu-R', size=42)
-    fonts['trip'] = ImageFont.truetype(font='Ubuntu-R', size=24)
-    fonts['time'] = ImageFont.truetype(font='Ubuntu-R', size=24)
-    fonts['toll'] = ImageFont.truetype(font='Ubuntu-B', size=140)
-
-    # Find the "absolute" height for each font.
-    font_heights(fonts)
-
-    return fonts
+# The on/off ramps to use when checking the status of the reversible lanes northbound and southbound.
+REVERSIBLE_RAMPS = {'north':{'ramp_on':218, 'ramp_off':183}, 'south':{'ramp_on':183, 'ramp_off':218}}
+
+# Figure out the status of the reversible lanes from the northbound and southbound statuses, or
+# None if we don't have both.
+def calc_reversible (north, south):
+    if north == None or south == None:
+        return None
+
+    # Derive the status of the reversible lanes based on whether they're reported as "open" for the
+    # northbound or southbound trip. If neither they're closed.
+    if north == 'open':
+        return 'N'
+    elif south == 'open':
+        return 'S'
+
+    return 'C'
+
+# Make all of a minute's lookups at once, waiting for them no later than the deadline. Returns the
+# toll for the trip and the northbound and southbound reversible lanes statuses, as
+# {'toll':..., 'north':..., 'south':...}, with None for any we didn't get in time.
+def fetch_tick (executor, trip, deadline):
+    futures = {
+        'toll':executor.submit(fetch_toll, trip),
+        'north':executor.submit(fetch_reversible_status, REVERSIBLE_RAMPS['north']),
+        'south':executor.submit(fetch_reversible_status, REVERSIBLE_RAMPS['south']),
+    }
+
+    timeout = max((deadline - datetime.now()).total_seconds(), 0)
+    concurrent.futures.wait(futures.values(), timeout=timeout)
+
+    results = {}
+
+    for name, future in futures.items():
+        if future.done():
+            # The fetches catch their own exceptions, so this won't raise.
+            results[name] = future.result()
+        else:
+            # This one missed the deadline. Don't bother starting it if it's still queued; if it's
+            # already going, it'll finish in the background, and we'll try again next minute.
+            future.cancel()
+            results[name] = None
+
+    return results
+
+# Where we follow the logger's updates for our trip, through webtoll, and how long we'll wait on a
+# poll, which is longer than webtoll holds one open (LIVE_POLL_TIMEOUT) before saying there's
+# nothing new. If a poll fails, we try again after LIVE_RETRY seconds.
+LIVE_URL = 'http://urbanjaguar.org:8080/live/poll?trip={ramp_on:n}-{ramp_off:n}&after={after:n}'
+LIVE_TIMEOUT = 35
+LIVE_RETRY = 10
+
+# How long the feed can go without an update before we stop waiting on it and look the toll up
+# ourselves, until it picks up again.
+FEED_QUIET = timedelta(minutes=2)
+
+# Follows the logger's updates for a trip through webtoll's live feed, in the background, so that
+# the display gets what the logger polled instead of making its own lookups.
+class Feed:
+    def __init__(self, trip):
+        self.trip = trip
+        self.seq = 0
+        self.update = None
+        self.heard = None
+        self.condition = threading.Condition()
+
+    # Keep polling for the next update, for as long as we run.
+    def follow(self):
+        while True:
+            url = LIVE_URL.format(after=self.seq, **self.trip)
+
+            try:
+                with urllib.request.urlopen(url, timeout=LIVE_TIMEOUT) as response:
+                    # 204 means there was nothing new before webtoll's timeout; just ask again.
+                    if response.status == 204:
+                        continue
+
+                    update = json.loads(response.read())
+            except Exception:
+                # We'll try again.
+                time.sleep(LIVE_RETRY)
+                continue
+
+            with self.condition:
+                self.seq = update['seq']
+                self.update = update
+                self.heard = datetime.now()
+                self.condition.notify_all()
+
+    # Whether we haven't heard from the feed lately, so we should look things up ourselves.
+    def quiet(self):
+        with self.condition:
+            return self.heard is None or datetime.now() - self.heard > FEED_QUIET
+
+    # Wait for the logger's update for check_time, no later than the deadline. Returns the trip's
+    # toll and the reversible lanes status from it, as {'toll':(..., minute), 'reversible':(...,
+    # minute)}, the way update_display keeps them, with None for any the update doesn't have, or for
+    # both if the update didn't come in time.
+    def wait(self, check_time, deadline):
+        log_date = check_time.strftime('%Y%m%d%H%M')
+        timeout = max((deadline - datetime.now()).total_seconds(), 0)
+
+        with self.condition:
+            self.condition.wait_for(lambda: self.update is not None and self.update['log_date'] >= log_date, timeout)
+            update = self.update
+
+        results = {'toll':None, 'reversible':None}
+
+        if update is None or update['log_date'] < log_date:
+            return results
+
+        for entry in update['trips']:
+            if (entry['ramp_on'], entry['ramp_off']) != (self.trip['ramp_on'], self.trip['ramp_off']) or 'as_of' not in entry:
+                continue
+
+            # Like the lookups, treat empty toll prices and travel times as zero, as long as we got
+            # one of them.
+            prices = [entry[column] for column in ('price_495', 'price_95') if entry.get(column) is not None]
+            times = [entry[column] for column in ('time_495', 'time_95') if entry.get(column) is not None]
+
+            if prices:
+                results['toll'] = ({'price':sum(prices), 'travel_time':sum(times) if times else None},
+                    datetime.strptime(entry['as_of'], '%Y%m%d%H%M'))
+
+        if update['reversible'] is not None:
+            results['reversible'] = (update['reversible']['status_code'],
+                datetime.strptime(update['reversible']['as_of'], '%Y%m%d%H%M'))
+
+        return results
+
+# Paint the toll display for a minute, into the image the label is already showing, with the
+# latest of what we have, marking what isn't current, unless it's too old to be worth showing. It
+# goes by the same rule as the web service's display (render.as_of).
+def paint (toll_display, renderer, trip, tolls, lock, latest, check_time):
+    stale = {}
+
+    for name, entry in list(latest.items()):
+        if entry is None:
+            continue
+
+        value, minute = render.as_of(entry[0], entry[1], check_time)
+
+        if value is None:
+            latest[name] = None
+        elif minute is not None:
+            stale[name] = minute
+
+    current = latest['toll'][0] if latest['toll'] is not None else {'price':None, 'travel_time':None}
+    trip['travel_time'] = current['travel_time']
+    reversible = latest['reversible'][0] if latest['reversible'] is not None else None
+
+    with lock:
+        display = renderer.render(check_time, trip, tolls.values(), tolls.max(), tolls.min(),
+            current['price'], reversible, stale)
+
+    toll_display.paste(display)
 
 # The main body of the program.
 def update_display(toll_label):
     # Load the fonts we're going to use in the display.
-    fonts = get_fonts()
+    fonts = render.get_fonts()
 
     # The trip we're going to track the tolls and time for.
     trip = {'ramp_on':182, 'ramp_off':191,
@@ -287,37 +339,90 @@ def update_display(toll_label):
 
     minute_delta = timedelta(minutes=1)
 
-    # The list of tolls over time.
-    tolls = []
+    # What draws the display, and the image the label shows it in.
+    renderer = render.Renderer(trip, DISPLAY_SIZE, fonts)
+    toll_display = ImageTk.PhotoImage('RGB', DISPLAY_SIZE)
+    toll_label.configure(image=toll_display)
+    toll_label.image = toll_display
 
     # We want to show the minute by minute history of toll prices over the last 12 hours.
     hist_minutes = 720
 
-    # Calculate the earliest date we want to fetch toll prices for.
-    trip['hist_minutes'] = hist_minutes
+    # The tolls over time: the history, plus the current minute, as we had them when we last ran.
+    # The history fills in from the background, so it's only touched while holding the lock.
+    tolls = tollseries.TollSeries(hist_minutes + 1, HISTORY_FILE.format(**trip))
+    tolls_lock = threading.Lock()
+
+    # The latest toll (and travel time) and reversible lanes status we got, and the minute they're
+    # from, as (value, minute). To start with, that's the latest toll from when we last ran, if
+    # we had one.
+    latest = {'toll':None, 'reversible':None}
+
+    if tolls.latest() is not None:
+        latest['toll'] = ({'price':tolls.latest(), 'travel_time':None}, datetime.fromtimestamp(tolls.minute * 60))
+
+    # Show what we have right away, rather than waiting on webtoll and the lookups.
+    paint(toll_display, renderer, trip, tolls, tolls_lock, latest, datetime.now().replace(second=0, microsecond=0))
+
+    # Bring our tolls dataset up to date by fetching the toll data we're missing from the last
+    # hist_minutes minutes, in the background.
+    threading.Thread(target=keep_history, args=(tolls, trip, tolls_lock), daemon=True).start()
 
-    # Initialize our tolls dataset by fetching the toll data for the last hist_minutes minutes.
-    get_history(tolls, trip)
+    # Follow the logger's updates, in the background.
+    feed = Feed(trip)
+    threading.Thread(target=feed.follow, daemon=True).start()
+
+    # The threads the lookups run in, for when the feed is quiet, so that they can all go at once,
+    # and none of them can hold up the display.
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=FETCH_WORKERS)
 
     # Now that we have the history of the toll price, check the toll price every minute going forward.
     while True:
         # To keep things simple, truncate the current date/time to the nearest minute.
         check_time = datetime.now().replace(second=0, microsecond=0)
+        minute = int(check_time.timestamp() // 60)
+
+        # Turn the display over to the new minute right away, carrying the latest toll we have
+        # into it for as long as it's still current, dropping off the oldest price.
+        current, as_of = render.as_of(latest['toll'][0]['price'] if latest['toll'] is not None else None,
+            latest['toll'][1] if latest['toll'] is not None else None, check_time)
+
+        with tolls_lock:
+            tolls.push(current if as_of is None else None, minute)
+
+        paint(toll_display, renderer, trip, tolls, tolls_lock, latest, check_time)
+
+        # Get the current toll and the status of the reversible lanes on 95, as much of it as we
+        # can by the deadline: from the logger's update, or if the feed has gone quiet, by looking
+        # them up ourselves.
+        deadline = check_time + timedelta(seconds=FETCH_DEADLINE)
+
+        if not feed.quiet():
+            results = feed.wait(check_time, deadline)
+        else:
+            results = fetch_tick(executor, trip, deadline)
+            reversible = calc_reversible(results['north'], results['south'])
+
+            results = {
+                'toll':(results['toll'], check_time) if results['toll'] is not None else None,
+                'reversible':(reversible, check_time) if reversible is not None else None,
+            }
 
-        # Get the current toll and the status of the reversible lanes on 95.
-        toll = fetch_toll(trip)
-        reversible = fetch_reversible()
+        for name, entry in results.items():
+            if entry is not None:
+                latest[name] = entry
 
-        # Add this toll price to the beginning of our list, dropping off the oldest price.
-        tolls = [toll] + tolls[0:(hist_minutes + 1)]
+        # This minute's toll takes the place of the one we carried over, as long as it's current.
+        if results['toll'] is not None:
+            current, as_of = render.as_of(results['toll'][0]['price'], results['toll'][1], check_time)
 
-        # Paint the toll display.
+            if current is not None and as_of is None:
+                with tolls_lock:
+                    tolls.push(current, minute)
 
-        # Get the new image.
-        toll_display = get_toll_display(check_time, trip, tolls, reversible, DISPLAY_SIZE, fonts)
-        # Update the label used to display it with the new image.
-        toll_label.configure(image=toll_display)
-        toll_label.image = toll_display
+        # Draw it again with what came in.
+        if results['toll'] is not None or results['reversible'] is not None:
+            paint(toll_display, renderer, trip, tolls, tolls_lock, latest, check_time)
 
         # Check again when we get to the next minute.
         pause.until(check_time + minute_delta)
@@ -0,0 +1,49 @@
+import json, logging, socket
+
+# Publishes what the logger knows about every trip, and the reversible lanes, once a tick, as a
+# JSON datagram sent to a Unix socket. The web service listens on the socket and passes the
+# updates on to its clients, so that they don't have to go to the web API themselves.
+#
+# Nobody has to be listening: if the socket isn't there, or the listener has fallen behind and
+# its buffer is full, the update is dropped rather than holding up the tick. The next one will
+# have the latest of everything anyway.
+
+# A datagram bigger than this may not fit in the socket's buffer.
+MAX_DATAGRAM = 65536
+
+class Publisher:
+    def __init__(self, path):
+        self.path = path
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+        # Whether the last update got through, so that we only log when that changes.
+        self.delivered = None
+
+    # Send an update. Returns whether it was sent.
+    def publish(self, update):
+        data = json.dumps(update, default=str).encode('utf-8')
+
+        if len(data) > MAX_DATAGRAM:
+            logging.warning('feed update of {} bytes is too big to send'.format(len(data)))
+            return False
+
+        try:
+            self.sock.sendto(data, self.path)
+            delivered = True
+        except OSError as e:
+            # No listener (FileNotFoundError, ConnectionRefusedError), or it's not keeping up
+            # (BlockingIOError).
+            delivered = False
+
+            if self.delivered is not False:
+                logging.info('feed updates not getting through to {}: {}'.format(self.path, str(e)))
+
+        if delivered and self.delivered is False:
+            logging.info('feed updates getting through to {} again'.format(self.path))
+
+        self.delivered = delivered
+
+        return delivered
+
+    def close(self):
+        self.sock.close()
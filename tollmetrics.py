@@ -0,0 +1,184 @@
+import cProfile, http.server, logging, os, threading, time
+
+# Simple counters, gauges and histograms, kept in memory and rendered in the Prometheus text format,
+# either from a local HTTP endpoint or to a file (for node_exporter's textfile collector).
+
+# The default histogram buckets, in seconds.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Format a set of labels the way Prometheus wants them.
+def format_labels(labels):
+    if not labels:
+        return ''
+
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for name, value in sorted(labels.items())) + '}'
+
+class Metric:
+    def __init__(self, name, help_text, metric_type):
+        self.name = name
+        self.help_text = help_text
+        self.metric_type = metric_type
+        self.lock = threading.Lock()
+        # One value per distinct set of labels.
+        self.values = {}
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help_text), '# TYPE {} {}'.format(self.name, self.metric_type)]
+
+        with self.lock:
+            for labels, value in sorted(self.values.items()):
+                lines.extend(self.render_value(dict(labels), value))
+
+        return lines
+
+    def render_value(self, labels, value):
+        return ['{}{} {}'.format(self.name, format_labels(labels), value)]
+
+class Counter(Metric):
+    def __init__(self, name, help_text):
+        super().__init__(name, help_text, 'counter')
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    def __init__(self, name, help_text):
+        super().__init__(name, help_text, 'gauge')
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[tuple(sorted(labels.items()))] = value
+
+class Histogram(Metric):
+    def __init__(self, name, help_text, buckets=BUCKETS):
+        super().__init__(name, help_text, 'histogram')
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+
+        with self.lock:
+            counts = self.values.setdefault(key, {'buckets':[0] * len(self.buckets), 'sum':0, 'count':0})
+
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts['buckets'][index] += 1
+
+            counts['sum'] += value
+            counts['count'] += 1
+
+    # Time a block of code: "with histogram.time(trip='182/191'):".
+    def time(self, **labels):
+        return Timer(self, labels)
+
+    def render_value(self, labels, value):
+        lines = []
+
+        for bound, count in zip(self.buckets, value['buckets']):
+            lines.append('{}_bucket{} {}'.format(self.name, format_labels(dict(labels, le=bound)), count))
+
+        lines.append('{}_bucket{} {}'.format(self.name, format_labels(dict(labels, le='+Inf')), value['count']))
+        lines.append('{}_sum{} {}'.format(self.name, format_labels(labels), value['sum']))
+        lines.append('{}_count{} {}'.format(self.name, format_labels(labels), value['count']))
+
+        return lines
+
+class Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.monotonic() - self.start, **self.labels)
+
+# All of the metrics we've created, in the order we created them.
+registry = []
+
+def counter(name, help_text):
+    metric = Counter(name, help_text)
+    registry.append(metric)
+    return metric
+
+def gauge(name, help_text):
+    metric = Gauge(name, help_text)
+    registry.append(metric)
+    return metric
+
+def histogram(name, help_text, buckets=BUCKETS):
+    metric = Histogram(name, help_text, buckets)
+    registry.append(metric)
+    return metric
+
+# All of the metrics, in the Prometheus text format.
+def render():
+    lines = []
+
+    for metric in registry:
+        lines.extend(metric.render())
+
+    return '\n'.join(lines) + '\n'
+
+# Write the metrics to a file, replacing it in one go so a reader never sees half of it.
+def write_file(path):
+    temp_path = path + '.tmp'
+
+    with open(temp_path, 'w') as metrics_file:
+        metrics_file.write(render())
+
+    os.replace(temp_path, path)
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+
+        body = render().encode('utf-8')
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Keep the requests out of our log.
+    def log_message(self, format, *args):
+        pass
+
+# Serve the metrics at http://address:port/metrics from a background thread.
+def serve(port, address='127.0.0.1'):
+    server = http.server.ThreadingHTTPServer((address, port), MetricsHandler)
+    server.daemon_threads = True
+
+    thread = threading.Thread(target=server.serve_forever, name='metrics', daemon=True)
+    thread.start()
+
+    logging.info('serving metrics on {}:{}'.format(address, port))
+
+    return server
+
+# Profiles the thread that turns it on, switched on and off by a signal. When it's switched off,
+# the stats collected are dumped to a file, for a look with pstats or snakeviz.
+class Profiler:
+    def __init__(self, path):
+        self.path = path
+        self.profile = None
+
+    def toggle(self, signum=None, frame=None):
+        if self.profile is None:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+            logging.info('profiling started')
+        else:
+            self.profile.disable()
+            self.profile.dump_stats(self.path)
+            self.profile = None
+            logging.info('profiling stopped, stats written to {}'.format(self.path))
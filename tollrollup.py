@@ -0,0 +1,243 @@
+#!/usr/bin/python3
+
+# Hourly and daily statistics for each trip's tolls and travel times, kept in the rollup tables,
+# along with how many minutes of each hour and day the toll spent at each price.
+#
+# The writer keeps them up to date as it goes: whenever it inserts a series, or extends one, the
+# minutes that are new are added to the hours and days they fall in, in the same transaction. Run
+# as a script, this (re)builds them from the history already in the log tables:
+#
+#   ./tollrollup.py --user root                      everything
+#   ./tollrollup.py --user root --since 2024-01-01   from the start of that day on
+#
+# The rebuild locks the tables it reads and writes, so the logger's writer waits for it to finish
+# (the logger carries on spooling in the meantime).
+
+import argparse, logging, os, sys
+import mysql.connector
+from datetime import datetime
+from datetime import timedelta
+from decimal import Decimal
+
+# The periods we keep statistics for.
+PERIODS = {'H':timedelta(hours=1), 'D':timedelta(days=1)}
+
+# A price, from the database or a spooled row. Spooled prices are JSON floats, so going by their
+# string keeps 4.35 from adding up as 4.3499999...
+def price_value(value):
+    return Decimal(str(value))
+
+# The log tables that have rollups, the columns that add up to the value for each minute, and the
+# rollup table with its columns for the total, lowest and highest values. The tolls also have a
+# table of the minutes at each price.
+ROLLUPS = {
+    'toll_log':{
+        'values':('price_495', 'price_95'),
+        'type':price_value,
+        'start':'toll_start_date',
+        'end':'toll_end_date',
+        'table':'toll_rollup',
+        'total':'price_total',
+        'min':'price_min',
+        'max':'price_max',
+        'histogram':'toll_price_rollup',
+        'value':'price',
+    },
+    'time_log':{
+        'values':('time_495', 'time_95'),
+        'type':int,
+        'start':'time_start_date',
+        'end':'time_end_date',
+        'table':'time_rollup',
+        'total':'time_total',
+        'min':'time_min',
+        'max':'time_max',
+    },
+}
+
+# Adds a batch of statistics to what's already there.
+UPSERT_SQL = '''
+    INSERT
+      INTO {table} (ramp_on, ramp_off, period, period_start, minutes, {total}, {min}, {max})
+      VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+      ON DUPLICATE KEY UPDATE
+        minutes = minutes + VALUES(minutes),
+        {total} = {total} + VALUES({total}),
+        {min} = LEAST({min}, VALUES({min})),
+        {max} = GREATEST({max}, VALUES({max}))
+'''
+
+# Adds a batch of minutes at each value to what's already there.
+HISTOGRAM_SQL = '''
+    INSERT
+      INTO {histogram} (ramp_on, ramp_off, period, period_start, {value}, minutes)
+      VALUES (%s, %s, %s, %s, %s, %s)
+      ON DUPLICATE KEY UPDATE
+        minutes = minutes + VALUES(minutes)
+'''
+
+# How many rows of statistics to write in one statement when rebuilding.
+WRITE_CHUNK = 5000
+
+# The dates in a spooled row are strings.
+def as_date(value):
+    if isinstance(value, datetime):
+        return value
+
+    return datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+
+# The value of a row for a minute: its columns added up, treating an empty one as zero.
+def row_value(table, row):
+    rollup = ROLLUPS[table]
+
+    return sum((rollup['type'](row[column]) for column in rollup['values'] if row[column] is not None),
+        rollup['type'](0))
+
+def period_start(date, period):
+    if period == 'H':
+        return date.replace(minute=0, second=0, microsecond=0)
+
+    return date.replace(hour=0, minute=0, second=0, microsecond=0)
+
+# Add the minutes from first to last (both included) at value, for a trip, to a set of statistics:
+# (ramp_on, ramp_off, period, period start) -> [minutes, total, lowest, highest, {value:minutes}].
+def add_span(stats, trip, first, last, value):
+    for period, length in PERIODS.items():
+        start = period_start(first, period)
+
+        while start <= last:
+            end = start + length
+            minutes = int((min(last, end - timedelta(minutes=1)) - max(first, start)) // timedelta(minutes=1)) + 1
+
+            key = trip + (period, start)
+            entry = stats.get(key)
+
+            if entry is None:
+                stats[key] = [minutes, value * minutes, value, value, {value:minutes}]
+            else:
+                entry[0] += minutes
+                entry[1] += value * minutes
+                entry[2] = min(entry[2], value)
+                entry[3] = max(entry[3], value)
+                entry[4][value] = entry[4].get(value, 0) + minutes
+
+            start = end
+
+# The minutes a series row adds, given where it ended before (None for a new series), as a
+# statistics span, added to stats.
+def add_row(stats, table, row, old_end=None):
+    rollup = ROLLUPS[table]
+    end = as_date(row[rollup['end']])
+
+    if old_end is None:
+        first = as_date(row[rollup['start']])
+    else:
+        first = as_date(old_end) + timedelta(minutes=1)
+
+    if first <= end:
+        add_span(stats, (row['ramp_on'], row['ramp_off']), first, end, row_value(table, row))
+
+# Add a set of statistics to a log table's rollup tables. Returns the number of statements it took.
+def write(curs, table, stats):
+    rollup = ROLLUPS[table]
+    statements = 0
+
+    writes = [(UPSERT_SQL.format(**rollup), [key + tuple(entry[:4]) for key, entry in stats.items()])]
+
+    if 'histogram' in rollup:
+        writes.append((HISTOGRAM_SQL.format(**rollup),
+            [key + (value, minutes) for key, entry in stats.items() for value, minutes in entry[4].items()]))
+
+    for sql, rows in writes:
+        for chunk in range(0, len(rows), WRITE_CHUNK):
+            curs.executemany(sql, rows[chunk:chunk + WRITE_CHUNK])
+            statements += 1
+
+    return statements
+
+# Rebuild the rollups from the history in the log tables, from the start of the day since falls in
+# (or from the beginning, if since is None).
+def rebuild(conn, since=None):
+    curs = conn.cursor()
+    since = period_start(since, 'D') if since is not None else datetime(1970, 1, 1)
+
+    rollup_tables = [rollup[kind] for rollup in ROLLUPS.values() for kind in ('table', 'histogram') if kind in rollup]
+    tables = ', '.join(['{} READ'.format(table) for table in ROLLUPS] +
+        ['{} WRITE'.format(rollup_table) for rollup_table in rollup_tables])
+
+    curs.execute('SET autocommit = 0')
+    curs.execute('LOCK TABLES ' + tables)
+
+    try:
+        for table, rollup in ROLLUPS.items():
+            for kind in ('table', 'histogram'):
+                if kind in rollup:
+                    curs.execute('DELETE FROM {} WHERE period_start >= %s'.format(rollup[kind]), (since,))
+
+            curs.execute('''
+                SELECT ramp_on, ramp_off, {start}, {end}, {values}
+                  FROM {table}
+                  WHERE {end} >= %s
+            '''.format(start=rollup['start'], end=rollup['end'], values=', '.join(rollup['values']), table=table),
+                (since,))
+
+            columns = curs.column_names
+            stats = {}
+            series = 0
+
+            # Read the series a chunk at a time; it's the statistics we need to hold on to, not them.
+            while True:
+                chunk = curs.fetchmany(WRITE_CHUNK)
+
+                if not chunk:
+                    break
+
+                for values in chunk:
+                    row = dict(zip(columns, values))
+                    # Leave out whatever came before since.
+                    old_end = since - timedelta(minutes=1) if row[rollup['start']] < since else None
+                    add_row(stats, table, row, old_end)
+                    series += 1
+
+            write(curs, table, stats)
+            logging.info('rebuilt {} from {} series in {}'.format(rollup['table'], series, table))
+
+        conn.commit()
+    except:
+        conn.rollback()
+        raise
+    finally:
+        curs.execute('UNLOCK TABLES')
+        curs.close()
+
+def main():
+    parser = argparse.ArgumentParser(description='Rebuild the hourly and daily toll and travel time statistics.')
+    parser.add_argument('--since', type=lambda value: datetime.strptime(value, '%Y-%m-%d'),
+        help='rebuild from the start of this day (YYYY-MM-DD) on, rather than from the beginning')
+    parser.add_argument('--user', default=os.environ.get('USER'))
+    parser.add_argument('--password')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--database', default='tolls')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s:%(levelname)s:%(message)s', level=logging.INFO)
+
+    connect_args = {'user':args.user, 'host':args.host, 'database':args.database}
+    if args.password is not None: connect_args['password'] = args.password
+
+    try:
+        conn = mysql.connector.connect(**connect_args)
+    except Exception as e:
+        logging.critical('Unable to connect to the database: {}'.format(str(e)))
+        sys.exit(1)
+
+    try:
+        rebuild(conn, args.since)
+    except Exception as e:
+        logging.critical('Rebuild failed: {}'.format(str(e)))
+        sys.exit(1)
+    finally:
+        conn.close()
+
+if __name__ == '__main__':
+    main()
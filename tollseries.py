@@ -0,0 +1,239 @@
+import collections, logging, os
+
+import numpy as np
+
+# The layout of a series file: a header of little-endian int64s (the version of the layout, the
+# capacity, how many values have ever been added, and the minute of the latest value, in minutes
+# since the epoch), followed by the buffer, as little-endian float64s.
+FILE_VERSION = 1
+HEADER_FIELDS = 4
+HEADER_SIZE = HEADER_FIELDS * 8
+
+# The minute of the latest value, in a file header, when there isn't one.
+NO_MINUTE = -1
+
+# The last so many minutes of a value (a toll price, say), one per minute, in a fixed amount of
+# memory. Adding a minute is O(1), and so is finding the lowest and highest values in the window,
+# which are kept up to date as values come and go. Minutes we don't have a value for are NaN,
+# and don't count towards the lowest or highest.
+#
+# Given a path, the series is kept in a memory-mapped file there, so that it survives a restart:
+# the next time, it picks up where it left off, and whoever's filling it only has to fill in the
+# minutes since. A file that isn't one of ours, or was for a different capacity, is started over.
+class TollSeries:
+    def __init__(self, capacity, path=None):
+        self.capacity = capacity
+        self.path = path
+        self.map = None
+        # How many values have ever been added; the next one goes in at count % capacity.
+        self.count = 0
+        # The minute of the latest value, in minutes since the epoch, if we know it.
+        self.minute = None
+
+        if path is not None:
+            self.open(path)
+        else:
+            # Every value is written twice, capacity apart, so that the window is always one
+            # contiguous slice of the buffer, whichever way round the ring is.
+            self.buffer = np.full(capacity * 2, np.nan)
+
+        # The candidates for the lowest and highest values in the window, as (number, value),
+        # oldest first. The lows only ever go up from front to back, and the highs only go down,
+        # so the front of each is the answer.
+        self.lows = collections.deque()
+        self.highs = collections.deque()
+
+        self.rebuild()
+
+    # Map the series file, starting it over unless it holds a series like this one.
+    def open(self, path):
+        size = HEADER_SIZE + self.capacity * 2 * 8
+        header = None
+
+        try:
+            if os.path.getsize(path) == size:
+                header = np.fromfile(path, dtype='<i8', count=HEADER_FIELDS)
+        except OSError:
+            pass
+
+        if header is None or header[0] != FILE_VERSION or header[1] != self.capacity:
+            if header is not None:
+                logging.warning('starting over with the series in {}'.format(path))
+
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+            with open(path, 'wb') as series_file:
+                series_file.write(np.array([FILE_VERSION, self.capacity, 0, NO_MINUTE], dtype='<i8').tobytes())
+                series_file.write(np.full(self.capacity * 2, np.nan, dtype='<f8').tobytes())
+
+        self.map = np.memmap(path, dtype=np.uint8, mode='r+')
+        self.header = self.map[:HEADER_SIZE].view('<i8')
+        self.buffer = self.map[HEADER_SIZE:].view('<f8')
+
+        self.count = int(self.header[2])
+        self.minute = int(self.header[3]) if self.header[3] != NO_MINUTE else None
+
+    # Write what's changed out to the file, if there is one.
+    def sync(self):
+        if self.map is not None:
+            self.header[2] = self.count
+            self.header[3] = self.minute if self.minute is not None else NO_MINUTE
+            self.map.flush()
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    # Add the value for the next minute, pushing the oldest one out if the window is full. None
+    # means we don't have a value. Given the minute it's for, any minutes skipped since the latest
+    # value are added first, as values we don't have; the same minute again replaces its value.
+    def push(self, value, minute=None):
+        value = np.nan if value is None else float(value)
+
+        if minute is not None and self.minute is not None:
+            if minute <= self.minute and self.count > 0:
+                position = (self.count - 1) % self.capacity
+                self.buffer[position] = value
+                self.buffer[position + self.capacity] = value
+
+                self.rebuild()
+                self.sync()
+                return
+
+            if minute > self.minute + 1:
+                self.extend(np.full(min(minute - self.minute - 1, self.capacity), np.nan), minute - 1)
+
+        number = self.count
+        position = number % self.capacity
+
+        self.buffer[position] = value
+        self.buffer[position + self.capacity] = value
+        self.count += 1
+
+        if minute is not None:
+            self.minute = minute
+        elif self.minute is not None:
+            self.minute += 1
+
+        if not np.isnan(value):
+            while self.lows and self.lows[-1][1] >= value:
+                self.lows.pop()
+            self.lows.append((number, value))
+
+            while self.highs and self.highs[-1][1] <= value:
+                self.highs.pop()
+            self.highs.append((number, value))
+
+        # Let go of the candidates that have left the window.
+        oldest = self.count - self.capacity
+
+        while self.lows and self.lows[0][0] < oldest:
+            self.lows.popleft()
+
+        while self.highs and self.highs[0][0] < oldest:
+            self.highs.popleft()
+
+        self.sync()
+
+    # Add a run of values, oldest first, all at once (like a history fetched from the web service),
+    # optionally with the minute of the last one.
+    def extend(self, values, minute=None):
+        values = np.asarray(values, dtype=float)
+        added = len(values)
+        values = values[-self.capacity:]
+
+        if added == 0:
+            return
+
+        # Lay the last capacity values out as the window, as if they'd been pushed one at a time.
+        window = np.concatenate((self.values(), values))[-self.capacity:]
+        self.count += added
+        first = self.count - len(window)
+
+        positions = np.arange(first, self.count) % self.capacity
+        self.buffer[positions] = window
+        self.buffer[positions + self.capacity] = window
+
+        if minute is not None:
+            self.minute = minute
+        elif self.minute is not None:
+            self.minute += added
+
+        self.rebuild()
+        self.sync()
+
+    # Fill in a run of values, oldest first, the last one for the given minute (like a history
+    # fetched from the web service while we've been adding the minutes as they come). Values only
+    # go in for minutes we don't have one for, whether they're before, among or after the ones we
+    # have; any minutes in between that neither has are ones we don't have.
+    def fill(self, values, minute):
+        values = np.asarray(values, dtype=float)
+
+        if self.minute is None:
+            self.extend(values, minute)
+            return
+
+        # Lay out the window as it'll be, by minute, from the oldest minute either of them has
+        # (as far back as the window goes) up to the latest.
+        latest = max(minute, self.minute)
+        have = self.values()
+        oldest = max(min(self.minute - len(have), minute - len(values)) + 1, latest - self.capacity + 1)
+        window = np.full(latest - oldest + 1, np.nan)
+
+        for run, last in ((have, self.minute), (values, minute)):
+            run = run[max(oldest - (last - len(run) + 1), 0):]
+            if len(run) == 0:
+                continue
+            start = last - len(run) + 1 - oldest
+            span = window[start:start + len(run)]
+            span[np.isnan(span)] = run[np.isnan(span)]
+
+        # The minutes after the latest we had are added to the count; ones before the oldest we
+        # had only fit if the window wasn't full.
+        self.count = max(self.count + latest - self.minute, len(window))
+        self.minute = latest
+
+        positions = np.arange(self.count - len(window), self.count) % self.capacity
+        self.buffer[positions] = window
+        self.buffer[positions + self.capacity] = window
+
+        self.rebuild()
+        self.sync()
+
+    # Start the candidates for the lowest and highest values over from the window.
+    def rebuild(self):
+        self.lows.clear()
+        self.highs.clear()
+
+        for number, value in zip(range(self.count - len(self), self.count), self.values().tolist()):
+            if value != value:
+                continue
+
+            while self.lows and self.lows[-1][1] >= value:
+                self.lows.pop()
+            self.lows.append((number, value))
+
+            while self.highs and self.highs[-1][1] <= value:
+                self.highs.pop()
+            self.highs.append((number, value))
+
+    # The values in the window, oldest first, as a view (not a copy) of the buffer.
+    def values(self):
+        start = self.count % self.capacity if self.count >= self.capacity else 0
+
+        return self.buffer[start:start + len(self)]
+
+    # The most recent value, or None if we don't have one for the last minute.
+    def latest(self):
+        if self.count == 0:
+            return None
+
+        value = self.buffer[(self.count - 1) % self.capacity]
+
+        return None if np.isnan(value) else float(value)
+
+    # The lowest and highest values in the window, or None if there aren't any.
+    def min(self):
+        return self.lows[0][1] if self.lows else None
+
+    def max(self):
+        return self.highs[0][1] if self.highs else None
@@ -0,0 +1,557 @@
+import mysql.connector, tollmetrics, tollrollup
+import json, logging, os, random, threading
+from datetime import datetime
+from decimal import Decimal
+
+# The log tables, and how to write them.
+#
+# The toll, time and reversible lanes tables hold series: runs of identical values, with a start
+# and end date. Every tick, the logger hands us a row for each series it's tracking, flagged as
+# new if it starts a series. The writer works out whether to insert it or extend a series it (or
+# an earlier run of the logger) already wrote. A series is identified by its trip's ramps and its
+# start date.
+LOG_TABLES = {
+    'toll_log':{
+        'columns':('ramp_on', 'ramp_off', 'direction', 'toll_start_date', 'toll_end_date',
+            'price_495', 'price_95'),
+        'id':'toll_log_id',
+        'trip':('ramp_on', 'ramp_off'),
+        'start':'toll_start_date',
+        'end':'toll_end_date',
+        'insert':'''
+            INSERT
+              INTO toll_log (toll_start_date, toll_end_date, ramp_on, ramp_off, direction,
+                  price_495, price_95)
+              VALUES (%(toll_start_date)s, %(toll_end_date)s, %(ramp_on)s, %(ramp_off)s, %(direction)s,
+                %(price_495)s, %(price_95)s)
+        ''',
+        'find':'''
+            SELECT toll_log_id, toll_end_date
+              FROM toll_log
+              WHERE ramp_on = %(ramp_on)s
+                AND ramp_off = %(ramp_off)s
+                AND toll_start_date = %(toll_start_date)s
+              ORDER BY toll_end_date DESC
+              LIMIT 1
+        ''',
+    },
+    'time_log':{
+        'columns':('ramp_on', 'ramp_off', 'direction', 'time_start_date', 'time_end_date',
+            'time_495', 'time_95'),
+        'id':'time_log_id',
+        'trip':('ramp_on', 'ramp_off'),
+        'start':'time_start_date',
+        'end':'time_end_date',
+        'insert':'''
+            INSERT
+              INTO time_log (time_start_date, time_end_date, ramp_on, ramp_off, direction,
+                  time_495, time_95)
+              VALUES (%(time_start_date)s, %(time_end_date)s, %(ramp_on)s, %(ramp_off)s, %(direction)s,
+                %(time_495)s, %(time_95)s)
+        ''',
+        'find':'''
+            SELECT time_log_id, time_end_date
+              FROM time_log
+              WHERE ramp_on = %(ramp_on)s
+                AND ramp_off = %(ramp_off)s
+                AND time_start_date = %(time_start_date)s
+              ORDER BY time_end_date DESC
+              LIMIT 1
+        ''',
+    },
+    'reversible_log':{
+        'columns':('reversible_start_date', 'reversible_end_date', 'status_code'),
+        'id':'reversible_log_id',
+        'trip':(),
+        'start':'reversible_start_date',
+        'end':'reversible_end_date',
+        'insert':'''
+            INSERT
+              INTO reversible_log (reversible_start_date, reversible_end_date, status_code)
+              VALUES (%(reversible_start_date)s, %(reversible_end_date)s, %(status_code)s)
+        ''',
+        'find':'''
+            SELECT reversible_log_id, reversible_end_date
+              FROM reversible_log
+              WHERE reversible_start_date = %(reversible_start_date)s
+              ORDER BY reversible_end_date DESC
+              LIMIT 1
+        ''',
+    },
+    'error_log':{
+        'columns':('error_log_date', 'ramp_on', 'ramp_off', 'error_text'),
+        'insert':'''
+            INSERT
+              INTO error_log (error_log_date, ramp_on, ramp_off, error_text)
+              VALUES (%(error_log_date)s, %(ramp_on)s, %(ramp_off)s, %(error_text)s)
+        ''',
+    },
+}
+
+# The tables that hold series.
+SERIES_TABLES = [table for table in LOG_TABLES if 'id' in LOG_TABLES[table]]
+
+# Extending series sets each one's end date to its own value, all in one statement.
+UPDATE_SQL = '''
+    UPDATE {table}
+      SET {end} = CASE {id} {cases} END
+      WHERE {id} IN ({ids})
+'''
+
+CHECKPOINT_SQL = '''
+    INSERT
+      INTO spool_checkpoint (spool_name, spool_seq)
+      VALUES (%(spool_name)s, %(spool_seq)s)
+      ON DUPLICATE KEY UPDATE spool_seq = VALUES(spool_seq)
+'''
+
+# Where the series we were given the ids of ended, before we extend them.
+ENDS_SQL = '''
+    SELECT {id}, {end}
+      FROM {table}
+      WHERE {id} IN ({ids})
+'''
+
+# The most spooled ticks we'll write to the database in one transaction when catching up.
+MAX_FLUSH_RECORDS = 1000
+
+# How big, in bytes, we'll let the spool get before starting it over, once it's all been written.
+COMPACT_SIZE = 1024 * 1024
+
+DB_STATEMENT_SECONDS = tollmetrics.histogram('tolls_db_statement_seconds',
+    'Time taken by each statement the writer runs against the database.')
+DB_STATEMENTS = tollmetrics.counter('tolls_db_statements_total', 'Statements run against the database.')
+DB_FLUSHES = tollmetrics.counter('tolls_db_flushes_total', 'Transactions written to the database.')
+DB_FAILURES = tollmetrics.counter('tolls_db_failures_total', 'Failed attempts to write to the database.')
+ROWS_INSERTED = tollmetrics.counter('tolls_rows_inserted_total', 'Rows inserted, i.e. new series.')
+ROWS_EXTENDED = tollmetrics.counter('tolls_rows_extended_total', 'Existing series extended.')
+SPOOL_PENDING = tollmetrics.gauge('tolls_spool_pending_batches', 'Ticks spooled but not yet written to the database.')
+
+# A new, empty batch of changes to the log tables for a tick.
+def new_batch():
+    return {table:[] for table in LOG_TABLES}
+
+# Add a row to a batch. For a series table, new says whether the row starts a new series. If we
+# already know the id of the series the row belongs to (because we picked it up from the database
+# at startup), pass it along, and the writer won't have to look for it.
+def add_row(batch, table, values, new=False):
+    row = {column:values.get(column) for column in LOG_TABLES[table]['columns']}
+
+    if table in SERIES_TABLES:
+        row['new'] = new
+
+        if values.get(LOG_TABLES[table]['id']) is not None:
+            row['id'] = values[LOG_TABLES[table]['id']]
+
+    batch[table].append(row)
+
+# How dates and prices go into the spool. MariaDB is happy to take dates back as strings, and
+# strings in this format sort the same as the dates do.
+def to_json(value):
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    elif isinstance(value, Decimal):
+        return str(value)
+
+    raise TypeError('cannot spool a {}'.format(type(value).__name__))
+
+# An append-only journal of the batches the logger has produced, kept on local disk until the
+# writer has committed them to the database. Each line is one batch, tagged with a sequence
+# number. The sequence number of the last batch committed is kept in the database, in the same
+# transaction as the batch, so that replaying the journal after a crash never writes a batch twice.
+# Once a batch is committed, a line acknowledging it is added too; the file is only started over
+# when it's grown past COMPACT_SIZE with nothing left in it to write.
+#
+# A spool that's started without a file (the first time, or after a reboot, since it lives in
+# /var/run) doesn't know where the database's sequence numbers are up to. Until it's anchored to
+# the checkpoint in the database, its batches are numbered from 0, and the first line of the file
+# says so; when the writer connects, they're numbered again from after the checkpoint.
+class Spool:
+    def __init__(self, path, name='tollogger'):
+        self.path = path
+        self.name = name
+        self.lock = threading.Lock()
+        # The batches that haven't been committed to the database yet, oldest first.
+        self.pending = []
+        self.seq = 0
+        # Whether our sequence numbers follow on from the database's checkpoint.
+        self.anchored = True
+
+        # Pick up whatever a previous run left behind.
+        if os.path.exists(path):
+            with open(path, 'r') as spool_file:
+                for line in spool_file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A batch that was only partly written when we went down. It was never
+                        # acknowledged, so there's nothing to recover from it.
+                        logging.warning('skipping damaged record in spool {}'.format(path))
+                        continue
+
+                    if 'ack' in record:
+                        self.pending = [pending for pending in self.pending if pending['seq'] > record['ack']]
+                        continue
+
+                    self.seq = max(self.seq, record['seq'])
+
+                    if record.get('anchored') is False:
+                        self.anchored = False
+
+                    if 'batch' in record:
+                        self.pending.append(record)
+
+            logging.info('spool {} has {} pending batches'.format(path, len(self.pending)))
+
+            self.spool_file = open(path, 'a')
+
+            # Don't let a partly written last line run into the next batch we add.
+            if self.spool_file.tell() > 0:
+                with open(path, 'rb') as spool_file:
+                    spool_file.seek(-1, os.SEEK_END)
+
+                    if spool_file.read(1) != b'\n':
+                        self.spool_file.write('\n')
+        else:
+            self.anchored = False
+            self.spool_file = None
+            self.rewrite()
+
+    # Start the file over with just what's pending, after a line with where the sequence numbers
+    # are up to. The caller has to be holding the lock (or be the constructor).
+    def rewrite(self):
+        temp_path = self.path + '.tmp'
+        header = {'seq':self.seq} if self.anchored else {'seq':self.seq, 'anchored':False}
+
+        with open(temp_path, 'w') as temp_file:
+            temp_file.write(json.dumps(header) + '\n')
+
+            for record in self.pending:
+                temp_file.write(json.dumps(record) + '\n')
+
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+
+        os.replace(temp_path, self.path)
+
+        if self.spool_file is not None:
+            self.spool_file.close()
+
+        self.spool_file = open(self.path, 'a')
+
+    # Durably add a batch to the end of the spool.
+    def append(self, batch):
+        with self.lock:
+            self.seq += 1
+            line = json.dumps({'seq':self.seq, 'batch':batch}, default=to_json)
+
+            self.spool_file.write(line + '\n')
+            self.spool_file.flush()
+            os.fsync(self.spool_file.fileno())
+
+            # Keep the same form of the batch in memory as we'd read back from the file.
+            self.pending.append(json.loads(line))
+
+    # The oldest batches that haven't been committed yet.
+    def peek(self, limit):
+        with self.lock:
+            return self.pending[:limit]
+
+    def __len__(self):
+        with self.lock:
+            return len(self.pending)
+
+    # Line the spool up with the last batch the database has committed, checkpoint (0 if it
+    # hasn't committed any). If our sequence numbers are our own, what's pending is numbered again
+    # from after the checkpoint, so none of it is taken for a batch that's already been written.
+    def anchor(self, checkpoint):
+        with self.lock:
+            if self.anchored:
+                self.forget(checkpoint)
+                return
+
+            for offset, record in enumerate(self.pending):
+                record['seq'] = checkpoint + 1 + offset
+
+            self.seq = checkpoint + len(self.pending)
+            self.anchored = True
+            self.rewrite()
+
+    # Forget the batches up to and including seq; they've been committed. The database has the
+    # checkpoint, so the line saying so doesn't have to be synced to disk right away.
+    def acknowledge(self, seq):
+        with self.lock:
+            self.forget(seq)
+
+    # The caller has to be holding the lock.
+    def forget(self, seq):
+        self.pending = [record for record in self.pending if record['seq'] > seq]
+
+        if len(self.pending) == 0 and self.spool_file.tell() > COMPACT_SIZE:
+            self.rewrite()
+        else:
+            self.spool_file.write(json.dumps({'ack':seq}) + '\n')
+            self.spool_file.flush()
+
+    def close(self):
+        with self.lock:
+            self.spool_file.close()
+
+# Writes the batches in a spool to the database from a background thread, so the logger never
+# waits on the database. If the database goes away, the batches pile up in the spool, and once it
+# comes back they're written out in a few large transactions.
+class Writer:
+    def __init__(self, spool, connect_args, retry_delay=5, max_retry_delay=60):
+        self.spool = spool
+        self.connect_args = connect_args
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+
+        self.conn = None
+        self.curs = None
+
+        # For each series table, the series we last wrote for each trip: trip -> (start date, id, end date).
+        self.series = {table:{} for table in SERIES_TABLES}
+
+        self.wake = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='spool-writer', daemon=True)
+
+    # Connect to the database, and skip any spooled batches it already has.
+    def connect(self):
+        self.conn = mysql.connector.connect(autocommit=False, **self.connect_args)
+        self.curs = self.conn.cursor()
+        logging.info('connected to database')
+
+        self.curs.execute('SELECT spool_seq FROM spool_checkpoint WHERE spool_name = %s', (self.spool.name,))
+        rows = self.curs.fetchall()
+        self.conn.rollback()
+
+        self.spool.anchor(rows[0][0] if rows else 0)
+
+    def disconnect(self):
+        for resource in (self.curs, self.conn):
+            if resource is not None:
+                try:
+                    resource.close()
+                except:
+                    pass
+
+        self.conn = None
+        self.curs = None
+
+    # Merge the rows for the same series across a set of batches, keeping the latest end date.
+    def coalesce(self, records):
+        series = {table:{} for table in SERIES_TABLES}
+        errors = []
+
+        for record in records:
+            batch = record['batch']
+
+            for table in SERIES_TABLES:
+                sql = LOG_TABLES[table]
+
+                for row in batch[table]:
+                    key = tuple(row[column] for column in sql['trip'] + (sql['start'],))
+                    merged = series[table].get(key)
+
+                    if merged is None:
+                        series[table][key] = dict(row)
+                    else:
+                        if row[sql['end']] > merged[sql['end']]:
+                            merged[sql['end']] = row[sql['end']]
+                        merged['new'] = merged['new'] or row['new']
+                        merged.setdefault('id', row.get('id'))
+
+            errors.extend(batch['error_log'])
+
+        return series, errors
+
+    # Find the id of each series row, and where the series ended before this row extends it; either
+    # one we've written, one we were told, or one that's already in the database. Rows for series
+    # that aren't in the database yet are left without.
+    def resolve(self, table, rows):
+        sql = LOG_TABLES[table]
+        # Rows we were given the id of, but (for the rollups) still need the old end date of.
+        hinted = {}
+
+        for row in rows:
+            trip = tuple(row[column] for column in sql['trip'])
+            known = self.series[table].get(trip)
+
+            if known is not None and known[0] == row[sql['start']]:
+                row['id'] = known[1]
+                row['old_end'] = known[2]
+            elif row.get('id') is not None:
+                if table in tollrollup.ROLLUPS: hinted[row['id']] = row
+            elif not row['new']:
+                # This extends a series from before we (re)started. Go find it.
+                with DB_STATEMENT_SECONDS.time(table=table, statement='find'):
+                    self.curs.execute(sql['find'], row)
+                    found = self.curs.fetchall()
+                DB_STATEMENTS.inc()
+
+                if found:
+                    row['id'], row['old_end'] = found[0]
+
+        if len(hinted) > 0:
+            with DB_STATEMENT_SECONDS.time(table=table, statement='ends'):
+                self.curs.execute(ENDS_SQL.format(table=table, id=sql['id'], end=sql['end'],
+                    ids=', '.join(['%s'] * len(hinted))), list(hinted))
+                found = self.curs.fetchall()
+            DB_STATEMENTS.inc()
+
+            for series_id, end in found:
+                hinted[series_id]['old_end'] = end
+
+    # Write a set of spooled batches to the database in a single transaction.
+    def flush(self, records):
+        series, errors = self.coalesce(records)
+        statements = 0
+        written = {}
+        counts = {}
+
+        try:
+            for table in SERIES_TABLES:
+                sql = LOG_TABLES[table]
+                rows = list(series[table].values())
+
+                self.resolve(table, rows)
+
+                updates = [row for row in rows if row.get('id') is not None]
+                inserts = [row for row in rows if row.get('id') is None]
+
+                if len(updates) > 0:
+                    cases = ' '.join(['WHEN %s THEN %s'] * len(updates))
+                    ids = ', '.join(['%s'] * len(updates))
+                    args = [value for row in updates for value in (row['id'], row[sql['end']])]
+                    args += [row['id'] for row in updates]
+
+                    with DB_STATEMENT_SECONDS.time(table=table, statement='update'):
+                        self.curs.execute(UPDATE_SQL.format(table=table, end=sql['end'], id=sql['id'],
+                            cases=cases, ids=ids), args)
+                    statements += 1
+
+                if len(inserts) > 0:
+                    # The connector sends this as a single multi-row INSERT. Its ids are consecutive,
+                    # starting from the one the cursor reports (which holds for
+                    # innodb_autoinc_lock_mode 0 or 1, the MariaDB default).
+                    with DB_STATEMENT_SECONDS.time(table=table, statement='insert'):
+                        self.curs.executemany(sql['insert'], inserts)
+                    statements += 1
+
+                    for offset, row in enumerate(inserts):
+                        row['id'] = self.curs.lastrowid + offset
+
+                # Add the minutes the new and extended series cover to the hourly and daily
+                # statistics. A series we couldn't find the old end of is left out of them.
+                if table in tollrollup.ROLLUPS:
+                    stats = {}
+
+                    for row in inserts:
+                        tollrollup.add_row(stats, table, row)
+
+                    for row in updates:
+                        if row.get('old_end') is not None:
+                            tollrollup.add_row(stats, table, row, row['old_end'])
+
+                    if len(stats) > 0:
+                        with DB_STATEMENT_SECONDS.time(table=tollrollup.ROLLUPS[table]['table'], statement='upsert'):
+                            statements += tollrollup.write(self.curs, table, stats)
+
+                written[table] = rows
+                counts[table] = (len(inserts), len(updates))
+
+            if len(errors) > 0:
+                with DB_STATEMENT_SECONDS.time(table='error_log', statement='insert'):
+                    self.curs.executemany(LOG_TABLES['error_log']['insert'], errors)
+                statements += 1
+                counts['error_log'] = (len(errors), 0)
+
+            with DB_STATEMENT_SECONDS.time(table='spool_checkpoint', statement='update'):
+                self.curs.execute(CHECKPOINT_SQL, {'spool_name':self.spool.name, 'spool_seq':records[-1]['seq']})
+            with DB_STATEMENT_SECONDS.time(table='', statement='commit'):
+                self.conn.commit()
+            statements += 2
+        except:
+            DB_FAILURES.inc()
+
+            try:
+                self.conn.rollback()
+            except:
+                pass
+
+            raise
+
+        # Now that they're committed, remember which series we've written for each trip.
+        for table, rows in written.items():
+            sql = LOG_TABLES[table]
+
+            for row in rows:
+                trip = tuple(row[column] for column in sql['trip'])
+                known = self.series[table].get(trip)
+
+                if known is None or row[sql['start']] >= known[0]:
+                    self.series[table][trip] = (row[sql['start']], row['id'], row[sql['end']])
+
+        self.spool.acknowledge(records[-1]['seq'])
+
+        DB_STATEMENTS.inc(statements)
+        DB_FLUSHES.inc()
+        SPOOL_PENDING.set(len(self.spool))
+
+        for table, (inserted, extended) in counts.items():
+            ROWS_INSERTED.inc(inserted, table=table)
+            ROWS_EXTENDED.inc(extended, table=table)
+
+        logging.info('wrote {} spooled batches in {} statements'.format(len(records), statements))
+
+        return statements
+
+    # Write everything that's spooled, connecting first if need be. Returns the number of
+    # statements it took.
+    def drain(self):
+        statements = 0
+
+        if self.conn is None:
+            self.connect()
+
+        while True:
+            records = self.spool.peek(MAX_FLUSH_RECORDS)
+
+            if len(records) == 0:
+                break
+
+            statements += self.flush(records)
+
+        return statements
+
+    def run(self):
+        backoff = self.retry_delay
+        delay = backoff
+
+        while True:
+            # Wait until there's something new to write, or it's time to try the database again.
+            self.wake.wait(timeout=delay if len(self.spool) > 0 else None)
+            self.wake.clear()
+
+            try:
+                self.drain()
+                backoff = self.retry_delay
+                delay = backoff
+            except Exception as e:
+                logging.error('write to database failed, {} batches spooled: {}'.format(len(self.spool), str(e)))
+                self.disconnect()
+
+                # Back off, with jitter, until the database comes back.
+                backoff = min(backoff * 2, self.max_retry_delay)
+                delay = backoff * random.uniform(0.5, 1)
+
+    def start(self):
+        self.thread.start()
+
+    # Spool a tick's batch and let the writer know it's there.
+    def write(self, batch):
+        self.spool.append(batch)
+        self.wake.set()
+
+        SPOOL_PENDING.set(len(self.spool))
@@ -9,6 +9,11 @@ setup(
     install_requires=[
         'flask',
         'mysql-connector-python',
+        'numpy',
         'waitress',
     ],
+    extras_require={
+        # for drawing the toll display as a PNG
+        'display':['pillow'],
+    },
 )
@@ -1,13 +1,33 @@
 import os
 
-from flask import Flask
-
 def create_app(test_config=None):
+    # Flask is imported here, not at the top, so that other programs can use the package's drawing
+    # code (webtoll.render) without having Flask installed
+    from flask import Flask
+
     # create and configure the app
     app = Flask(__name__, instance_relative_config=True)
     app.config.from_mapping(
         DBUSER='tollreader',
         DBNAME='tolls',
+        # keep DBPOOL_SIZE in step with waitress's --threads
+        DBPOOL_SIZE=16,
+        DBPOOL_TIMEOUT=10,
+        DBPOOL_MAX_LIFETIME=3600,
+        DBPOOL_CHECK_INTERVAL=30,
+        RESPONSE_CACHE_SIZE=256,
+        RESPONSE_CACHE_VERSION_TTL=5,
+        # where the logger sends its updates, and how many live clients we'll hold threads for
+        LIVE_SOCKET='/var/run/webtoll/tollfeed.sock',
+        LIVE_MAX_SUBSCRIBERS=12,
+        LIVE_POLL_TIMEOUT=25,
+        LIVE_KEEPALIVE=15,
+        # the fonts the display is drawn in, how big we'll draw it, and how many trip and size
+        # combinations we keep a renderer for
+        DISPLAY_FONT_REGULAR='Ubuntu-R',
+        DISPLAY_FONT_BOLD='Ubuntu-B',
+        DISPLAY_MAX_SIZE=(1920, 1080),
+        DISPLAY_RENDERERS=32,
     )
 
     if test_config is None:
@@ -26,7 +46,21 @@ def create_app(test_config=None):
     from . import db
     db.init_app(app)
 
+    from . import cache
+    cache.init_app(app)
+
     from . import getdata
     app.register_blueprint(getdata.bp)
-    
+
+    from . import live
+    live.init_app(app)
+
+    # drawing the display needs Pillow, which is optional (pip install webtoll[display])
+    try:
+        from . import display
+    except ImportError as e:
+        app.logger.info('toll display not available: {}'.format(str(e)))
+    else:
+        display.init_app(app)
+
     return app
@@ -0,0 +1,44 @@
+import struct
+
+import numpy as np
+
+from flask import request
+
+# A compact, columnar alternative to JSON for the data routes, for clients that ask for it with
+# "Accept: application/vnd.webtoll.columns". Everything is little-endian:
+#
+#   header   magic "WTC1", then uint32 column count, uint32 row count, int32 origin, int32 step
+#   names    one 8 byte name per column, padded with NULs
+#   columns  one int32 array per column, row count long
+#
+# Dates are minutes since the epoch, and prices are in cents, so a client can use the columns as
+# they are, straight out of the response (say, with memoryview.cast('i')). Origin and step are for
+# evenly spaced series: the minute of the first row, and how many minutes apart the rows are.
+# Values we don't have are MISSING.
+MIMETYPE = 'application/vnd.webtoll.columns'
+
+MAGIC = b'WTC1'
+HEADER = struct.Struct('<4sIIii')
+NAME_SIZE = 8
+MISSING = -2 ** 31
+
+# Whether the client would rather have this than JSON. Without saying so, it gets JSON.
+def wanted():
+    return request.accept_mimetypes.best_match(['application/json', MIMETYPE]) == MIMETYPE
+
+# Encode columns, given as (name, values) pairs, all the same length.
+def encode(columns, origin=0, step=0):
+    arrays = [np.asarray(values, dtype='<i4') for name, values in columns]
+    rows = len(arrays[0]) if arrays else 0
+
+    parts = [HEADER.pack(MAGIC, len(columns), rows, origin, step)]
+    parts.extend(name.encode('ascii').ljust(NAME_SIZE, b'\0') for name, values in columns)
+    parts.extend(array.tobytes() for array in arrays)
+
+    return b''.join(parts)
+
+# Values in dollars as cents, with NaN for the ones we don't have.
+def cents(values):
+    values = np.asarray(values, dtype=float)
+
+    return np.where(np.isnan(values), MISSING, np.round(values * 100)).astype('<i4')
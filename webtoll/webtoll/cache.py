@@ -0,0 +1,138 @@
+import functools, hashlib, threading, time
+
+from collections import OrderedDict
+from datetime import timezone
+
+from flask import current_app, request
+
+from webtoll import binary
+from webtoll.db import get_db
+
+# Caches the responses of the data routes. The data only changes once a minute, when the logger
+# writes, but every display asks for the same windows over and over. A cached response is good
+# until the minute rolls over (the window moves) or new rows land in the tables it was built from,
+# whichever comes first. Clients that send the ETag or Last-Modified back get a 304.
+class ResponseCache:
+    def __init__(self, max_entries, version_ttl):
+        self.max_entries = max_entries
+        self.version_ttl = version_ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        # table -> (when we checked, version).
+        self.versions = {}
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is not None:
+                self.entries.move_to_end(key)
+
+            return entry
+
+    def put(self, key, entry):
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+
+            # Evict the least recently used.
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    # Where a table's data is up to: its newest row, and the newest end date in it. Either one
+    # changes whenever the logger inserts or extends a series. We only ask the database every
+    # version_ttl seconds.
+    def version(self, table, id_column, date_column):
+        now = time.monotonic()
+
+        with self.lock:
+            checked = self.versions.get(table)
+
+            if checked is not None and now - checked[0] < self.version_ttl:
+                return checked[1]
+
+        curs = get_db().cursor()
+
+        try:
+            curs.execute('SELECT MAX({}), MAX({}) FROM {}'.format(id_column, date_column, table))
+            version = curs.fetchone()
+        finally:
+            curs.close()
+
+        with self.lock:
+            self.versions[table] = (now, version)
+
+        return version
+
+# The tables the data routes read, with their id and end date columns.
+TABLES = {
+    'toll_log':('toll_log_id', 'toll_end_date'),
+    'time_log':('time_log_id', 'time_end_date'),
+    'reversible_log':('reversible_log_id', 'reversible_end_date'),
+}
+
+# Cache the responses of a route that reads the given tables and returns a JSON string (or the
+# binary encoding, as bytes, to a client that asked for it). The route's arguments, query string
+# and the client's Accept header make up the cache key. A route can return a response object
+# instead (say, a streamed one), which is passed along as is. A route that only ever returns one
+# kind of bytes (an image, say) gives its mimetype, and then every client shares the same response,
+# whatever it accepts.
+def cached(*tables, mimetype=None):
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(**kwargs):
+            cache = current_app.extensions['webtoll_cache']
+
+            key = (request.endpoint, tuple(sorted(kwargs.items())), request.query_string,
+                request.headers.get('Accept', '') if mimetype is None else mimetype)
+            minute = int(time.time() // 60)
+            versions = tuple(cache.version(table, *TABLES[table]) for table in tables)
+
+            entry = cache.get(key)
+
+            if entry is None or entry['minute'] != minute or entry['versions'] != versions:
+                body = view(**kwargs)
+
+                # Streamed responses go straight out; there's nothing to keep.
+                if not isinstance(body, (str, bytes)):
+                    return body
+
+                if isinstance(body, str):
+                    body_mimetype = 'application/json'
+                    body = body.encode('utf-8')
+                else:
+                    body_mimetype = mimetype or binary.MIMETYPE
+
+                # The newest end date in the tables is as good a last modified date as any.
+                dates = [version[1] for version in versions if version[1] is not None]
+                last_modified = max(dates).astimezone(timezone.utc) if dates else None
+
+                entry = {
+                    'body':body,
+                    'mimetype':body_mimetype,
+                    'etag':hashlib.sha1(body).hexdigest(),
+                    'last_modified':last_modified,
+                    'minute':minute,
+                    'versions':versions,
+                }
+
+                cache.put(key, entry)
+
+            response = current_app.response_class(entry['body'], mimetype=entry['mimetype'])
+            response.set_etag(entry['etag'])
+            if mimetype is None:
+                response.vary.add('Accept')
+            response.last_modified = entry['last_modified']
+
+            # Clients can hang on to it until the minute rolls over.
+            response.cache_control.max_age = 60 - int(time.time() % 60)
+
+            return response.make_conditional(request)
+
+        return wrapper
+
+    return decorator
+
+def init_app(app):
+    app.extensions['webtoll_cache'] = ResponseCache(app.config['RESPONSE_CACHE_SIZE'],
+        app.config['RESPONSE_CACHE_VERSION_TTL'])
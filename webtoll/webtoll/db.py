@@ -1,22 +1,180 @@
+import json, queue, threading, time
+
 import mysql.connector
 
 from flask import current_app, g
+from werkzeug.exceptions import abort
+
+# A pool of database connections shared by all of the threads serving requests, so that a request
+# doesn't have to pay for a new connection (and the handshake and login that go with it). Idle
+# connections that haven't been used in a while are pinged before they're handed out, and
+# connections are closed and replaced once they're older than max_lifetime, so that we don't hang
+# on to ones the server is about to time out.
+class ConnectionPool:
+    def __init__(self, connect_args, size, timeout, max_lifetime, check_interval):
+        self.connect_args = connect_args
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.check_interval = check_interval
+
+        # Idle connections, most recently used first, so the ones that go stale are the ones we don't need.
+        self.idle = queue.LifoQueue()
+        # Limits how many connections (idle or in use) we'll ever have open at once.
+        self.slots = threading.BoundedSemaphore(size)
+
+        self.lock = threading.Lock()
+        self.stats = {
+            'size':size,
+            'in_use':0,
+            'opened':0,
+            'closed':0,
+            'recycled':0,
+            'failed_checks':0,
+            'borrowed':0,
+            'waited':0,
+            'wait_seconds':0.0,
+            'timeouts':0,
+        }
+
+    def count(self, stat, amount=1):
+        with self.lock:
+            self.stats[stat] += amount
+
+    def open(self):
+        entry = {'conn':mysql.connector.connect(**self.connect_args), 'created':time.monotonic()}
+        entry['used'] = entry['created']
+
+        self.count('opened')
+
+        return entry
+
+    def discard(self, entry):
+        try:
+            entry['conn'].close()
+        except Exception:
+            pass
+
+        self.count('closed')
+
+    # Borrow a connection, waiting up to timeout seconds for one to be free. Returns the pool's
+    # entry for the connection, which is what has to be given back.
+    def borrow(self):
+        start = time.monotonic()
+
+        if not self.slots.acquire(blocking=False):
+            self.count('waited')
+
+            if not self.slots.acquire(timeout=self.timeout):
+                self.count('timeouts')
+                return None
+
+            self.count('wait_seconds', time.monotonic() - start)
+
+        try:
+            entry = self.checkout()
+        except:
+            self.slots.release()
+            raise
+
+        with self.lock:
+            self.stats['borrowed'] += 1
+            self.stats['in_use'] += 1
+
+        return entry
+
+    # Find an idle connection that's still good, or open a new one.
+    def checkout(self):
+        while True:
+            try:
+                entry = self.idle.get_nowait()
+            except queue.Empty:
+                return self.open()
+
+            now = time.monotonic()
+
+            if now - entry['created'] >= self.max_lifetime:
+                self.count('recycled')
+                self.discard(entry)
+                continue
+
+            if now - entry['used'] >= self.check_interval:
+                try:
+                    entry['conn'].ping()
+                except Exception:
+                    self.count('failed_checks')
+                    self.discard(entry)
+                    continue
+
+            return entry
+
+    # Give a connection back. One that went wrong, or has outlived max_lifetime, gets closed instead
+    # of going back in the pool.
+    def give_back(self, entry, broken=False):
+        now = time.monotonic()
+
+        if broken or now - entry['created'] >= self.max_lifetime:
+            if not broken:
+                self.count('recycled')
+
+            self.discard(entry)
+        else:
+            entry['used'] = now
+            self.idle.put(entry)
+
+        with self.lock:
+            self.stats['in_use'] -= 1
+
+        self.slots.release()
+
+    def status(self):
+        with self.lock:
+            status = dict(self.stats)
+
+        status['idle'] = self.idle.qsize()
+
+        return status
+
+def get_pool():
+    return current_app.extensions['webtoll_dbpool']
 
 def get_db():
     if 'db' not in g:
-        g.db = mysql.connector.connect(
-            user=current_app.config['DBUSER'],
-            database=current_app.config['DBNAME'],
-            autocommit=True,
-        )
+        entry = get_pool().borrow()
+
+        if entry is None:
+            abort(503, 'no database connections free')
+
+        g.db_entry = entry
+        g.db = entry['conn']
 
     return g.db
 
+# Take this request's connection (as the pool's entry for it) away from the request, for something
+# that will outlive it, like a streamed response. Whatever takes it has to give it back to the pool.
+def detach_db():
+    g.pop('db', None)
+    return g.pop('db_entry', None)
+
 def close_db(e=None):
-    db = g.pop('db', None)
+    entry = g.pop('db_entry', None)
+    g.pop('db', None)
 
-    if db is not None:
-        db.close()
+    if entry is not None:
+        # If the request blew up, we don't know what state the connection is in.
+        get_pool().give_back(entry, broken=e is not None)
+
+def pool_status():
+    return current_app.response_class(json.dumps(get_pool().status()), mimetype='application/json')
 
 def init_app(app):
+    # One connection per waitress thread is as many as we can use. They're only opened as they're needed.
+    app.extensions['webtoll_dbpool'] = ConnectionPool(
+        {'user':app.config['DBUSER'], 'database':app.config['DBNAME'], 'autocommit':True},
+        size=app.config['DBPOOL_SIZE'],
+        timeout=app.config['DBPOOL_TIMEOUT'],
+        max_lifetime=app.config['DBPOOL_MAX_LIFETIME'],
+        check_interval=app.config['DBPOOL_CHECK_INTERVAL'],
+    )
+
     app.teardown_appcontext(close_db)
+    app.add_url_rule('/dbpool', 'dbpool', pool_status)
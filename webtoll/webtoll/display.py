@@ -0,0 +1,165 @@
+import io, logging, re, threading
+
+import numpy as np
+
+from collections import OrderedDict
+from datetime import datetime
+from datetime import timedelta
+
+from flask import Blueprint, current_app, request
+from werkzeug.exceptions import abort
+
+from webtoll import render, series
+from webtoll.cache import cached
+from webtoll.db import get_db
+from webtoll.getdata import check_minutes, toll_series
+
+# Keeps a renderer for every trip and display size clients ask for (up to max_entries of them, the
+# least recently used going first), so that each one only draws what changed since the last time.
+# A renderer draws one frame at a time.
+class Renderers:
+    def __init__(self, max_entries, regular_font, bold_font):
+        self.max_entries = max_entries
+        self.regular_font = regular_font
+        self.bold_font = bold_font
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.fonts = None
+
+    # The renderer (and the lock to hold while using it) for a trip and display size.
+    def get(self, trip, display_size):
+        key = (trip['ramp_on_name'], trip['ramp_off_name'], display_size)
+
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is None:
+                if self.fonts is None:
+                    try:
+                        self.fonts = render.get_fonts(self.regular_font, self.bold_font)
+                    except OSError as e:
+                        logging.error('could not load the display fonts: {}'.format(str(e)))
+                        abort(503, 'display not available')
+
+                entry = (threading.Lock(), render.Renderer(trip, display_size, self.fonts))
+                self.entries[key] = entry
+
+            self.entries.move_to_end(key)
+
+            # Evict the least recently used.
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+            return entry
+
+# The names of a trip's ramps, its latest travel time, and the latest status of the reversible
+# lanes, with the last minute we had each of them, in one go.
+BOARD_SQL = '''
+    SELECT
+        (SELECT ramp_name FROM ramp WHERE ramp_num = %(ramp_on)s LIMIT 1) ramp_on_name,
+        (SELECT ramp_name FROM ramp WHERE ramp_num = %(ramp_off)s LIMIT 1) ramp_off_name,
+        (SELECT COALESCE(time_495, 0) + COALESCE(time_95, 0)
+           FROM time_log
+           WHERE ramp_on = %(ramp_on)s
+             AND ramp_off = %(ramp_off)s
+           ORDER BY time_end_date DESC
+           LIMIT 1) travel_time,
+        (SELECT MAX(time_end_date)
+           FROM time_log
+           WHERE ramp_on = %(ramp_on)s
+             AND ramp_off = %(ramp_off)s) travel_time_date,
+        (SELECT status_code
+           FROM reversible_log
+           ORDER BY reversible_end_date DESC
+           LIMIT 1) reversible,
+        (SELECT MAX(reversible_end_date)
+           FROM reversible_log) reversible_date
+'''
+
+# Turn a size given as "<width>x<height>" into a pair of pixel counts, no bigger than we allow.
+def parse_size(size):
+    match = re.fullmatch(r'(\d+)x(\d+)', size)
+    max_width, max_height = current_app.config['DISPLAY_MAX_SIZE']
+
+    if match is None:
+        abort(400, 'bad size {}'.format(size))
+
+    width, height = int(match.group(1)), int(match.group(2))
+
+    if not (0 < width <= max_width and 0 < height <= max_height):
+        abort(400, 'size must be at most {}x{}'.format(max_width, max_height))
+
+    return (width, height)
+
+bp = Blueprint('display', __name__)
+
+@bp.route('/gettolldisplay/<int:ramp_on>/<int:ramp_off>/<int:minutes>')
+@cached('toll_log', 'time_log', 'reversible_log', mimetype='image/png')
+def get_toll_display(ramp_on, ramp_off, minutes):
+    # Returns the toll display for a trip as a PNG, graphing its toll prices over the last "minutes"
+    # minutes, for clients that can only show an image. "size" is the size of the image (800x480
+    # by default, the size of the display tolldisp draws on). It's drawn once a minute, however
+    # many clients ask for it.
+    display_size = parse_size(request.args.get('size', '800x480'))
+
+    check_minutes(minutes)
+
+    check_time = datetime.now().replace(second=0, microsecond=0)
+    start, length = series.window(check_time, minutes, 1)
+    values = toll_series(ramp_on, ramp_off, start, check_time, length)
+
+    # The highest and lowest tolls we have, and the latest, with the minute it's from.
+    known = np.flatnonzero(~np.isnan(values))
+
+    if len(known):
+        high_toll, low_toll = float(np.nanmax(values)), float(np.nanmin(values))
+        current_toll, toll_date = float(values[known[-1]]), start + timedelta(minutes=int(known[-1]))
+    else:
+        high_toll, low_toll, current_toll, toll_date = None, None, None, None
+
+    db = get_db()
+
+    try:
+        curs = db.cursor(dictionary=True)
+        curs.execute(BOARD_SQL, {'ramp_on':ramp_on, 'ramp_off':ramp_off})
+        board = curs.fetchone()
+    finally:
+        curs.close()
+
+    # Don't pass off what the logger last logged as current when it hasn't logged anything lately.
+    # The travel time goes with the toll, so they're marked as of the older of the two.
+    current_toll, toll_date = render.as_of(current_toll, toll_date, check_time)
+    travel_time, travel_time_date = render.as_of(board['travel_time'], board['travel_time_date'], check_time)
+    reversible, reversible_date = render.as_of(board['reversible'], board['reversible_date'], check_time)
+
+    stale = {}
+
+    toll_dates = [date for date in (toll_date, travel_time_date) if date is not None]
+    if toll_dates:
+        stale['toll'] = min(toll_dates)
+
+    if reversible_date is not None:
+        stale['reversible'] = reversible_date
+
+    trip = {
+        'ramp_on':ramp_on,
+        'ramp_off':ramp_off,
+        'ramp_on_name':board['ramp_on_name'] or 'Ramp {}'.format(ramp_on),
+        'ramp_off_name':board['ramp_off_name'] or 'Ramp {}'.format(ramp_off),
+        'travel_time':travel_time,
+    }
+
+    lock, renderer = current_app.extensions['webtoll_display'].get(trip, display_size)
+
+    with lock:
+        display = renderer.render(check_time, trip, values, high_toll, low_toll, current_toll, reversible, stale)
+
+    png = io.BytesIO()
+    display.save(png, 'PNG')
+
+    return png.getvalue()
+
+def init_app(app):
+    app.extensions['webtoll_display'] = Renderers(app.config['DISPLAY_RENDERERS'],
+        app.config['DISPLAY_FONT_REGULAR'], app.config['DISPLAY_FONT_BOLD'])
+    app.register_blueprint(bp)
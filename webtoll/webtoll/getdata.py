@@ -1,9 +1,11 @@
 from flask import (
-    Blueprint, flash, g, redirect, render_template, request, url_for
+    Blueprint, current_app, flash, g, redirect, render_template, request, url_for
 )
 from werkzeug.exceptions import abort
 
-from webtoll.db import get_db
+from webtoll import binary, series
+from webtoll.cache import cached
+from webtoll.db import detach_db, get_db, get_pool
 
 from datetime import datetime
 from datetime import timedelta
@@ -12,28 +14,447 @@ import json
 
 bp = Blueprint('gettolldata', __name__)
 
+# How many rows to read from the database at a time when streaming.
+STREAM_CHUNK_ROWS = 1000
+
+# Reject a window of more minutes than we'll serve (or none at all).
+def check_minutes(minutes):
+    if not 0 < minutes <= series.MAX_MINUTES:
+        abort(400, 'minutes must be between 1 and {}'.format(series.MAX_MINUTES))
+
 @bp.route('/gettollprices/<int:ramp_on>/<int:ramp_off>/<int:minutes>')
+@cached('toll_log')
 def get_toll_prices(ramp_on, ramp_off, minutes):
+    check_minutes(minutes)
+
     db = get_db()
 
     args = {'ramp_on':ramp_on, 'ramp_off':ramp_off}
     args['min_date'] = datetime.now() - timedelta(minutes=minutes)
 
+    sql = '''
+        SELECT DATE_FORMAT(toll_start_date, '%Y%m%d%H%i') toll_start_date,
+            DATE_FORMAT(toll_end_date, '%Y%m%d%H%i') toll_end_date,
+            CONVERT(COALESCE(price_495, 0) + COALESCE(price_95, 0), CHAR) toll_price
+          FROM toll_log
+          WHERE ramp_on = %(ramp_on)s
+            AND ramp_off = %(ramp_off)s
+            AND toll_end_date >= %(min_date)s
+          ORDER BY toll_end_date DESC, toll_start_date DESC
+    '''
+
+    # For long windows, "?format=ndjson" streams the rows as they come from the database, one
+    # JSON object per line, instead of building the whole response first.
+    if request.args.get('format') == 'ndjson':
+        return current_app.response_class(RowStream(sql, args), mimetype='application/x-ndjson')
+
+    # Clients that ask for it get the rows as columns: start and end minutes, and prices in cents.
+    if binary.wanted():
+        try:
+            curs = db.cursor()
+
+            curs.execute('''
+                SELECT UNIX_TIMESTAMP(toll_start_date) DIV 60,
+                    UNIX_TIMESTAMP(toll_end_date) DIV 60,
+                    CAST(ROUND((COALESCE(price_495, 0) + COALESCE(price_95, 0)) * 100) AS SIGNED)
+                  FROM toll_log
+                  WHERE ramp_on = %(ramp_on)s
+                    AND ramp_off = %(ramp_off)s
+                    AND toll_end_date >= %(min_date)s
+                  ORDER BY toll_end_date DESC, toll_start_date DESC
+            ''', args)
+
+            rows = curs.fetchall()
+        finally:
+            curs.close()
+
+        starts, ends, prices = zip(*rows) if rows else ((), (), ())
+
+        return binary.encode([('start', starts), ('end', ends), ('price', prices)])
+
+    try:
+        curs = db.cursor(dictionary=True)
+
+        curs.execute(sql, args)
+
+        data = curs.fetchall()
+    finally:
+        curs.close()
+
+    return json.dumps(data)
+
+# Streams the rows a query returns as newline-delimited JSON, reading them from the database a
+# chunk at a time, so that we never hold more than a chunk of them however many there are. The
+# response outlives the request, so it takes the request's database connection over, and gives
+# it back to the pool when it's closed (which the server does even if the client goes away early).
+class RowStream:
+    def __init__(self, sql, args):
+        get_db()
+
+        self.pool = get_pool()
+        self.entry = detach_db()
+        self.finished = False
+
+        # An unbuffered cursor leaves the rows on the server until we ask for them.
+        self.curs = self.entry['conn'].cursor(dictionary=True, buffered=False)
+
+        try:
+            self.curs.execute(sql, args)
+        except:
+            self.close()
+            raise
+
+    def __iter__(self):
+        while True:
+            rows = self.curs.fetchmany(STREAM_CHUNK_ROWS)
+
+            if not rows:
+                break
+
+            yield ''.join(json.dumps(row) + '\n' for row in rows)
+
+        self.finished = True
+
+    def close(self):
+        if self.entry is None:
+            return
+
+        try:
+            self.curs.close()
+        except Exception:
+            pass
+
+        # If we didn't get to the end, the rest of the rows are still waiting to be read, and the
+        # connection is no good to anyone else.
+        self.pool.give_back(self.entry, broken=not self.finished)
+        self.entry = None
+
+# Stand-ins for an end date or id that no row is past.
+NO_DATE = '999912312359'
+NO_ID = 2 ** 63 - 1
+
+# Turn the newest end date and id a client has seen into a cursor it can hand back, and back again.
+def make_cursor(since, after_id):
+    return '{}-{}'.format(since, after_id)
+
+def parse_cursor(cursor):
+    try:
+        since, after_id = cursor.split('-')
+        return datetime.strptime(since, '%Y%m%d%H%M'), int(after_id)
+    except ValueError:
+        abort(400, 'bad cursor')
+
+@bp.route('/gettollchanges/<int:ramp_on>/<int:ramp_off>')
+@cached('toll_log')
+def get_toll_changes(ramp_on, ramp_off):
+    # Returns only the toll_log rows for a trip that have been inserted or extended since the
+    # client last asked, along with a cursor to ask with next time. The client says where it's up
+    # to with the cursor from its last call, or with "since" (an end date, YYYYmmddHHMM) and/or
+    # "after_id" (the newest toll_log_id it has). With none of those, it gets the rows for the
+    # last "minutes" minutes (720 by default) to start from.
+    db = get_db()
+
+    args = {'ramp_on':ramp_on, 'ramp_off':ramp_off}
+
+    if 'cursor' in request.args:
+        args['since'], args['after_id'] = parse_cursor(request.args['cursor'])
+    elif 'since' in request.args or 'after_id' in request.args:
+        # Whichever one is missing matches nothing on its own.
+        args['since'], args['after_id'] = parse_cursor(make_cursor(request.args.get('since', NO_DATE),
+            request.args.get('after_id', NO_ID)))
+    else:
+        minutes = request.args.get('minutes', 720, type=int)
+        check_minutes(minutes)
+        args['since'] = datetime.now() - timedelta(minutes=minutes)
+        args['after_id'] = NO_ID
+
     try:
         curs = db.cursor(dictionary=True)
 
+        # Rows that have been extended past the newest end date the client has seen, plus any
+        # rows newer than the newest one it has seen (which can turn up with older end dates when
+        # the logger catches up after a database outage).
         curs.execute('''
-            SELECT DATE_FORMAT(toll_start_date, '%Y%m%d%H%i') toll_start_date,
+            SELECT toll_log_id, toll_end_date end_date,
+                DATE_FORMAT(toll_start_date, '%Y%m%d%H%i') toll_start_date,
+                DATE_FORMAT(toll_end_date, '%Y%m%d%H%i') toll_end_date,
+                CONVERT(COALESCE(price_495, 0) + COALESCE(price_95, 0), CHAR) toll_price
+              FROM toll_log
+              WHERE ramp_on = %(ramp_on)s
+                AND ramp_off = %(ramp_off)s
+                AND toll_end_date > %(since)s
+            UNION
+            SELECT toll_log_id, toll_end_date end_date,
+                DATE_FORMAT(toll_start_date, '%Y%m%d%H%i') toll_start_date,
                 DATE_FORMAT(toll_end_date, '%Y%m%d%H%i') toll_end_date,
                 CONVERT(COALESCE(price_495, 0) + COALESCE(price_95, 0), CHAR) toll_price
               FROM toll_log
               WHERE ramp_on = %(ramp_on)s
                 AND ramp_off = %(ramp_off)s
-                AND toll_end_date >= %(min_date)s
-              ORDER BY toll_end_date DESC, toll_start_date DESC
+                AND toll_log_id > %(after_id)s
+            ORDER BY end_date DESC, toll_start_date DESC
+        ''', args)
+
+        data = curs.fetchall()
+    finally:
+        curs.close()
+
+    # The next cursor picks up from the newest end date and id in this batch, or where the
+    # client already was if there's nothing new.
+    since = max([row.pop('end_date') for row in data], default=args['since'])
+    after_id = max([row['toll_log_id'] for row in data], default=args['after_id'])
+
+    return json.dumps({'rows':data, 'cursor':make_cursor(since.strftime('%Y%m%d%H%M'), after_id)})
+
+# A trip's toll prices for every minute of a window, from start to end, length minutes long, with
+# NaN for the minutes we don't have a price for.
+def toll_series(ramp_on, ramp_off, start, end, length):
+    db = get_db()
+
+    args = {'ramp_on':ramp_on, 'ramp_off':ramp_off, 'start':start, 'end':end}
+
+    try:
+        curs = db.cursor()
+
+        # Each series as its first and last minute, counted from the start of the window.
+        curs.execute('''
+            SELECT TIMESTAMPDIFF(MINUTE, %(start)s, toll_start_date),
+                TIMESTAMPDIFF(MINUTE, %(start)s, toll_end_date),
+                COALESCE(price_495, 0) + COALESCE(price_95, 0)
+              FROM toll_log
+              WHERE ramp_on = %(ramp_on)s
+                AND ramp_off = %(ramp_off)s
+                AND toll_end_date >= %(start)s
+                AND toll_start_date <= %(end)s
         ''', args)
 
+        runs = curs.fetchall()
+    finally:
+        curs.close()
+
+    return series.densify(runs, length)
+
+@bp.route('/gettollseries/<int:ramp_on>/<int:ramp_off>/<int:minutes>')
+@cached('toll_log')
+def get_toll_series(ramp_on, ramp_off, minutes):
+    # Returns a trip's toll prices for the last "minutes" minutes as one value per minute, oldest
+    # first, with null for the minutes we don't have a price for. With "resolution" (5, 15, 30 or
+    # 60 minutes), it returns the lowest, highest, average and last price in each bucket instead.
+    resolution = request.args.get('resolution', 1, type=int)
+
+    if resolution not in series.RESOLUTIONS:
+        abort(400, 'resolution must be one of {}'.format(', '.join(str(r) for r in series.RESOLUTIONS)))
+
+    check_minutes(minutes)
+
+    end = datetime.now().replace(second=0, microsecond=0)
+    start, length = series.window(end, minutes, resolution)
+
+    values = toll_series(ramp_on, ramp_off, start, end, length)
+
+    # Clients that ask for it get the prices in cents, with the minute of the first one and the
+    # minutes between them in the header.
+    if binary.wanted():
+        if resolution == 1:
+            columns = [('value', binary.cents(values))]
+        else:
+            columns = [(name, binary.cents(aggregate)) for name, aggregate in series.downsample(values, resolution).items()]
+
+        return binary.encode(columns, origin=int(start.timestamp() // 60), step=resolution)
+
+    data = {'start':start.strftime('%Y%m%d%H%M'), 'resolution':resolution}
+
+    if resolution == 1:
+        data['values'] = series.to_list(values)
+    else:
+        for name, aggregate in series.downsample(values, resolution).items():
+            data[name] = series.to_list(aggregate)
+
+    return json.dumps(data)
+
+# The most trips one batch request can ask for.
+MAX_BATCH_TRIPS = 50
+
+# What a batch request can ask for, and the query that gets it. The trip queries get "{trips}"
+# filled in with the list of trips.
+BATCH_METRICS = {
+    'price':'''
+        SELECT ramp_on, ramp_off,
+            DATE_FORMAT(toll_start_date, '%Y%m%d%H%i') toll_start_date,
+            DATE_FORMAT(toll_end_date, '%Y%m%d%H%i') toll_end_date,
+            CONVERT(COALESCE(price_495, 0) + COALESCE(price_95, 0), CHAR) toll_price
+          FROM toll_log
+          WHERE (ramp_on, ramp_off) IN ({trips})
+            AND toll_end_date >= %(min_date)s
+          ORDER BY toll_end_date DESC, toll_start_date DESC
+    ''',
+    'time':'''
+        SELECT ramp_on, ramp_off,
+            DATE_FORMAT(time_start_date, '%Y%m%d%H%i') time_start_date,
+            DATE_FORMAT(time_end_date, '%Y%m%d%H%i') time_end_date,
+            COALESCE(time_495, 0) + COALESCE(time_95, 0) travel_time
+          FROM time_log
+          WHERE (ramp_on, ramp_off) IN ({trips})
+            AND time_end_date >= %(min_date)s
+          ORDER BY time_end_date DESC, time_start_date DESC
+    ''',
+    'reversible':'''
+        SELECT DATE_FORMAT(reversible_start_date, '%Y%m%d%H%i') reversible_start_date,
+            DATE_FORMAT(reversible_end_date, '%Y%m%d%H%i') reversible_end_date,
+            status_code
+          FROM reversible_log
+          WHERE reversible_end_date >= %(min_date)s
+          ORDER BY reversible_end_date DESC, reversible_start_date DESC
+    ''',
+}
+
+# Turn a trip given as "ramp_on-ramp_off" into a pair of ramp numbers.
+def parse_trip(trip):
+    try:
+        ramp_on, ramp_off = trip.split('-')
+        return int(ramp_on), int(ramp_off)
+    except ValueError:
+        abort(400, 'bad trip {}'.format(trip))
+
+@bp.route('/gettolldata')
+@cached('toll_log', 'time_log', 'reversible_log')
+def get_toll_data():
+    # Returns the data for any number of trips and metrics over the last "minutes" minutes (720 by
+    # default) in one go, e.g. "?trip=182-191&trip=183-218&metric=price&metric=time&minutes=60".
+    # Every metric takes one query, however many trips there are. The trips come back in the order
+    # they were asked for, each with a list of rows per metric; the reversible lanes' status isn't
+    # tied to a trip, so it comes back on its own.
+    trips = list(dict.fromkeys(parse_trip(trip) for trip in request.args.getlist('trip')))
+    metrics = list(dict.fromkeys(request.args.getlist('metric') or ['price']))
+    minutes = request.args.get('minutes', 720, type=int)
+
+    check_minutes(minutes)
+
+    for metric in metrics:
+        if metric not in BATCH_METRICS:
+            abort(400, 'unknown metric {}'.format(metric))
+
+    if len(trips) > MAX_BATCH_TRIPS:
+        abort(400, 'no more than {} trips at a time'.format(MAX_BATCH_TRIPS))
+
+    args = {'min_date':datetime.now() - timedelta(minutes=minutes)}
+
+    for index, (ramp_on, ramp_off) in enumerate(trips):
+        args['ramp_on_{}'.format(index)] = ramp_on
+        args['ramp_off_{}'.format(index)] = ramp_off
+
+    trip_list = ', '.join('(%(ramp_on_{0})s, %(ramp_off_{0})s)'.format(index) for index in range(len(trips)))
+
+    data = {'trips':[{'ramp_on':ramp_on, 'ramp_off':ramp_off} for ramp_on, ramp_off in trips]}
+    by_trip = {(trip['ramp_on'], trip['ramp_off']):trip for trip in data['trips']}
+
+    db = get_db()
+
+    try:
+        curs = db.cursor(dictionary=True)
+
+        for metric in metrics:
+            if metric == 'reversible':
+                curs.execute(BATCH_METRICS[metric], args)
+                data['reversible'] = curs.fetchall()
+                continue
+
+            for trip in data['trips']:
+                trip[metric] = []
+
+            # There's nothing to ask the database if there are no trips.
+            if len(trips) == 0:
+                continue
+
+            curs.execute(BATCH_METRICS[metric].replace('{trips}', trip_list), args)
+
+            for row in curs.fetchall():
+                by_trip[(row.pop('ramp_on'), row.pop('ramp_off'))][metric].append(row)
+    finally:
+        curs.close()
+
+    return json.dumps(data)
+
+# The hourly and daily statistics a rollup request can ask for, and the query that gets them.
+ROLLUP_METRICS = {
+    'price':'''
+        SELECT DATE_FORMAT(period_start, '%Y%m%d%H%i') period_start, minutes,
+            CONVERT(ROUND(price_total / minutes, 2), CHAR) avg,
+            CONVERT(price_min, CHAR) min,
+            CONVERT(price_max, CHAR) max
+          FROM toll_rollup
+          WHERE ramp_on = %(ramp_on)s
+            AND ramp_off = %(ramp_off)s
+            AND period = %(period)s
+            AND period_start >= %(min_date)s
+          ORDER BY period_start
+    ''',
+    'time':'''
+        SELECT DATE_FORMAT(period_start, '%Y%m%d%H%i') period_start, minutes,
+            CONVERT(ROUND(time_total / minutes, 1), CHAR) avg,
+            time_min min,
+            time_max max
+          FROM time_rollup
+          WHERE ramp_on = %(ramp_on)s
+            AND ramp_off = %(ramp_off)s
+            AND period = %(period)s
+            AND period_start >= %(min_date)s
+          ORDER BY period_start
+    ''',
+}
+
+# How many minutes of each period a trip's toll spent at each price.
+ROLLUP_PRICES = '''
+    SELECT DATE_FORMAT(period_start, '%Y%m%d%H%i') period_start, CONVERT(price, CHAR) price, minutes
+      FROM toll_price_rollup
+      WHERE ramp_on = %(ramp_on)s
+        AND ramp_off = %(ramp_off)s
+        AND period = %(period)s
+        AND period_start >= %(min_date)s
+      ORDER BY period_start, price
+'''
+
+ROLLUP_PERIODS = {'hour':'H', 'day':'D'}
+
+@bp.route('/getrollup/<int:ramp_on>/<int:ramp_off>/<int:days>')
+@cached('toll_log', 'time_log')
+def get_rollup(ramp_on, ramp_off, days):
+    # Returns the hourly (or with "period=day", daily) statistics for a trip's toll prices (or with
+    # "metric=time", travel times) for the last "days" days, counting today, oldest first: the
+    # minutes we have a value for, and the time-weighted average, lowest and highest values. Prices
+    # also come with how many minutes the toll spent at each one, as "prices".
+    metric = request.args.get('metric', 'price')
+    period = request.args.get('period', 'hour')
+
+    if metric not in ROLLUP_METRICS:
+        abort(400, 'unknown metric {}'.format(metric))
+
+    if period not in ROLLUP_PERIODS:
+        abort(400, 'unknown period {}'.format(period))
+
+    args = {'ramp_on':ramp_on, 'ramp_off':ramp_off, 'period':ROLLUP_PERIODS[period]}
+    args['min_date'] = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=days - 1)
+
+    db = get_db()
+
+    try:
+        curs = db.cursor(dictionary=True)
+
+        curs.execute(ROLLUP_METRICS[metric], args)
+
         data = curs.fetchall()
+
+        if metric == 'price':
+            prices = {row['period_start']:{} for row in data}
+
+            curs.execute(ROLLUP_PRICES, args)
+
+            for row in curs:
+                if row['period_start'] in prices:
+                    prices[row['period_start']][row['price']] = row['minutes']
+
+            for row in data:
+                row['prices'] = prices[row['period_start']]
     finally:
         curs.close()
 
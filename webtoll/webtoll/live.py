@@ -0,0 +1,179 @@
+import json, logging, os, socket, threading
+
+from flask import Blueprint, current_app, request
+from werkzeug.exceptions import abort
+
+from webtoll.getdata import parse_trip
+
+# The logger sends what it knows about every trip, and the reversible lanes, once a tick, as a JSON
+# datagram to a Unix socket (see tollfeed.py). The hub listens on the socket and hands the latest
+# update to every client waiting on one, either as a stream of Server-Sent Events or by long-polling,
+# so that however many displays there are, only the logger goes to the web API.
+class Hub:
+    def __init__(self, path, max_subscribers):
+        self.path = path
+        self.max_subscribers = max_subscribers
+        self.condition = threading.Condition()
+        # Every update gets the next sequence number, so clients can say which one they have.
+        self.seq = 0
+        self.update = None
+        self.subscribers = 0
+        self.started = False
+
+    # Start listening for updates from the logger, unless we already are. Returns whether we are.
+    def start(self):
+        with self.condition:
+            if self.started:
+                return True
+
+            try:
+                # Clear out a socket left over from the last time we ran.
+                if os.path.exists(self.path):
+                    os.unlink(self.path)
+
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+                sock.bind(self.path)
+                # The logger runs as a different user, in our group.
+                os.chmod(self.path, 0o660)
+            except OSError as e:
+                logging.error('could not listen for updates on {}: {}'.format(self.path, str(e)))
+                return False
+
+            threading.Thread(target=self.listen, args=(sock,), name='live', daemon=True).start()
+            self.started = True
+
+            return True
+
+    def listen(self, sock):
+        while True:
+            try:
+                update = json.loads(sock.recv(65536).decode('utf-8'))
+            except ValueError as e:
+                logging.warning('ignoring bad update: {}'.format(str(e)))
+                continue
+
+            with self.condition:
+                self.seq += 1
+                self.update = update
+                self.condition.notify_all()
+
+    # Wait up to timeout seconds for an update newer than the one numbered after. Returns the latest
+    # update's number and the update (None if there hasn't been one).
+    def wait(self, after, timeout):
+        with self.condition:
+            self.condition.wait_for(lambda: self.seq > after, timeout)
+            return self.seq, self.update
+
+    # Where to carry on from for a client that says it has the update numbered after. A number we
+    # haven't got to yet is from before we restarted, so that client starts over.
+    def resume_from(self, after):
+        with self.condition:
+            return after if after <= self.seq else 0
+
+    # Count a client in, if there's room for it. Every client waiting on us is holding a server
+    # thread, and we have to leave some for the rest of the requests.
+    def subscribe(self):
+        with self.condition:
+            if self.subscribers >= self.max_subscribers:
+                return False
+
+            self.subscribers += 1
+            return True
+
+    def unsubscribe(self):
+        with self.condition:
+            self.subscribers -= 1
+
+def get_hub():
+    hub = current_app.extensions['webtoll_live']
+
+    if not hub.start():
+        abort(503, 'live updates not available')
+
+    return hub
+
+# The part of an update a client asked for: just the trips it listed, or all of them.
+def client_update(seq, update, trips):
+    update = dict(update, seq=seq)
+
+    if trips:
+        update['trips'] = [trip for trip in update['trips'] if (trip['ramp_on'], trip['ramp_off']) in trips]
+
+    return update
+
+# A stream of Server-Sent Events, one per update, for as long as the client stays connected. Like a
+# streamed query, it's closed by the server when the client goes away, which is when it gives up
+# its place with the hub.
+class EventStream:
+    def __init__(self, hub, after, trips, keepalive):
+        self.hub = hub
+        self.after = after
+        self.trips = trips
+        self.keepalive = keepalive
+        self.subscribed = True
+
+    def __iter__(self):
+        # Tell the client how long to wait before reconnecting if we go away.
+        yield 'retry: 5000\n\n'
+
+        while True:
+            seq, update = self.hub.wait(self.after, self.keepalive)
+
+            if seq > self.after and update is not None:
+                self.after = seq
+                yield 'id: {}\ndata: {}\n\n'.format(seq, json.dumps(client_update(seq, update, self.trips)))
+            else:
+                # A comment, to keep the connection (and anything in between) from timing out.
+                yield ': keepalive\n\n'
+
+    def close(self):
+        if self.subscribed:
+            self.subscribed = False
+            self.hub.unsubscribe()
+
+bp = Blueprint('live', __name__)
+
+@bp.route('/live/events')
+def live_events():
+    # Server-Sent Events with the latest tolls, travel times and reversible lanes status as of every
+    # tick of the logger, starting with the latest one there is. "trip=<on>-<off>" (as many as you
+    # like) narrows it down to just those trips. A reconnecting client's Last-Event-ID picks up
+    # where it left off.
+    hub = get_hub()
+    trips = set(parse_trip(trip) for trip in request.args.getlist('trip'))
+    after = hub.resume_from(request.headers.get('Last-Event-ID', 0, type=int))
+
+    if not hub.subscribe():
+        abort(503, 'too many live clients')
+
+    response = current_app.response_class(EventStream(hub, after, trips, current_app.config['LIVE_KEEPALIVE']),
+        mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+
+    return response
+
+@bp.route('/live/poll')
+def live_poll():
+    # Long-polling, for clients that can't do Server-Sent Events: returns the latest update as soon
+    # as there's one newer than "after" (the "seq" of the last one the client got), or 204 No
+    # Content if none turns up within LIVE_POLL_TIMEOUT seconds. Takes "trip" like /live/events.
+    hub = get_hub()
+    trips = set(parse_trip(trip) for trip in request.args.getlist('trip'))
+    after = hub.resume_from(request.args.get('after', 0, type=int))
+
+    if not hub.subscribe():
+        abort(503, 'too many live clients')
+
+    try:
+        seq, update = hub.wait(after, current_app.config['LIVE_POLL_TIMEOUT'])
+    finally:
+        hub.unsubscribe()
+
+    if seq <= after or update is None:
+        return ('', 204)
+
+    return current_app.response_class(json.dumps(client_update(seq, update, trips)), mimetype='application/json')
+
+def init_app(app):
+    app.extensions['webtoll_live'] = Hub(app.config['LIVE_SOCKET'], app.config['LIVE_MAX_SUBSCRIBERS'])
+    app.register_blueprint(bp)
@@ -0,0 +1,246 @@
+import numpy as np
+
+from datetime import timedelta
+from PIL import Image, ImageDraw, ImageFont
+
+# Draws the toll display: the day and time, a trip's current toll and travel time, the highest and
+# lowest tolls over a window with a graph of them, and the status of the reversible lanes. It only
+# needs Pillow and NumPy, not a window to draw in, so the same board can be drawn on a display
+# (tolldisp.py) or by the web service, as a PNG for clients that only show images. Nothing in here
+# needs a Flask app or the database, and importing the package doesn't import Flask, so tolldisp
+# can use it from a package installed without its dependencies.
+
+# The width and height of a text, as drawn at the origin.
+def text_size(draw, text, font):
+    (left, top, right, bottom) = draw.textbbox((0, 0), text, font=font)
+
+    return (right, bottom)
+
+def calc_toll_color(toll):
+    low_toll = 10.0
+    low_color = (0x2d, 0x82, 0x00)
+
+    high_toll = 20.0
+    high_color = (0xff, 0x00, 0x24)
+    
+    if toll <= low_toll:
+        toll_color = low_color
+    elif toll >= high_toll:
+        toll_color = high_color
+    else:
+        gradient = (toll - low_toll)/(high_toll - low_toll)
+        toll_red = low_color[0] + int((high_color[0] - low_color[0]) * gradient)
+        toll_green = low_color[1] + int((high_color[1] - low_color[1]) * gradient)
+        toll_blue = low_color[2] + int((high_color[2] - low_color[2]) * gradient)
+        toll_color = (toll_red, toll_green, toll_blue)
+
+    return toll_color
+
+# How many minutes old a toll, travel time or reversible lanes status can be and still be shown as
+# current. The logger only polls a trip whose toll hasn't been changing every 10 minutes
+# (POLL_CEILING in logtolls.py), so that's as old as the latest value gets, plus the minute the
+# next poll is in. Past that, we keep showing it, marked with the minute it's from, until it's
+# MAX_STALE_MINUTES old, and then show that we don't have one.
+CURRENT_MINUTES = 11
+MAX_STALE_MINUTES = 30
+
+# A value as of the minute we last had it, as we'd show it at check_time: (value, None) if it's
+# current, (value, minute) if it's older than that, and (None, None) if it's too old to be worth
+# showing, or we don't have it at all. The web service and tolldisp both go by this.
+def as_of(value, minute, check_time):
+    if value is None or minute is None or check_time - minute > timedelta(minutes=MAX_STALE_MINUTES):
+        return None, None
+
+    return value, (minute if check_time - minute > timedelta(minutes=CURRENT_MINUTES) else None)
+
+# Colors for our display.
+BACKGROUND_COLOR = (0x34, 0x34, 0x34)
+GRAPH_COLOR = (0x8c, 0x13, 0x1a)
+TEXT_COLOR = (0x8b, 0x8b, 0x8b)
+# For values we don't have, or only have an old one of.
+STALE_COLOR = (0x5c, 0x5c, 0x5c)
+
+# A price, or dashes if we don't have one.
+def price_text(price):
+    return '${:.2f}'.format(price) if price is not None else '$--.--'
+
+# Draws the toll display in layers, so that each frame only redraws what changed. The background,
+# the graph and the text that never changes (the trip) are kept composited from frame to frame as
+# an array of the display's pixels, and only the columns whose bars have moved get repainted, all
+# at once. Only the text that changes (the date and time, the tolls, the reversible lanes and the
+# travel time) is drawn every frame.
+class Renderer:
+    def __init__(self, trip, display_size, fonts):
+        self.display_size = display_size
+        self.fonts = fonts
+        (width, height) = display_size
+
+        # The row number of every row of pixels, for painting bars a column at a time.
+        self.rows = np.arange(height)[:, None]
+        # The top of the bar in each column (height for no bar).
+        self.tops = np.full(width, height)
+
+        # The trip text, as a mask to paint the text color through.
+        static = Image.new('L', display_size, 0)
+        draw = ImageDraw.Draw(static)
+
+        # Use this height as the margin.
+        margin = fonts['day_height']
+        self.margin = margin
+
+        # The ramp where the trip starts.
+        (text_width, text_height) = text_size(draw, 'From: ', font=fonts['label'])
+        anchor = (margin + text_width, height/6)
+        draw.text((margin, anchor[1] - fonts['label_height']), 'From: ', fill=255, font=fonts['label'])
+        draw.text((anchor[0], anchor[1] - fonts['trip_height']), trip['ramp_on_name'], fill=255, font=fonts['trip'])
+
+        # The ramp where the trip ends.
+        (text_width, text_height) = text_size(draw, 'To: ', font=fonts['label'])
+        draw.text((anchor[0] - text_width, anchor[1]), 'To: ', fill=255, font=fonts['label'])
+        anchor = (anchor[0], anchor[1] + fonts['label_height'] - fonts['trip_height'])
+        draw.text((anchor[0], anchor[1]), trip['ramp_off_name'], fill=255, font=fonts['trip'])
+
+        # Where the text that changes goes: the highest and lowest tolls and the reversible lanes
+        # under the trip, and the current toll, time and travel time right-aligned to the right
+        # edge (less the margin).
+        self.high_anchor = (margin, anchor[1] + fonts['trip_height'] + margin)
+        self.low_anchor = (margin, self.high_anchor[1] + fonts['trip_height'] + margin/2)
+        self.reversible_anchor = (margin, self.high_anchor[1] + fonts['trip_height']*2 + margin*2)
+        self.right = width - margin
+        self.toll_top = (height/2) - fonts['toll_height'] + margin
+        self.time_top = self.toll_top - fonts['label_height']
+        self.travel_top = (height/2) + (margin * 2)
+        # When the current toll and travel time, or the reversible lanes status, are old news, the
+        # minute they're from goes under them.
+        self.travel_note_top = self.travel_top + fonts['trip_height'] + margin/2
+        self.reversible_note_anchor = (margin, self.reversible_anchor[1] + fonts['trip_height'] + margin/2)
+
+        # Every pixel as it looks with the trip text over the background, and over the graph, to
+        # repaint columns from. The frame starts out with no bars.
+        layers = []
+
+        for color in (BACKGROUND_COLOR, GRAPH_COLOR):
+            layer = Image.new('RGB', display_size, color)
+            layer.paste(TEXT_COLOR, (0, 0), static)
+            layers.append(np.asarray(layer))
+
+        (self.over_background, self.over_graph) = layers
+        self.pixels = self.over_background.copy()
+
+    # Bring the graph up to date with the tolls, oldest to most recent, scaled so that the highest
+    # reaches a third of the way to the top.
+    def paint_graph(self, values, high_toll):
+        (width, height) = self.display_size
+
+        if len(values) == 0 or not high_toll:
+            tops = np.full(width, height)
+        else:
+            # The toll for each column of pixels, spreading the tolls across the display.
+            tolls = values[np.arange(width) * len(values) // width]
+            # No bar where we don't have price data.
+            tops = np.where(np.isnan(tolls), height,
+                height - (np.nan_to_num(tolls) * height / (high_toll * 3)).astype(int))
+
+        # Repaint the columns whose bars moved.
+        changed = np.flatnonzero(tops != self.tops)
+
+        if len(changed):
+            bars = (self.rows >= tops[changed])[:, :, None]
+            self.pixels[:, changed] = np.where(bars, self.over_graph[:, changed], self.over_background[:, changed])
+            self.tops = tops
+
+    # Draw a text right-aligned to the right edge of the display (less the margin).
+    def draw_right(self, draw, top, text, fill, font):
+        (width, height) = text_size(draw, text, font=font)
+        draw.text((self.right - width, top), text, fill=fill, font=font)
+
+    # Draw the display for a minute, returning the image. Values are the tolls, oldest to most
+    # recent, with NaN where we don't have one; the highest, lowest and current tolls are given
+    # separately, since whoever has the tolls usually knows them already. Any of them (and the
+    # trip's travel time, and the reversible lanes status) can be None when we don't have one, and
+    # it's shown as such. Stale says which of the current toll (and travel time, which comes with
+    # it) and the reversible lanes status are from an earlier minute, and which: {'toll':<datetime>,
+    # 'reversible':<datetime>}.
+    def render(self, check_time, trip, values, high_toll, low_toll, current_toll, reversible, stale=None):
+        fonts = self.fonts
+        stale = stale or {}
+
+        # The background, the graph and the trip, and then the rest on top of a copy of them.
+        self.paint_graph(values, high_toll)
+
+        display = Image.fromarray(self.pixels, 'RGB')
+        draw = ImageDraw.Draw(display)
+
+        # Put the day and date centered at the top.
+        day_text = check_time.strftime('%A %m/%d/%Y')
+        (width, height) = text_size(draw, day_text, font=fonts['day'])
+        draw.text(((self.display_size[0] - width)/2, self.margin), day_text, fill=TEXT_COLOR, font=fonts['day'])
+
+        # The highest and lowest tolls in the last X minutes.
+        draw.text(self.high_anchor, 'High: ' + price_text(high_toll), fill=TEXT_COLOR, font=fonts['trip'])
+        draw.text(self.low_anchor, 'Low: ' + price_text(low_toll), fill=TEXT_COLOR, font=fonts['trip'])
+
+        # The status of the reversible lanes.
+        reversible_text = 'I95 '
+        if reversible == 'N':
+            reversible_text += 'Open Northbound'
+        elif reversible == 'S':
+            reversible_text += 'Open Southbound'
+        elif reversible == 'C':
+            reversible_text += 'Closed'
+        else:
+            reversible_text += 'Status Unknown'
+
+        draw.text(self.reversible_anchor, reversible_text,
+            fill=STALE_COLOR if reversible is None or 'reversible' in stale else TEXT_COLOR, font=fonts['trip'])
+
+        if 'reversible' in stale:
+            draw.text(self.reversible_note_anchor, stale['reversible'].strftime('As of %I:%M %p'),
+                fill=STALE_COLOR, font=fonts['day'])
+
+        # The current toll, in the color for how high it is, as long as it's current.
+        if current_toll is None or 'toll' in stale:
+            toll_color = STALE_COLOR
+        else:
+            toll_color = calc_toll_color(current_toll)
+
+        self.draw_right(draw, self.toll_top, price_text(current_toll), toll_color, fonts['toll'])
+
+        # The current time, and the current travel time.
+        self.draw_right(draw, self.time_top, check_time.strftime('%I:%M %p'), TEXT_COLOR, fonts['label'])
+
+        if trip['travel_time'] is not None:
+            travel_text = 'Travel Time {:n} Minutes'.format(trip['travel_time'])
+        else:
+            travel_text = 'Travel Time -- Minutes'
+
+        self.draw_right(draw, self.travel_top, travel_text,
+            STALE_COLOR if trip['travel_time'] is None or 'toll' in stale else TEXT_COLOR, fonts['trip'])
+
+        if 'toll' in stale:
+            self.draw_right(draw, self.travel_note_top, stale['toll'].strftime('As of %I:%M %p'), STALE_COLOR, fonts['day'])
+
+        return display
+
+def font_heights(fonts):
+    # We need an image and a drawing context to find the font heights.
+    junkimg = Image.new('RGB', (800, 480), color=(0x00, 0x00, 0x00))
+    junkdraw = ImageDraw.Draw(junkimg)
+
+    # Find the height of each font.
+    for font_name in list(fonts.keys()):
+        (width, fonts[font_name + '_height']) = text_size(junkdraw, 'X', font=fonts[font_name])
+
+def get_fonts(regular='Ubuntu-R', bold='Ubuntu-B'):
+    fonts = {}
+
+    fonts['day'] = ImageFont.truetype(font=regular, size=22)
+    fonts['label'] = ImageFont.truetype(font=regular, size=42)
+    fonts['trip'] = ImageFont.truetype(font=regular, size=24)
+    fonts['time'] = ImageFont.truetype(font=regular, size=24)
+    fonts['toll'] = ImageFont.truetype(font=bold, size=140)
+
+    # Find the "absolute" height for each font.
+    font_heights(fonts)
+
+    return fonts
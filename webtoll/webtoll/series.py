@@ -0,0 +1,78 @@
+import numpy as np
+
+from datetime import timedelta
+
+# The log tables store runs of identical values (a start date, an end date and a value). These
+# turn runs into one value per minute, and per-minute values into per-bucket aggregates, with
+# numpy doing the work instead of a loop per minute.
+
+# The bucket sizes, in minutes, we'll aggregate to. They all divide a day evenly, so buckets can
+# line up with the clock (on the hour, on the quarter hour, and so on).
+RESOLUTIONS = (1, 5, 15, 30, 60)
+
+# The longest window, in minutes (31 days), that any request can ask for. An expanded series
+# takes 8 bytes a minute, and some more for each aggregate, and the other requests read every row
+# in the window, so this keeps one request from taking all of our memory.
+MAX_MINUTES = 31 * 24 * 60
+
+# The window of minutes that covers the last "minutes" minutes up to and including end, widened
+# so that it starts and ends on a bucket boundary. Returns its first minute and its length in minutes.
+def window(end, minutes, resolution):
+    start = end - timedelta(minutes=minutes - 1)
+
+    # Back up to the start of the bucket.
+    midnight = start.replace(hour=0, minute=0)
+    start -= timedelta(minutes=((start - midnight).seconds // 60) % resolution)
+
+    # Pad out to the end of the last bucket.
+    length = int((end - start).total_seconds() // 60) + 1
+    length += -length % resolution
+
+    return start, length
+
+# Expand runs, given as (first minute, last minute, value) with the minutes as offsets into the
+# window, into one value per minute of a window length minutes long. Minutes that no run covers are NaN.
+def densify(runs, length):
+    values = np.full(length, np.nan)
+    runs = np.array(runs, dtype=float).reshape(-1, 3)
+
+    # Keep only the part of each run that's in the window.
+    firsts = np.clip(runs[:, 0], 0, length).astype(np.int64)
+    lasts = np.clip(runs[:, 1], -1, length - 1).astype(np.int64)
+    counts = np.maximum(lasts - firsts + 1, 0)
+
+    # The minute offsets each run covers, all strung together: each run's first minute, repeated
+    # once per minute of the run, plus how far into the run each minute is.
+    run_starts = np.repeat(np.cumsum(counts) - counts, counts)
+    minutes = np.repeat(firsts, counts) + np.arange(counts.sum()) - run_starts
+
+    values[minutes] = np.repeat(runs[:, 2], counts)
+
+    return values
+
+# Aggregate per-minute values into buckets of resolution minutes: the lowest, highest and average
+# of the values we have in each bucket, and the last one. Buckets with no values at all get NaN.
+def downsample(values, resolution):
+    buckets = values.reshape(-1, resolution)
+    known = ~np.isnan(buckets)
+    counts = known.sum(axis=1)
+
+    # fmin and fmax skip NaNs, without the warnings nanmin and nanmax give for empty buckets.
+    lows = np.fmin.reduce(buckets, axis=1)
+    highs = np.fmax.reduce(buckets, axis=1)
+
+    totals = np.where(known, buckets, 0).sum(axis=1)
+    averages = np.divide(totals, counts, out=np.full(len(buckets), np.nan), where=counts > 0)
+
+    # The position of the last known value in each bucket (-1 if there isn't one).
+    last_index = np.where(known, np.arange(resolution), -1).max(axis=1)
+    lasts = np.where(last_index >= 0, buckets[np.arange(len(buckets)), last_index], np.nan)
+
+    return {'min':lows, 'max':highs, 'avg':averages, 'last':lasts}
+
+# A list of values, rounded to the cent, ready for json.dumps. NaNs become None (null).
+def to_list(values):
+    rounded = np.round(values, 2).astype(object)
+    rounded[np.isnan(values)] = None
+
+    return rounded.tolist()